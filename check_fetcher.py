@@ -53,12 +53,14 @@ def main():
     now = datetime.datetime.now()
     since = now - datetime.timedelta(days=look_back_days)
 
-    json_resp = pw.get_patches_all(delegate=delegate, since=since)
     jdb = []
+    patch_cnt = 0
     old_unchanged = 0
     check_updates = 0
     seen_pids = set()
-    for p in json_resp:
+    # Process patches as the pages arrive
+    for p in pw.iter_patches_all(delegate=delegate, since=since):
+        patch_cnt += 1
         pdate = datetime.datetime.fromisoformat(p["date"])
         hours_old = (now - pdate).total_seconds() // 3600
         # Checks won't get updated after 2+ days, so if the state is the same - skip
@@ -107,7 +109,7 @@ def main():
         new_db.append(row)
     new_db += jdb
     print(f'Old db: {len(old_db)}, retained: {old_stayed}')
-    print(f'Fetching: patches: {len(json_resp)}, patches old-unchanged: {old_unchanged}, checks fetched: {len(jdb)}, checks were updates: {check_updates}')
+    print(f'Fetching: patches: {patch_cnt}, patches old-unchanged: {old_unchanged}, checks fetched: {len(jdb)}, checks were updates: {check_updates}')
     print(f'Writing:  refreshed: {skipped}, new: {len(new_db) - old_stayed}, expired: {horizon_gc} new len: {len(new_db)}')
 
     with open(tgt_json, "w") as fp:
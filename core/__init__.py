@@ -20,8 +20,9 @@ NIPA_DIR : str
 import os
 
 from .lifetime import NipaLifetime
-from .logger import log, log_open_sec, log_end_sec, log_init
+from .logger import log, log_open_sec, log_end_sec, log_init, log_render
 from .patch import Patch
+from .result_cache import ResultCache
 from .test import Test
 from .tree import Tree, PatchApplyError, PullError
 from .tester import Tester, write_tree_selection_result, mark_done
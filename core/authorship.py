@@ -0,0 +1,399 @@
+# SPDX-License-Identifier: GPL-2.0
+
+""" Per-file git authorship statistics, updated incrementally """
+
+import os
+import pickle
+import re
+import subprocess
+import tempfile
+import threading
+import time
+
+import core
+
+# Trailers get_maintainer.pl counts as signatures (unless --git-all-signature-types)
+_signature = re.compile(r'^[ \t]*(?:Signed-off-by|Reviewed-by|Acked-by):\s*(.*@.*)$', re.MULTILINE)
+
+_log_format = '--format=%x1e%H%x1f%ct%x1f%an <%ae>%x1f%b%x1f'
+
+
+def _git(tree, args):
+    # Not using tree.git(), the output is too large to be logged
+    res = subprocess.run(['git'] + args, cwd=tree.path, stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL, check=True)
+    return res.stdout.decode('utf-8', 'replace')
+
+
+def commit_signatures(body):
+    return [m.strip() for m in _signature.findall(body)]
+
+
+class Mailmap:
+    """Identity mapping from a .mailmap file, as applied by get_maintainer.pl"""
+    _entry = re.compile(r'([^<]*)<([^>]*)>')
+
+    def __init__(self, path):
+        # lower case email -> (name, email), (name, lower case email) -> (name, email)
+        self.by_email = {}
+        self.by_name_email = {}
+
+        try:
+            with open(path, 'r', errors='replace') as fp:
+                lines = fp.readlines()
+        except OSError:
+            lines = []
+
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            ids = [(name.strip(), addr.strip()) for name, addr in self._entry.findall(line)]
+            if len(ids) == 1:
+                # Proper Name <commit email>, only replaces the name
+                name, addr = ids[0]
+                if name:
+                    self.by_email[addr.lower()] = (name, None)
+            elif len(ids) == 2:
+                (name, addr), (commit_name, commit_addr) = ids
+                if commit_name:
+                    self.by_name_email[(commit_name, commit_addr.lower())] = (name, addr)
+                else:
+                    self.by_email[commit_addr.lower()] = (name, addr)
+
+    def map(self, name_email):
+        match = self._entry.match(name_email)
+        if not match:
+            return name_email
+        name, addr = match.group(1).strip(), match.group(2).strip()
+
+        mapped = self.by_name_email.get((name, addr.lower()))
+        if mapped is None:
+            mapped = self.by_email.get(addr.lower())
+        if mapped is None:
+            return name_email
+        new_name, new_addr = mapped
+        return f"{new_name or name} <{new_addr or addr}>"
+
+
+def _numstat_paths(path):
+    """Old and new path of a --numstat line's path, old is None unless renamed"""
+    if ' => ' not in path:
+        return None, path
+    if '{' in path and '}' in path:
+        pfx, rest = path.split('{', 1)
+        mid, sfx = rest.split('}', 1)
+        old, new = mid.split(' => ', 1)
+        # Moves in or out of a directory look like "dir/{ => sub}/file"
+        return (pfx + old + sfx).replace('//', '/'), (pfx + new + sfx).replace('//', '/')
+    old, new = path.split(' => ', 1)
+    return old, new
+
+
+class _History:
+    """Commits and the files they touched"""
+    def __init__(self):
+        # sha -> (commit time, author, signatures)
+        self.commits = {}
+        # path -> [(sha, lines added, lines removed), ...], line counts are None
+        # for binary files and renames
+        self.files = {}
+        # new path -> [(old path, sha of the renaming commit), ...]
+        self.renames = {}
+
+    def add_log(self, out):
+        """Add the output of git log with _log_format and --numstat"""
+        for record in out.split('\x1e'):
+            if not record:
+                continue
+            sha, ct, author, body, changes = record.split('\x1f', 4)
+            self.commits[sha] = (int(ct), author, tuple(commit_signatures(body)))
+            for line in changes.split('\n'):
+                bits = line.split('\t', 2)
+                if len(bits) < 3:
+                    continue
+                old, path = _numstat_paths(bits[2])
+                if old is not None:
+                    self.renames.setdefault(path, []).append((old, sha))
+                    added = removed = None
+                elif bits[0] == '-':
+                    added = removed = None
+                else:
+                    added, removed = int(bits[0]), int(bits[1])
+                self.files.setdefault(path, []).append((sha, added, removed))
+
+    @staticmethod
+    def merged(histories, since):
+        """Single history with the commits of all the histories since the cut off"""
+        res = _History()
+        for history in histories:
+            for sha, commit in history.commits.items():
+                if commit[0] >= since:
+                    res.commits[sha] = commit
+            for path, changes in history.files.items():
+                kept = [change for change in changes if change[0] in res.commits]
+                if kept:
+                    res.files.setdefault(path, []).extend(kept)
+            for path, renames in history.renames.items():
+                kept = [ren for ren in renames if ren[1] in res.commits]
+                if kept:
+                    res.renames.setdefault(path, []).extend(kept)
+        return res
+
+
+class AuthorshipStore:
+    """Authors and signers of commits touching each file
+
+    Serves the data get_maintainer.pl's git fallback collects with
+    git log --follow --since --numstat for each file, without walking
+    the history for every file of every patch. History of the upstream
+    branch is indexed up to the merge base of the worktree's HEAD and
+    the branch, and extended incrementally as the branch advances.
+    The commits between the merge base and HEAD (the series under test)
+    are indexed on the fly for each query and not stored.
+
+    The index is a chain of immutable segments, one per update, queries work
+    on a snapshot of the chain so they never wait for an update of the index
+    unless they need it. While the index is being updated queries whose base
+    is ahead of the indexed history index the commits in between on the fly.
+    Each segment is pickled into its own file in the repo's git directory,
+    so the index is shared by all the worktrees, survives restarts, and
+    an update only writes the new commits. Segments get merged (and old
+    commits dropped) once there are more than max_segments of them.
+
+    Attributes
+    ----------
+    since_days : int
+        length of history considered, in days (get_maintainer's --git-since)
+    """
+    max_segments = 16
+
+    def __init__(self, path, since_days=365):
+        self.path = path
+        self.since_days = since_days
+        # Indexed tip and the segments of history up to it, replaced
+        # (never modified) under _lock
+        self._snapshot = (None, ())
+        self._fix_signers = {}
+        self._lock = threading.Lock()
+        # Held while running git log to update the index
+        self._update_lock = threading.Lock()
+
+        self._load()
+
+    @staticmethod
+    def _read_segment(path):
+        try:
+            with open(path, 'rb') as fp:
+                return pickle.load(fp)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError):
+            return None
+
+    def _load(self):
+        try:
+            names = sorted(name for name in os.listdir(self.path) if name.endswith('.pickle'))
+        except OSError:
+            return
+
+        segments = {}
+        for name in names:
+            segment = self._read_segment(os.path.join(self.path, name))
+            if segment:
+                segments[name] = segment
+
+        # Chain starts at the latest full index, names sort by creation time
+        roots = [name for name, segment in segments.items() if segment[0] is None]
+        if not roots:
+            return
+        tip = segments[roots[-1]][1]
+        chain = [segments[roots[-1]][2]]
+        for name in names:
+            if name > roots[-1] and name in segments and segments[name][0] == tip:
+                tip = segments[name][1]
+                chain.append(segments[name][2])
+        self._snapshot = (tip, tuple(chain))
+
+    def _write_segment(self, prev, tip, history):
+        os.makedirs(self.path, exist_ok=True)
+        name = f"{time.time_ns():020d}-{tip[:12]}.pickle"
+        tmp_fd, tmp = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(tmp_fd, 'wb') as fp:
+            pickle.dump((prev, tip, history), fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, os.path.join(self.path, name))
+
+        if prev is None:
+            # Full index, everything written before is superseded
+            for old in os.listdir(self.path):
+                if old < name:
+                    try:
+                        os.unlink(os.path.join(self.path, old))
+                    except OSError:
+                        pass
+
+    def _since(self):
+        return int(time.time()) - self.since_days * 24 * 60 * 60
+
+    def _log(self, tree, rev_args):
+        return _git(tree, ['log', '--no-merges', '--no-color', '-M', '--numstat',
+                           _log_format] + rev_args)
+
+    @staticmethod
+    def _is_ancestor(tree, commit, base):
+        try:
+            _git(tree, ['merge-base', '--is-ancestor', commit, base])
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def _update(self, tree, base):
+        """Index the history up to base, called with the _update_lock held"""
+        tip, segments = self._snapshot
+        if base == tip:
+            return
+
+        incremental = tip is not None and self._is_ancestor(tree, tip, base)
+
+        start = time.monotonic()
+        history = _History()
+        if incremental:
+            history.add_log(self._log(tree, [f'{tip}..{base}']))
+            segments += (history,)
+            prev = tip
+        else:
+            # Some slack, so that the index does not have to be rebuilt as time passes
+            history.add_log(self._log(tree, [f'--since={self.since_days + 30}.days.ago', base]))
+            segments = (history,)
+            prev = None
+
+        kind = 'Incremental' if incremental else 'Full'
+        if len(segments) > self.max_segments:
+            history = _History.merged(segments, self._since() - 30 * 24 * 60 * 60)
+            segments = (history,)
+            prev = None
+            kind += ' (merged)'
+
+        self._write_segment(prev, base, history)
+        with self._lock:
+            self._snapshot = (base, segments)
+
+        core.log(f"Authorship index at {base}, {len(segments)} segments",
+                 f"{kind} update took {time.monotonic() - start:.1f}s")
+
+    def query(self, tree):
+        """Bring the index up to date with the tree's HEAD, returns a query object"""
+        base = None
+        if tree.branch:
+            try:
+                base = _git(tree, ['merge-base', 'HEAD', tree.branch]).strip()
+            except subprocess.CalledProcessError:
+                pass
+        if not base:
+            base = _git(tree, ['rev-parse', 'HEAD']).strip()
+
+        with self._lock:
+            tip, segments = self._snapshot
+        if tip != base:
+            # Don't wait for somebody else's update if we can index the commits
+            # since the indexed tip ourselves
+            ahead = tip is not None and self._is_ancestor(tree, tip, base)
+            if self._update_lock.acquire(blocking=not ahead):
+                try:
+                    self._update(tree, base)
+                finally:
+                    self._update_lock.release()
+                with self._lock:
+                    tip, segments = self._snapshot
+                if tip != base:
+                    # Moved on by another worktree in the meantime
+                    ahead = self._is_ancestor(tree, tip, base)
+            if not ahead:
+                tip = base
+
+        local = _History()
+        local.add_log(self._log(tree, [f'{tip}..HEAD']))
+        return AuthorshipQuery((local,) + segments, self._since())
+
+    def fix_signers(self, tree, commit):
+        """Signatures of a commit referred to by a Fixes tag, [] if unknown"""
+        with self._lock:
+            if commit in self._fix_signers:
+                return self._fix_signers[commit]
+        try:
+            body = _git(tree, ['log', '-1', '--format=%b', commit])
+            signers = commit_signatures(body)
+        except subprocess.CalledProcessError:
+            signers = []
+        with self._lock:
+            self._fix_signers[commit] = signers
+        return signers
+
+
+class AuthorshipQuery:
+    """Snapshot of the history as seen from a HEAD"""
+    def __init__(self, histories, since):
+        self.histories = histories
+        self.since = since
+
+    def _commit(self, sha):
+        for history in self.histories:
+            if sha in history.commits:
+                return history.commits[sha]
+        return None
+
+    def file_commits(self, path):
+        """Commits touching path (following renames) since the cut off
+
+        Returns dict of sha -> (commit time, author, signatures), and dict
+        of sha -> (lines added, lines removed) for the commits which changed
+        the file under its current name (as git log --numstat -- path reports).
+        """
+        shas = {}
+        stats = {}
+        todo = [(path, None)]
+        seen = set()
+        while todo:
+            cur, before = todo.pop()
+            if cur in seen:
+                continue
+            seen.add(cur)
+            for history in self.histories:
+                for sha, added, removed in history.files.get(cur, ()):
+                    commit = self._commit(sha)
+                    if commit[0] >= self.since and (before is None or commit[0] <= before):
+                        shas[sha] = commit
+                        if cur == path and added is not None:
+                            stats[sha] = (added, removed)
+                for old, sha in history.renames.get(cur, ()):
+                    commit = self._commit(sha)
+                    todo.append((old, commit[0]))
+        return shas, stats
+
+    def file_signoffs(self, path):
+        """Returns number of commits, list of signatures, list of authors,
+        and list of (author, lines added, lines removed) for each commit,
+        or None if line counts are not known for all of them"""
+        commits, stats = self.file_commits(path)
+        signers = []
+        authors = []
+        lines = []
+        for sha, (_, author, signatures) in commits.items():
+            authors.append(author)
+            signers += signatures
+            if sha in stats:
+                lines.append((author, *stats[sha]))
+        if len(lines) != len(commits):
+            lines = None
+        return len(commits), signers, authors, lines
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def authorship_store(tree):
+    """Get the store for the tree's repo and branch"""
+    name = re.sub(r'[^\w.-]', '_', tree.branch or 'HEAD')
+    path = os.path.join(tree.state_dir(), f'authorship-{name}')
+
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = AuthorshipStore(path)
+        return _stores[path]
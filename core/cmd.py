@@ -6,7 +6,9 @@
 
 import datetime
 import os
+import selectors
 import subprocess
+import time
 from typing import List
 
 import core
@@ -35,7 +37,75 @@ class CmdError(Exception):
         self.stderr = stderr
 
 
-def cmd_run(cmd: List[str], shell=False, include_stderr=False, add_env=None, cwd=None, pass_fds=()):
+# Amount of output kept in memory when command output is spilled to files
+SPILL_TAIL = 64 * 1024
+
+
+def _communicate(process, spill_dir=None):
+    """Read all output of the process and reap it, collecting its resource usage.
+
+    Unlike Popen.communicate() the process is reaped with wait4() so that
+    the resource usage of the whole (waited-for) process tree is known.
+
+    If spill_dir is set the output is written to "stdout" and "stderr" files
+    in that directory as it arrives, and only the last SPILL_TAIL bytes
+    of each stream are returned.
+    """
+    names = {process.stdout: "stdout", process.stderr: "stderr"}
+    outputs = {process.stdout: bytearray(), process.stderr: bytearray()}
+    sizes = {"stdout": 0, "stderr": 0}
+    files = {}
+
+    try:
+        if spill_dir:
+            for fp, name in names.items():
+                files[fp] = open(os.path.join(spill_dir, name), "wb")
+
+        with selectors.DefaultSelector() as sel:
+            for fp in outputs:
+                sel.register(fp, selectors.EVENT_READ)
+            while sel.get_map():
+                for key, _ in sel.select():
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        continue
+                    sizes[names[key.fileobj]] += len(data)
+                    buf = outputs[key.fileobj]
+                    buf += data
+                    if spill_dir:
+                        files[key.fileobj].write(data)
+                        # Trim only once in a while to avoid constant copying
+                        if len(buf) > 2 * SPILL_TAIL:
+                            del buf[:-SPILL_TAIL]
+    finally:
+        for fp in files.values():
+            fp.close()
+
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if spill_dir:
+        for name, size in sizes.items():
+            if not size:
+                os.unlink(os.path.join(spill_dir, name))
+        for buf in outputs.values():
+            del buf[:-SPILL_TAIL]
+
+    return bytes(outputs[process.stdout]), bytes(outputs[process.stderr]), rusage, sizes
+
+
+def rusage_metrics(rusage):
+    """Convert the interesting fields of struct rusage to a dict"""
+    return {"utime": round(rusage.ru_utime, 3),
+            "stime": round(rusage.ru_stime, 3),
+            "maxrss_kb": rusage.ru_maxrss,
+            "inblock": rusage.ru_inblock,
+            "oublock": rusage.ru_oublock}
+
+
+def cmd_run(cmd: List[str], shell=False, include_stderr=False, add_env=None, cwd=None, pass_fds=(),
+            metrics=None, spill_dir=None):
     """Run a command.
 
     Run a command in subprocess and return the stdout;
@@ -55,6 +125,12 @@ def cmd_run(cmd: List[str], shell=False, include_stderr=False, add_env=None, cwd
         directory to run the command in
     pass_fds : iterable, optional
         pass extra file descriptors to the command
+    metrics : dict, optional
+        filled with wall time and resource usage of the command
+    spill_dir : str, optional
+        stream the output into "stdout" and "stderr" files in this directory
+        (empty ones are removed), only the tail of the output is returned
+        and logged
 
     Raises
     ------
@@ -72,13 +148,17 @@ def cmd_run(cmd: List[str], shell=False, include_stderr=False, add_env=None, cwd
         env.update(add_env)
 
     core.log("START", datetime.datetime.now().isoformat())
+    start = time.monotonic()
 
     process = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                                env=env, cwd=cwd, pass_fds=pass_fds)
 
     core.log_open_sec("CMD " + str(process.args))
 
-    stdout, stderr = process.communicate()
+    stdout, stderr, rusage, sizes = _communicate(process, spill_dir)
+    if metrics is not None:
+        metrics["wall"] = round(time.monotonic() - start, 3)
+        metrics.update(rusage_metrics(rusage))
     stdout = stdout.decode("utf-8", "ignore")
     stderr = stderr.decode("utf-8", "ignore")
     process.stdout.close()
@@ -89,8 +169,12 @@ def cmd_run(cmd: List[str], shell=False, include_stderr=False, add_env=None, cwd
         stderr = stderr[:-1]
 
     core.log("RETCODE", process.returncode)
-    core.log("STDOUT", stdout)
-    core.log("STDERR", stderr)
+    if spill_dir:
+        for name in ("stdout", "stderr"):
+            core.log(name.upper(), f"{sizes[name]} bytes in {os.path.join(spill_dir, name)}")
+    else:
+        core.log("STDOUT", stdout)
+        core.log("STDERR", stderr)
     core.log("END", datetime.datetime.now().isoformat())
     core.log_end_sec()
 
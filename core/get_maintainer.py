@@ -0,0 +1,253 @@
+# SPDX-License-Identifier: GPL-2.0
+
+""" Native version of the kernel's scripts/get_maintainer.pl for patches """
+
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+import threading
+
+from .authorship import Mailmap, authorship_store
+from .maintainers import Maintainers
+
+# get_maintainer.pl drops the chief penguin from the output and ignores
+# his signatures in the git history (unless --git-chief-penguins)
+_penguin_chief_email = 'torvalds@linux-foundation.org'
+_penguin_chief = re.compile(r'Linus Torvalds|torvalds@linux-foundation\.org', re.IGNORECASE)
+
+_maintainer_roles = {
+    'supported': 'supporter',
+    'maintained': 'maintainer',
+    'odd fixes': 'odd fixer',
+    'orphan': 'orphan minder',
+    'obsolete': 'obsolete minder',
+    'buried alive in reporters': 'chief penguin',
+}
+
+_cache_lock = threading.Lock()
+_maintainers_cache = {}
+_mailmap_cache = {}
+
+
+def _tree_maintainers(tree):
+    """Parsed MAINTAINERS of the tree, shared by all callers while the file doesn't change"""
+    with open(os.path.join(tree.path, 'MAINTAINERS'), 'rb') as fp:
+        data = fp.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    with _cache_lock:
+        maintainers = _maintainers_cache.get(digest)
+    if maintainers is None:
+        maintainers = Maintainers()
+        maintainers.load_data(data)
+        with _cache_lock:
+            # Only keep a handful, trees of different age may be under test
+            if len(_maintainers_cache) > 4:
+                _maintainers_cache.pop(next(iter(_maintainers_cache)))
+            _maintainers_cache[digest] = maintainers
+    return maintainers
+
+
+def _tree_mailmap(tree):
+    path = os.path.join(tree.path, '.mailmap')
+    try:
+        key = (path, os.path.getmtime(path))
+    except OSError:
+        key = (path, None)
+
+    with _cache_lock:
+        mailmap = _mailmap_cache.get(path)
+        if mailmap is None or mailmap[0] != key:
+            mailmap = (key, Mailmap(path))
+            _mailmap_cache[path] = mailmap
+        return mailmap[1]
+
+
+def _subsystem_name(entry, maxlen=50):
+    name = entry.title
+    if len(name) > maxlen:
+        name = name[:maxlen - 3].rstrip() + "..."
+    return name
+
+
+class GetMaintainer:
+    """Addresses get_maintainer.pl would output for a patch
+
+    Follows ``get_maintainer.pl --git-min-percent N`` with otherwise default
+    options: maintainers, reviewers and lists of sections matching the files
+    (F:/N:/X:) or the contents (K:) of the patch, signers of the commits
+    referred to by Fixes tags (blamed_fixes), and for files without
+    an exactly matching maintained section the frequent signers, authors
+    and authors of added / removed lines from the last year of git history
+    (commit_signer, authored, added_lines, removed_lines).
+
+    Known differences: renames are followed through the renames recorded
+    in the index rather than by git log --follow, and F: directories not
+    ending with '/' match as prefixes (the script checks the file system).
+
+    MAINTAINERS is parsed once per version of the file, git history comes
+    from the incrementally updated authorship store of the repo, so no
+    history walk is needed per patch.
+    """
+    # Defaults are the defaults of get_maintainer.pl
+    def __init__(self, tree, min_percent=5, min_signatures=1, max_maintainers=5):
+        self.tree = tree
+        self.min_percent = min_percent
+        self.min_signatures = min_signatures
+        self.max_maintainers = max_maintainers
+
+    def _push(self, res, name_email, role):
+        match = re.match(r'\s*([^<]*?)\s*<([^>]*)>', name_email)
+        if match:
+            name, addr = match.group(1), match.group(2)
+        else:
+            name, addr = '', name_email.strip()
+        key = addr.lower()
+        if key == _penguin_chief_email:
+            return
+        if key not in res:
+            res[key] = [f"{name} <{addr}>" if name else addr, []]
+        if role not in res[key][1]:
+            res[key][1].append(role)
+
+    def _add_entry(self, emails, lists, entry):
+        subsystem = _subsystem_name(entry)
+        status = entry.status.lower()
+        role = _maintainer_roles.get(status, status or 'unknown')
+        for person in entry.maintainers:
+            self._push(emails, person.name_email, f"{role}:{subsystem}")
+        for person in entry.reviewers:
+            self._push(emails, person.name_email, f"reviewer:{subsystem}")
+
+        list_role = '' if entry.title == 'THE REST' else ':' + subsystem
+        for line in entry.lists:
+            bits = line.split(None, 1)
+            address = bits[0]
+            additional = bits[1] if len(bits) > 1 else ''
+            if 'subscribers-only' in additional:
+                continue
+            if 'moderated' in additional:
+                self._push(lists, address, 'moderated list' + list_role)
+            else:
+                self._push(lists, address, 'open list' + list_role)
+
+    def _assign(self, res, mailmap, role, divisor, lines):
+        counts = {}
+        for line in sorted(mailmap.map(line) for line in lines):
+            counts[line] = counts.get(line, 0) + 1
+        self._assign_counts(res, role, divisor, counts)
+
+    def _assign_lines(self, res, mailmap, lines):
+        """added_lines / removed_lines roles, lines is a list of (author, added, removed)"""
+        added = {}
+        removed = {}
+        for author, n_added, n_removed in lines:
+            author = mailmap.map(author)
+            added[author] = added.get(author, 0) + n_added
+            removed[author] = removed.get(author, 0) + n_removed
+        for role, counts in (("added_lines", added), ("removed_lines", removed)):
+            counts = {author: counts[author] for author in sorted(counts) if counts[author]}
+            self._assign_counts(res, role, sum(counts.values()), counts)
+
+    def _assign_counts(self, res, role, divisor, counts):
+        if not counts:
+            return
+        divisor = max(divisor, 1)
+
+        count = 0
+        for line in sorted(counts, key=lambda x: counts[x], reverse=True):
+            sign_offs = counts[line]
+            percent = min(sign_offs * 100 / divisor, 100)
+            count += 1
+            if sign_offs < self.min_signatures or count > self.max_maintainers or \
+               percent < self.min_percent:
+                break
+            self._push(res, line, f"{role}:{sign_offs}/{divisor}={percent:.0f}%")
+
+    @staticmethod
+    def _is_exact(entry, path):
+        depth = entry.file_match_depth(path)
+        return depth is not None and depth >= path.count('/') and \
+            entry.status.lower() in ('maintained', 'supported') and bool(entry.maintainers)
+
+    def run(self, patch):
+        """Returns list of lines, address followed by roles in brackets"""
+        parsed = patch.parsed
+        maintainers = _tree_maintainers(self.tree)
+        mailmap = _tree_mailmap(self.tree)
+
+        files = []
+        for f in parsed.files:
+            for path in (f.old_path, f.path):
+                if path and path != '/dev/null' and path not in files:
+                    files.append(path)
+
+        sections = []
+        git_files = []
+        for path in files:
+            entries = maintainers.find_by_path(path)
+            sections += [e for e in entries if e not in sections]
+            if path.endswith('MAINTAINERS'):
+                continue
+            if not any(self._is_exact(e, path) for e in entries):
+                git_files.append(path)
+
+        keyword_text = [line[1:] for line in patch.raw_patch.split('\n')
+                        if line[:1] in ('+', '-')]
+        for entry in maintainers.entries:
+            if entry.keywords and entry not in sections and \
+               any(entry.match_keywords(line) for line in keyword_text):
+                sections.append(entry)
+
+        emails = {}
+        lists = {}
+        for entry in sections:
+            self._add_entry(emails, lists, entry)
+
+        store = authorship_store(self.tree)
+        for commit in dict.fromkeys(parsed.fixes_commits):
+            signers = store.fix_signers(self.tree, commit)
+            signers = [s for s in signers if not _penguin_chief.search(s)]
+            self._assign(emails, mailmap, "blamed_fixes", 1, signers)
+
+        if git_files:
+            query = store.query(self.tree)
+            for path in git_files:
+                commits, signers, authors, lines = query.file_signoffs(path)
+                signers = [s for s in signers if not _penguin_chief.search(s)]
+                self._assign(emails, mailmap, "commit_signer", commits, signers)
+                self._assign(emails, mailmap, "authored", commits, authors)
+                if lines:
+                    self._assign_lines(emails, mailmap, lines)
+
+        return [f"{addr} ({','.join(roles)})" for addr, roles in
+                list(emails.values()) + list(lists.values())]
+
+
+def get_maintainer_script(tree, patch, min_percent):
+    """Output lines of the tree's scripts/get_maintainer.pl for the patch"""
+    with tempfile.NamedTemporaryFile() as fp:
+        patch.write_out(fp)
+        command = ['./scripts/get_maintainer.pl', '--git-min-percent', str(min_percent),
+                   '--', fp.name]
+        res = subprocess.run(command, cwd=tree.path, stdout=subprocess.PIPE, check=True)
+    lines = res.stdout.decode('utf8', 'replace').split('\n')
+    return [line.strip() for line in lines if line.strip()]
+
+
+engines = ('script', 'native')
+
+
+def get_maintainer(tree, patch, engine, min_percent):
+    """Output lines of get_maintainer for the patch
+
+    engine is either 'script' (the tree's scripts/get_maintainer.pl) or
+    'native' (GetMaintainer).
+    """
+    if engine == 'script':
+        return get_maintainer_script(tree, patch, min_percent)
+    if engine == 'native':
+        return GetMaintainer(tree, min_percent=min_percent).run(patch)
+    raise ValueError(f"Unknown get_maintainer engine {engine}")
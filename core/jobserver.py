@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: GPL-2.0
+
+""" GNU make jobserver shared by all the tests run by this process """
+
+import os
+import select
+import threading
+
+import core
+
+
+class _JobPipe:
+    """Pipe holding the job tokens, and the number of commands using it"""
+    def __init__(self, slots):
+        self.slots = slots
+        self.users = 0
+        self._rfd, self._wfd = os.pipe()
+        # Each make gets one implicit job slot, so the pipe holds one less
+        os.write(self._wfd, b'+' * (slots - 1))
+
+    @property
+    def fds(self):
+        return [self._rfd, self._wfd]
+
+    def makeflags(self):
+        return f" -j{self.slots} --jobserver-auth={self._rfd},{self._wfd}"
+
+    def refill(self):
+        """Put back the full set of tokens, must only be called when no command uses the pipe
+
+        Returns the number of tokens which were missing.
+        """
+        # Don't make the fd non-blocking, the flag is shared with the makes
+        tokens = 0
+        while select.select([self._rfd], [], [], 0)[0]:
+            tokens += len(os.read(self._rfd, 4096))
+        os.write(self._wfd, b'+' * (self.slots - 1))
+        return self.slots - 1 - tokens
+
+    def close(self):
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+
+class JobServer:
+    """GNU make jobserver
+
+    Holds a pipe pre-loaded with job tokens. Every make invoked with
+    the MAKEFLAGS of the pipe returned by get() (and the pipe fds passed down)
+    has to take a token from the pipe before starting a job in addition
+    to its first one, so all the builds running in parallel, across trees
+    and lanes, share the same budget instead of each one using -j $ncpu.
+
+    The anonymous pipe form of --jobserver-auth is used, rather than
+    a named FIFO, as it is understood by all versions of make since 4.2.
+
+    A make which gets killed doesn't return the tokens of the jobs it had
+    running, and there is no way to tell how many it had. When a command
+    dies of a signal the pipe is retired, commands started afterwards get
+    a new, full one; the retired pipe is closed once the commands still
+    using it are done. Whenever no command uses the current pipe its tokens
+    are topped up, in case some were lost in a way we could not see
+    (e.g. a make killed in a test which exited normally).
+
+    Attributes
+    ----------
+    slots : int
+        Number of jobs which may run at once (make's "-j").
+    """
+    def __init__(self, slots):
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._pipe = _JobPipe(slots)
+
+    def get(self):
+        """Get the pipe for a command, has to be returned with put() once it exits"""
+        with self._lock:
+            self._pipe.users += 1
+            return self._pipe
+
+    def put(self, pipe, retcode):
+        """Return the pipe after the command exited with retcode"""
+        with self._lock:
+            pipe.users -= 1
+            # Shells report children killed by a signal as 128 + signal number
+            if pipe is self._pipe and (retcode < 0 or retcode >= 128):
+                core.log(f"Command exited with {retcode}, job tokens may be lost, replacing the jobserver pipe")
+                self._pipe = _JobPipe(self.slots)
+            if pipe.users:
+                return
+            if pipe is not self._pipe:
+                pipe.close()
+            else:
+                lost = pipe.refill()
+                if lost:
+                    core.log(f"Jobserver refilled with {lost} lost tokens")
+
+
+_jobserver = None
+_jobserver_lock = threading.Lock()
+
+
+def jobserver_get(slots):
+    """Get the process-wide jobserver, create it on first use"""
+    global _jobserver
+
+    with _jobserver_lock:
+        if _jobserver is None:
+            _jobserver = JobServer(slots)
+            core.log(f"Jobserver created with {slots} slots")
+        elif _jobserver.slots != slots:
+            core.log(f"Jobserver already exists with {_jobserver.slots} slots, ignoring request for {slots}")
+        return _jobserver
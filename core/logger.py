@@ -12,9 +12,12 @@ at the start and destroyed at the end of the run.
 
 import atexit
 import datetime
+import json
 import lzma
 import os
 import pprint
+import queue
+import sys
 import threading
 from xml.sax.saxutils import escape as xml_escape
 
@@ -22,6 +25,108 @@ from xml.sax.saxutils import escape as xml_escape
 tls = threading.local()
 
 
+def _compress_log(path, name):
+    with open(path, "rb") as f:
+        with lzma.open(name, "w") as zf:
+            data = f.read(1 << 20)
+            while data:
+                zf.write(data)
+                data = f.read(1 << 20)
+
+
+def _rotate_file(path):
+    """Move the log aside and compress it in the background"""
+    name = path + '-' + datetime.datetime.now().isoformat()
+    os.rename(path, name)
+
+    def compress():
+        _compress_log(name, name + '.xz')
+        os.unlink(name)
+
+    # Not a daemon, let compression finish on exit
+    threading.Thread(target=compress, name="log-compress", daemon=False).start()
+
+
+class AsyncLogFile:
+    """Log file written by a background thread
+
+    Stands in for the file object of a Logger. Writes are queued and
+    written out in batches by a writer thread, so the logging thread does
+    not wait for the disk. The queue is bounded, when the writer falls
+    behind the loggers block until there is space again.
+
+    Attributes
+    ----------
+    size : int
+        Number of characters written since the file was (re)opened.
+    """
+    _ROTATE = object()
+    _CLOSE = object()
+
+    def __init__(self, path, depth=4096):
+        self.size = 0
+        self._path = path
+        self._closed = False
+        self._file = open(path, "w+")
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._writer, daemon=True,
+                                        name="log-writer-" + os.path.basename(path))
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, data):
+        self.size += len(data)
+        self._queue.put(data)
+
+    def flush(self):
+        # Writer flushes whenever it runs out of work
+        pass
+
+    def rotate(self):
+        """Move the current contents aside, they get compressed in the background"""
+        self.size = 0
+        self._queue.put(self._ROTATE)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._CLOSE)
+        self._thread.join()
+
+    def _rotate(self):
+        self._file.close()
+        _rotate_file(self._path)
+        self._file = open(self._path, "w+")
+
+    def _writer(self):
+        while True:
+            batch = []
+            item = self._queue.get()
+            while True:
+                if item is self._ROTATE or item is self._CLOSE:
+                    break
+                batch.append(item)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+                    break
+
+            try:
+                if batch:
+                    self._file.write("".join(batch))
+                if item is self._ROTATE:
+                    self._rotate()
+                self._file.flush()
+            except OSError as e:
+                print("Log writer failed:", e, file=sys.stderr)
+
+            if item is self._CLOSE:
+                self._file.close()
+                return
+
+
 class Logger:
     """Logger base class
 
@@ -44,16 +149,19 @@ class Logger:
     log_data()
         Create a new log file section with given header and contents.
     """
-    def __init__(self, path=None):
+    def __init__(self, path=None, async_write=False):
         self.printer = pprint.PrettyPrinter()
         self._path = path
         self._level = 0
+        self._async = async_write
 
         self._log_open_init()
         self._log_open()
 
     def fini(self):
         self._log_close()
+        if self._async:
+            self._log_file.close()
 
     def open_sec(self, header):
         self._level += 1
@@ -79,31 +187,33 @@ class Logger:
         self._log_flush()
 
     def _rotate_log(self):
-        # copy the data in to a compressed file now
-        name = self._path + '-' + datetime.datetime.now().isoformat() + '.xz'
+        _rotate_file(self._path)
 
-        with open(self._path, "rb") as f:
-            with lzma.open(name, "w") as zf:
-                data = f.read()
-                while data:
-                    zf.write(data)
-                    data = f.read()
+    def _log_size(self):
+        if self._async:
+            return self._log_file.size
+        return os.stat(self._path).st_size
 
     def _maybe_close(self):
         if self._level:
             return
-        if os.stat(self._path).st_size < 4 * 1000 * 1000:
+        if self._log_size() < 4 * 1000 * 1000:
             return
 
         # close the old log off
         self._log_close()
+        if self._async:
+            self._log_file.rotate()
+            self._log_open()
+            return
+
         self._log_flush()
         self._log_file.close()
         self._log_file = None
 
         self._rotate_log()
 
-        # truncate the main log by re-opening
+        # start the main log afresh
         self._log_file = open(self._path, "w+")
         self._log_open()
 
@@ -111,7 +221,10 @@ class Logger:
         if os.path.isfile(self._path) and os.path.getsize(self._path) > 0:
             self._rotate_log()
 
-        self._log_file = open(self._path, "w+")
+        if self._async:
+            self._log_file = AsyncLogFile(self._path)
+        else:
+            self._log_file = open(self._path, "w+")
 
     def _log_open(self):
         pass
@@ -207,7 +320,55 @@ class OrgLogger(Logger):
             self._nl = data[:-1] == "\n"
 
 
-def log_init(name, path, force_single_thread=False):
+class JsonlLogger(Logger):
+    """Structured log, one JSON record per line
+
+    Records are {"ts": ..., "ev": "sec"|"end"|"data", "d": ...}, they can be
+    turned into the other formats with log_render().
+    """
+    def _record(self, ev, data=None):
+        rec = {"ts": datetime.datetime.now().isoformat(), "ev": ev}
+        if data is not None:
+            rec["d"] = data
+        self._log_file.write(json.dumps(rec) + "\n")
+
+    def _sec_start(self, header):
+        self._record("sec", header)
+
+    def _sec_end(self):
+        self._record("end")
+
+    def _log_data(self, data):
+        self._record("data", data)
+
+
+_loggers = {
+    "org": OrgLogger,
+    "xml": XmlLogger,
+    "jsonl": JsonlLogger,
+}
+
+
+def log_render(src, name, path):
+    """Render a JSONL log (possibly xz-compressed) as a log of another type"""
+    logger = _loggers[name.lower()](path)
+
+    opener = lzma.open if src.endswith('.xz') else open
+    with opener(src, "rt") as fp:
+        for line in fp:
+            rec = json.loads(line)
+            if rec["ev"] == "sec":
+                logger.open_sec(rec["d"])
+            elif rec["ev"] == "end":
+                # Not end_sec(), the rendered log must not get rotated
+                logger._sec_end()
+                logger._level -= 1
+            elif rec["ev"] == "data":
+                logger._log_data(logger._escape(rec["d"]))
+    logger.fini()
+
+
+def log_init(name, path, force_single_thread=False, async_write=False):
     global tls
 
     if force_single_thread:
@@ -215,10 +376,8 @@ def log_init(name, path, force_single_thread=False):
 
     if name.lower() == 'stdout':
         tls.logger = StdoutLogger()
-    elif name.lower() == "org":
-        tls.logger = OrgLogger(path)
-    elif name.lower() == "xml":
-        tls.logger = XmlLogger(path)
+    elif name.lower() in _loggers:
+        tls.logger = _loggers[name.lower()](path, async_write=async_write)
     else:
         raise Exception("Logger type unknown", name)
 
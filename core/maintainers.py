@@ -1,6 +1,12 @@
 # SPDX-License-Identifier: GPL-2.0
 
-import fnmatch
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import time
+
 import requests
 
 
@@ -43,14 +49,25 @@ class Person:
 
 
 class Maintainers:
+    """Parsed MAINTAINERS file
+
+    With a cache_dir configured (``[maintainers] cache_dir``) the parsed
+    and indexed entries are pickled to disk keyed by the hash of the file's
+    contents, so reloading an unchanged file skips parsing altogether.
+    """
+    # Bump when the format of the parsed entries changes
+    _cache_version = 3
+
     def __init__(self, *, file=None, url=None, config=None):
         self.entries = MaintainersList()
 
         self.http_headers = None
+        self.cache_dir = None
         if config:
             ua = config.get('patchwork', 'user-agent', fallback='')
             if ua:
                 self.http_headers = {"user-agent":ua}
+            self.cache_dir = config.get('maintainers', 'cache_dir', fallback=None)
 
         if file:
             self._load_from_file(file)
@@ -83,14 +100,53 @@ class Maintainers:
                 print("Bad group:", group, line.strip())
                 group = [line.strip()]
 
+    def _cache_path(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        return os.path.join(self.cache_dir, f"maintainers-v{self._cache_version}-{digest}.pickle")
+
+    def load_data(self, data):
+        cache_path = None
+        if self.cache_dir:
+            cache_path = self._cache_path(data)
+            try:
+                with open(cache_path, 'rb') as fp:
+                    self.entries = pickle.load(fp)
+                os.utime(cache_path)
+                return
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+                pass
+
+        self._load_from_lines(data.decode('utf-8').split('\n'))
+        self.entries.build_index()
+
+        if cache_path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(tmp_fd, 'wb') as fp:
+                pickle.dump(self.entries, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_path)
+            self._cache_prune(cache_path)
+
+    def _cache_prune(self, keep, max_age=7 * 24 * 60 * 60):
+        """Remove cached versions of MAINTAINERS which were not used recently"""
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not name.startswith('maintainers-') or path == keep:
+                continue
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.unlink(path)
+            except OSError:
+                pass
+
     def _load_from_file(self, file):
-        with open(file, 'r') as f:
-            self._load_from_lines(f.read().split('\n'))
+        with open(file, 'rb') as f:
+            self.load_data(f.read())
 
     def _load_from_url(self, url):
         r = requests.get(url, headers=self.http_headers)
-        data = r.content.decode('utf-8')
-        self._load_from_lines(data.split('\n'))
+        self.load_data(r.content)
 
     def find_by_path(self, path):
         return self.entries.find_by_paths([path])
@@ -102,35 +158,122 @@ class Maintainers:
         return self.entries.find_by_owner(person)
 
 
+def _is_glob(pattern):
+    return '?' in pattern or '*' in pattern or '[' in pattern
+
+
+def _glob_literal_prefix(pattern):
+    """Part of the glob before its first wildcard, all paths it matches start with it"""
+    for i, c in enumerate(pattern):
+        if c in '?*[':
+            return pattern[:i]
+    return pattern
+
+
+def _glob_compile(pattern):
+    """Compile an F:/X: glob the way get_maintainer.pl matches it, as a prefix
+    of the path and, unless the glob is a directory, at the same depth"""
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        end = pattern.find(']', i + 2) if c == '[' else -1
+        if c == '*':
+            regex += '.*'
+        elif c == '?':
+            regex += '.'
+        elif end != -1:
+            cls = pattern[i + 1:end]
+            if cls.startswith('!'):
+                cls = '^' + cls[1:]
+            regex += '[' + cls.replace('\\', '\\\\') + ']'
+            i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    depth = None if pattern.endswith('/') else pattern.count('/')
+    return re.compile(regex), depth
+
+
+def _glob_match(glob, path):
+    _, regex, depth = glob
+    return regex.match(path) is not None and (depth is None or path.count('/') == depth)
+
+
+def _pattern_depth(pattern):
+    """Depth of an F: pattern as used by get_maintainer.pl to tell if a file
+    is matched "exactly" (pattern for its directory or deeper)"""
+    if pattern.startswith('*'):
+        return -1
+    depth = pattern.count('/')
+    if not pattern.endswith('/'):
+        depth += 1
+    return depth
+
+
 class MaintainersEntry:
     def __init__(self, lines):
         self._raw = lines
 
         self.title = lines[0]
+        self.status = ''
         self.maintainers = []
         self.reviewers = []
+        self.lists = []
         self.files = []
+        self.excludes = []
+        self.regexes = []
+        self.keywords = []
 
         for line in lines[1:]:
             if line[:3] == 'M:\t':
                 self.maintainers.append(Person(line[3:]))
             elif line[:3] == 'R:\t':
                 self.reviewers.append(Person(line[3:]))
+            elif line[:3] == 'L:\t':
+                self.lists.append(line[3:])
+            elif line[:3] == 'S:\t':
+                self.status = line[3:]
             elif line[:3] == 'F:\t':
                 self.files.append(line[3:])
+            elif line[:3] == 'X:\t':
+                self.excludes.append(line[3:])
+            elif line[:3] == 'N:\t':
+                self.regexes.append(line[3:])
+            elif line[:3] == 'K:\t':
+                self.keywords.append(line[3:])
 
         self._owners = self.maintainers + self.reviewers
 
-        self._file_match = []
-        self._file_pfx = []
-        for F in self.files:
-            # Strip trailing wildcard, it's implicit and slows down the match
-            if F.endswith('*'):
-                F = F[:-1]
-            if '?' in F or '*' in F or '[' in F:
-                self._file_match.append(F)
+        self._file_match, self._file_pfx = self._split_patterns(self.files)
+        self._file_depth = {F: _pattern_depth(F) for F in self.files}
+        self._excl_match, self._excl_pfx = self._split_patterns(self.excludes)
+        self._name_match = self._compile_regexes(self.regexes)
+        self._keyword_match = self._compile_regexes(self.keywords)
+
+    def _compile_regexes(self, regexes):
+        # get_maintainer.pl applies N: and K: with the /x modifier
+        ret = []
+        for R in regexes:
+            try:
+                ret.append(re.compile(R, re.VERBOSE))
+            except re.error:
+                print("Bad regex:", self.title, R)
+        return ret
+
+    @staticmethod
+    def _split_patterns(patterns):
+        """Split F:/X: patterns into compiled globs and plain prefixes"""
+        match = []
+        pfx = []
+        for F in patterns:
+            # Note that a trailing wildcard is not implicit, "dir/*" only
+            # matches files directly in dir, not in its subdirectories
+            if _is_glob(F):
+                match.append((F, *_glob_compile(F)))
             else:
-                self._file_pfx.append(F)
+                pfx.append(F)
+        return match, pfx
 
     def __repr__(self):
         return f"MaintainersEntry('{self.title}')"
@@ -141,41 +284,149 @@ class MaintainersEntry:
                 return True
         return False
 
+    def match_excluded(self, path):
+        for X in self._excl_pfx:
+            if path.startswith(X):
+                return True
+        for X in self._excl_match:
+            if _glob_match(X, path):
+                return True
+        return False
+
     def match_path(self, path):
+        if self.match_excluded(path):
+            return False
         for F in self._file_pfx:
             if path.startswith(F):
                 return True
         for F in self._file_match:
-            if fnmatch.fnmatch(path, F):
+            if _glob_match(F, path):
+                return True
+        for N in self._name_match:
+            if N.search(path):
                 return True
         return False
 
+    def match_keywords(self, text):
+        for K in self._keyword_match:
+            if K.search(text):
+                return True
+        return False
+
+    def file_match_depth(self, path):
+        """Depth of the deepest F: pattern matching path, None if none matches"""
+        depths = []
+        for F in self._file_pfx:
+            if path.startswith(F):
+                depths.append(self._file_depth[F])
+        for F in self._file_match:
+            if _glob_match(F, path):
+                depths.append(self._file_depth[F[0]])
+        return max(depths, default=None)
+
+
+class _PathIndex:
+    """Index of the path patterns of a list of entries
+
+    Plain F: prefixes live in a character trie, walking a path down
+    the trie yields all the entries with a prefix of the path. Globs are
+    hung off the trie node of their literal part (the part before the first
+    wildcard) so only globs which can possibly match get evaluated.
+    N: regexes can match anywhere in the path and are always evaluated.
+    X: exclusions are checked only for the candidate entries.
+    """
+    def __init__(self, entries):
+        self._trie = {}
+        self._regexes = []
+        for idx, entry in enumerate(entries):
+            for F in entry._file_pfx:
+                self._node(F).setdefault(None, []).append((idx, None))
+            for glob in entry._file_match:
+                self._node(_glob_literal_prefix(glob[0])).setdefault(None, []).append((idx, glob))
+            for regex in entry._name_match:
+                self._regexes.append((idx, regex))
+
+    def _node(self, pfx):
+        node = self._trie
+        for c in pfx:
+            node = node.setdefault(c, {})
+        return node
+
+    def candidates(self, path):
+        """Returns set of indexes of entries whose F:/N: patterns match path"""
+        found = set()
+        node = self._trie
+        depth = 0
+        while node is not None:
+            for idx, glob in node.get(None, ()):
+                if idx not in found and (glob is None or _glob_match(glob, path)):
+                    found.add(idx)
+            if depth == len(path):
+                break
+            node = node.get(path[depth])
+            depth += 1
+        for idx, regex in self._regexes:
+            if idx not in found and regex.search(path):
+                found.add(idx)
+        return found
+
 
 class MaintainersList:
     def __init__(self):
         self._list = []
+        self._path_index = None
+        self._owner_index = None
 
     def __len__(self):
         return len(self._list)
 
+    def __iter__(self):
+        return iter(self._list)
+
     def __repr__(self):
         return repr(self._list)
 
     def add(self, other):
         self._list.append(other)
-
-    def find_by_paths(self, paths):
+        self._path_index = None
+        self._owner_index = None
+
+    def build_index(self):
+        """Build the lookup indexes up front (they are built on first use otherwise)"""
+        self._get_path_index()
+        self._get_owner_index()
+
+    def _get_path_index(self):
+        if self._path_index is None:
+            self._path_index = _PathIndex(self._list)
+        return self._path_index
+
+    def _get_owner_index(self):
+        if self._owner_index is None:
+            self._owner_index = {}
+            for idx, entry in enumerate(self._list):
+                for M in entry._owners:
+                    self._owner_index.setdefault(M.email, []).append(idx)
+        return self._owner_index
+
+    def _sublist(self, idxs):
         ret = MaintainersList()
-        for entry in self._list:
-            for path in paths:
-                if entry.match_path(path):
-                    ret.add(entry)
-                    break
+        for idx in sorted(idxs):
+            ret.add(self._list[idx])
         return ret
 
+    def find_by_paths(self, paths):
+        index = self._get_path_index()
+        found = set()
+        for path in paths:
+            for idx in index.candidates(path) - found:
+                if not self._list[idx].match_excluded(path):
+                    found.add(idx)
+        return self._sublist(found)
+
     def find_by_owner(self, person):
-        ret = MaintainersList()
-        for entry in self._list:
-            if entry.match_owner(person):
-                ret.add(entry)
-        return ret
+        if isinstance(person, Person):
+            email = person.email
+        else:
+            _, email = Person.name_email_split(person)
+        return self._sublist(self._get_owner_index().get(email, ()))
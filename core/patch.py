@@ -6,11 +6,171 @@
 # TODO: document
 
 import re
-from email import message_from_string
+from email.parser import Parser
 
 import core
 
 
+class PatchFile:
+    """File touched by a patch
+
+    Attributes
+    ----------
+    path : str
+        Path of the file after the patch (before, for deleted files).
+    old_path : str
+        Path of the file before the patch.
+    status : str
+        'A'dded, 'D'eleted, 'R'enamed or 'M'odified.
+    hunks : list of tuples
+        (old start, old length, new start, new length) of each hunk.
+    added, removed : int
+        Number of lines added and removed.
+    """
+    def __init__(self, old_path=None, path=None):
+        self.old_path = old_path
+        self.path = path
+        self.status = 'M'
+        self.hunks = []
+        self.added = 0
+        self.removed = 0
+
+
+class ParsedPatch:
+    """Patch parsed into its parts, see Patch.parsed
+
+    Attributes
+    ----------
+    headers : email.message.Message
+        Email headers of the patch.
+    files : list of PatchFile
+        Files touched by the diff, in order.
+    diffstat : list of tuples
+        (file name, change count) from the diffstat, file names may be
+        abbreviated with '.../' by git.
+    fixes : list of str
+        Values of the Fixes: tags in the commit message.
+    fixes_commits : list of str
+        Commit hashes referred to by well-formed Fixes: tags.
+    signed_off_by : list of str
+        Values of the Signed-off-by: tags in the commit message.
+    """
+    _r_tag = re.compile(r'^(Fixes|Signed-off-by): (.*)$')
+    _r_fixes = re.compile(r'^([a-f0-9]+) \(')
+    _r_diffstat = re.compile(r'^\s*([-\w/._,]+)\s+\|\s+(\d+)\s*[-+]*\s*$')
+    _r_hunk = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+    def __init__(self, raw_patch, headers):
+        self.headers = headers
+        self.files = []
+        self.diffstat = []
+        self.fixes = []
+        self.fixes_commits = []
+        self.signed_off_by = []
+
+        self._parse(raw_patch)
+
+    @staticmethod
+    def _strip_prefix(name, pfx):
+        name = name.split('\t')[0]
+        if name.startswith(pfx):
+            return name[len(pfx):]
+        return name
+
+    def _parse(self, raw_patch):
+        lines = raw_patch.split('\n')
+        i = 0
+        # Skip the email headers
+        while i < len(lines) and lines[i]:
+            i += 1
+
+        # Commit message, up to the "---" separator or the diff itself
+        while i < len(lines):
+            line = lines[i]
+            if line == '---' or line.startswith('diff --git '):
+                break
+            match = self._r_tag.match(line)
+            if match:
+                if match.group(1) == 'Fixes':
+                    self.fixes.append(match.group(2))
+                    commit = self._r_fixes.match(match.group(2))
+                    if commit:
+                        self.fixes_commits.append(commit.group(1))
+                else:
+                    self.signed_off_by.append(match.group(2))
+            i += 1
+
+        # Diffstat, notes, and the diff
+        cur = None
+        old_left = new_left = 0
+        for line in lines[i:]:
+            if old_left > 0 or new_left > 0:
+                if line.startswith('+'):
+                    cur.added += 1
+                    new_left -= 1
+                elif line.startswith('-'):
+                    cur.removed += 1
+                    old_left -= 1
+                elif not line.startswith('\\'):
+                    old_left -= 1
+                    new_left -= 1
+                continue
+
+            if line.startswith('diff --git '):
+                names = line[11:].split(' b/', 1)
+                cur = PatchFile(self._strip_prefix(names[0], 'a/'),
+                                names[1] if len(names) > 1 else None)
+                cur.path = cur.path or cur.old_path
+                self.files.append(cur)
+            elif line.startswith('@@ ') and cur:
+                match = self._r_hunk.match(line)
+                if match:
+                    hunk = tuple(int(x) if x is not None else 1 for x in match.groups())
+                    cur.hunks.append(hunk)
+                    old_left, new_left = hunk[1], hunk[3]
+            elif line.startswith('--- '):
+                # Plain diffs, without the git header
+                if cur is None or cur.hunks:
+                    cur = PatchFile()
+                    self.files.append(cur)
+                if line == '--- /dev/null':
+                    cur.status = 'A'
+                else:
+                    cur.old_path = self._strip_prefix(line[4:], 'a/')
+            elif line.startswith('+++ ') and cur:
+                if line == '+++ /dev/null':
+                    cur.status = 'D'
+                    cur.path = cur.path or cur.old_path
+                else:
+                    cur.path = self._strip_prefix(line[4:], 'b/')
+            elif cur is None:
+                match = self._r_diffstat.match(line)
+                if match:
+                    self.diffstat.append((match.group(1), int(match.group(2))))
+            elif line.startswith('new file mode'):
+                cur.status = 'A'
+            elif line.startswith('deleted file mode'):
+                cur.status = 'D'
+            elif line.startswith('rename from '):
+                cur.status = 'R'
+                cur.old_path = line[12:]
+            elif line.startswith('rename to '):
+                cur.path = line[10:]
+
+    def file_names(self, status=None):
+        """Paths of files touched by the diff, optionally only with given statuses"""
+        return [f.path for f in self.files if status is None or f.status in status]
+
+    def touched_files(self):
+        """All file names mentioned by the patch, diffstat and diff, without duplicates"""
+        names = [name for name, _ in self.diffstat]
+        for f in self.files:
+            names.append(f.path)
+            if f.old_path and f.old_path != f.path:
+                names.append(f.old_path)
+        return list(dict.fromkeys(names))
+
+
 class Patch:
     """Patch class
 
@@ -22,6 +182,8 @@ class Patch:
         The entire patch as a string, including commit message, diff, etc.
     title : str
         The Subject line/first line of the commit message of the patch.
+    parsed : ParsedPatch
+        Headers, tags and diff of the patch, parsed on first use.
 
     Methods
     -------
@@ -40,7 +202,10 @@ class Patch:
         # Whether the patch is first in the series, set by series.add_patch()
         self.first_in_series = None
 
-        msg = message_from_string(raw_patch)
+        self._headers = Parser().parsestr(raw_patch, headersonly=True)
+        self._parsed = None
+
+        msg = self._headers
         self.subject = msg['Subject'] or ""
         if not self.title:
             subj = re.search(r'\[.*\](.*)', self.subject)
@@ -57,6 +222,12 @@ class Patch:
             Patch.PATCH_ID_GEN += 1
             self.id = Patch.PATCH_ID_GEN
 
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = ParsedPatch(self.raw_patch, self._headers)
+        return self._parsed
+
     def write_out(self, fp):
         """ Write patch contents to a file """
         fp.write(self.raw_patch.encode('utf-8'))
@@ -0,0 +1,102 @@
+# SPDX-License-Identifier: GPL-2.0
+
+""" Classification of file paths against tables of path prefixes """
+
+REQUIRED = 'required'
+ACCEPTABLE = 'acceptable'
+EXCLUDED = 'excluded'
+FOREIGN = 'foreign'
+
+_F_REQUIRED = 1
+_F_ACCEPTABLE = 2
+_F_EXCLUDED = 4
+
+
+def _dotted_forms(pfx):
+    """Forms of a prefix which can match an abbreviated ('.../') file name,
+    the prefix with one or more of its leading directories dropped"""
+    dirs = pfx.split('/')
+    while True:
+        dirs.pop(0)
+        dotted = '.../' + '/'.join(dirs)
+        if dotted == '.../':
+            return
+        yield dotted
+
+
+class PathClassifier:
+    """Prefix tables compiled into a character trie
+
+    Each file name is walked down the trie once, collecting the flags
+    of all the prefixes it passes, instead of being compared against
+    every entry of every table.
+
+    File names abbreviated by diffstat (starting with '.../') are looked
+    up in a separate trie of the prefixes with leading directories dropped,
+    so '.../wireless/foo.c' is matched by 'drivers/net/wireless/'.
+
+    A file is classified as excluded if any excluded prefix matches it,
+    otherwise as required or acceptable if prefixes of that table match
+    (required wins), and as foreign if nothing matches.
+    """
+    def __init__(self, required=(), acceptable=(), excluded=()):
+        self._trie = {}
+        self._dotted = {}
+
+        for table, flag in ((required, _F_REQUIRED),
+                            (acceptable, _F_ACCEPTABLE),
+                            (excluded, _F_EXCLUDED)):
+            for pfx in table:
+                self._insert(self._trie, pfx, flag)
+                for dotted in _dotted_forms(pfx):
+                    self._insert(self._dotted, dotted, flag)
+
+    @staticmethod
+    def _insert(trie, pfx, flag):
+        node = trie
+        for c in pfx:
+            node = node.setdefault(c, {})
+        node[None] = node.get(None, 0) | flag
+
+    @staticmethod
+    def _walk(trie, name):
+        flags = 0
+        node = trie
+        for c in name:
+            node = node.get(c)
+            if node is None:
+                break
+            flags |= node.get(None, 0)
+        return flags
+
+    def classify(self, file_name):
+        trie = self._dotted if file_name.startswith('.../') else self._trie
+        flags = self._walk(trie, file_name)
+        if flags & _F_EXCLUDED:
+            return EXCLUDED
+        if flags & _F_REQUIRED:
+            return REQUIRED
+        if flags & _F_ACCEPTABLE:
+            return ACCEPTABLE
+        return FOREIGN
+
+    def classify_all(self, file_names):
+        """Returns dict of class -> list of file names"""
+        res = {REQUIRED: [], ACCEPTABLE: [], EXCLUDED: [], FOREIGN: []}
+        for file_name in file_names:
+            res[self.classify(file_name)].append(file_name)
+        return res
+
+    @staticmethod
+    def local_state(classes):
+        """Tri-state verdict for classify_all() output
+
+        Returns True: files should have been explicitly designated for local tree
+                False: files have nothing to do with local trees
+                None: mixed contents, touches local code, but also code outside
+        """
+        if not classes[REQUIRED]:
+            return False
+        if classes[EXCLUDED] or classes[FOREIGN]:
+            return None
+        return True
@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: GPL-2.0
+
+""" Content-addressed cache of test results """
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import core
+
+
+def dir_hash(*paths):
+    """Hash of all the files under paths, used to detect test definition changes"""
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(os.path.basename(os.path.normpath(path)).encode())
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for name in sorted(files):
+                fpath = os.path.join(root, name)
+                h.update(os.path.relpath(fpath, path).encode())
+                with open(fpath, 'rb') as fp:
+                    h.update(fp.read())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Cache of test result directories
+
+    Results are stored under a key computed from the test name, hash of the
+    test definition (including the shared test libraries), the environment
+    the test is run with, and the trees before and after the patch. The trees
+    are fully determined by the base commit and the contents of the patch
+    stack, so re-posted or re-tested series with identical code hit the cache.
+    The whole result directory of the test is stored and replayed.
+    """
+    # Pruning walks the whole cache, do it at most this often (in seconds),
+    # across all the users of the cache
+    prune_interval = 60 * 60
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(test_name, test_hash, tree, env=None):
+        trees = tree.git(['rev-parse', 'HEAD~^{tree}', 'HEAD^{tree}']).split()
+        data = json.dumps([test_name, test_hash, env or {}] + trees, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def replay(self, key, test_dir):
+        """Copy cached results into test_dir, returns retcode or None on miss"""
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return None
+
+        shutil.copytree(entry, test_dir, dirs_exist_ok=True)
+        with open(os.path.join(test_dir, "retcode"), "r") as fp:
+            retcode = int(fp.read())
+        core.log("Replayed cached result", entry)
+        return retcode
+
+    def store(self, key, test_dir):
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            shutil.copytree(test_dir, tmp, dirs_exist_ok=True)
+            os.rename(tmp, entry)
+            core.log("Stored result in cache", entry)
+        except OSError:
+            # Lost a race with another worker storing the same result
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _prune_due(self):
+        """Claim the next prune, returns False if the cache was pruned recently"""
+        stamp = os.path.join(self.path, '.last_prune')
+        now = time.time()
+        try:
+            if now - os.path.getmtime(stamp) < self.prune_interval:
+                return False
+        except FileNotFoundError:
+            pass
+        with open(stamp, 'a'):
+            pass
+        os.utime(stamp, (now, now))
+        return True
+
+    def prune(self, max_age):
+        """Remove entries older than max_age seconds
+
+        Other users of the cache may be pruning (or storing) at the same time.
+        """
+        if not self._prune_due():
+            return
+
+        cutoff = time.time() - max_age
+        for sub in os.listdir(self.path):
+            sub_path = os.path.join(self.path, sub)
+            if not os.path.isdir(sub_path):
+                continue
+            try:
+                keys = os.listdir(sub_path)
+            except FileNotFoundError:
+                continue
+            for key in keys:
+                entry = os.path.join(sub_path, key)
+                try:
+                    if os.path.getmtime(entry) < cutoff:
+                        shutil.rmtree(entry, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: GPL-2.0
+
+""" Priority scheduling of series waiting for testing """
+
+import heapq
+import itertools
+import re
+import threading
+import time
+
+
+def series_is_rfc(series):
+    subject = series.subject
+    if not subject and series.patches:
+        subject = series.patches[0].subject
+    return bool(re.match(r'\[[^\]]*\bRFC\b', subject or "", re.IGNORECASE))
+
+
+class SchedulerQueue:
+    """Per-tree view of the scheduler, mimics the parts of queue.Queue testers use"""
+    def __init__(self, scheduler, name):
+        self.scheduler = scheduler
+        self.name = name
+
+    def put(self, item):
+        self.scheduler.put(self.name, item)
+
+    def get(self):
+        return self.scheduler.get(self.name)
+
+    def qsize(self):
+        return self.scheduler.qsize(self.name)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def foreign_tree(self, series):
+        """Tree the series was queued for, if it's not the tree of this queue"""
+        name = getattr(series, 'tree_name', None)
+        if name and name != self.name:
+            return self.scheduler.trees[name]
+        return None
+
+
+class Scheduler:
+    """Priority scheduler for series to be tested
+
+    Series are ordered by the time they were queued adjusted by a per-series
+    offset (all weights are expressed in seconds of queueing time):
+     - fixes (series for one of the fix_trees) move ahead by fix_boost,
+     - RFCs are demoted by rfc_penalty,
+     - each patch in the series costs patch_cost.
+    Since all queued series age at the same rate the order never changes
+    once queued, and long waiting series eventually get their turn.
+
+    Testers of sibling trees (configured groups of trees, typically
+    the fixes and the development tree of the same project) can steal work
+    from each other when their own queue is empty. The series is still
+    tested in a worktree of the tree it was queued for.
+
+    Attributes
+    ----------
+    trees : dict
+        the trees, by name, series can be queued for
+    on_get : callable
+        called with each series when a tester takes it off the queue
+    """
+    def __init__(self, config, trees, fix_trees=(), on_get=None):
+        self.trees = trees
+        self.fix_trees = set(fix_trees)
+        self.on_get = on_get
+
+        self.fix_boost = config.getint('scheduler', 'fix_boost', fallback=3600)
+        self.rfc_penalty = config.getint('scheduler', 'rfc_penalty', fallback=4 * 3600)
+        self.patch_cost = config.getint('scheduler', 'patch_cost', fallback=120)
+        # Groups of trees, one group per line, names separated by commas
+        groups = [[t.strip() for t in line.split(',') if t.strip()]
+                  for line in config.get('scheduler', 'siblings', fallback="").split('\n')]
+
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._heaps = {name: [] for name in trees}
+        self._stops = {name: 0 for name in trees}
+        self._stats = {name: {"done": 0, "wait-sum": 0.0, "wait-max": 0.0, "stolen": 0}
+                       for name in trees}
+
+        # Trees we can take work from when idle
+        self._siblings = {name: [] for name in trees}
+        for group in groups:
+            for name in group:
+                if name not in trees:
+                    raise Exception(f"Unknown tree {name} in scheduler siblings")
+                self._siblings[name] += [other for other in group
+                                         if other != name and other not in self._siblings[name]]
+
+    def queue(self, name):
+        return SchedulerQueue(self, name)
+
+    def priority(self, name, series):
+        prio = time.time()
+        if name in self.fix_trees:
+            prio -= self.fix_boost
+        if series_is_rfc(series):
+            prio += self.rfc_penalty
+        prio += self.patch_cost * len(series.patches)
+        return prio
+
+    def put(self, name, series):
+        with self._cond:
+            if series is None:
+                # Ask one tester of the tree to exit
+                self._stops[name] += 1
+            else:
+                entry = (self.priority(name, series), next(self._seq), time.time(), series)
+                heapq.heappush(self._heaps[name], entry)
+            self._cond.notify_all()
+
+    def _pick(self, name):
+        """Returns the owner tree and heap entry of the next series for tree name,
+        entry is None if the tester should exit and False if there is no work"""
+        if self._stops[name]:
+            self._stops[name] -= 1
+            return None, None
+        if self._heaps[name]:
+            return name, heapq.heappop(self._heaps[name])
+
+        best = None
+        for other in self._siblings[name]:
+            heap = self._heaps[other]
+            if heap and (best is None or heap[0] < self._heaps[best][0]):
+                best = other
+        if best is not None:
+            self._stats[best]["stolen"] += 1
+            return best, heapq.heappop(self._heaps[best])
+        return None, False
+
+    def get(self, name):
+        with self._cond:
+            while True:
+                owner, entry = self._pick(name)
+                if entry is None:
+                    return None
+                if entry:
+                    break
+                self._cond.wait()
+
+            wait = time.time() - entry[2]
+            stats = self._stats[owner]
+            stats["done"] += 1
+            stats["wait-sum"] += wait
+            stats["wait-max"] = max(stats["wait-max"], wait)
+
+        if self.on_get:
+            self.on_get(entry[3])
+        return entry[3]
+
+    def qsize(self, name):
+        with self._cond:
+            return len(self._heaps[name])
+
+    def stats(self):
+        """Queue depth and wait times (in seconds) per tree"""
+        now = time.time()
+        with self._cond:
+            res = {}
+            for name, heap in self._heaps.items():
+                stats = self._stats[name]
+                res[name] = {
+                    "depth": len(heap),
+                    "oldest": round(now - min(e[2] for e in heap), 1) if heap else 0,
+                    "done": stats["done"],
+                    "wait-avg": round(stats["wait-sum"] / stats["done"], 1) if stats["done"] else 0,
+                    "wait-max": round(stats["wait-max"], 1),
+                    "stolen": stats["stolen"],
+                }
+            return res
@@ -9,23 +9,37 @@ import datetime
 import importlib
 import json
 import os
+import time
 
 import core
 import core.cmd as CMD
+from core.result_cache import dir_hash
 
 
 class Test(object):
     """Test class
 
     """
-    def __init__(self, path, name):
+    def __init__(self, path, name, result_cache=None, env=None, jobserver=None):
         self.path = path
         self.name = name
+        # Extra environment variables for tests executed as commands
+        self.env = env or {}
+        self.jobserver = jobserver
 
         core.log_open_sec("Test %s init" % (self.name, ))
 
         self._info_load()
 
+        # Only tests which declare their results depend purely on the code
+        # (not the commit message or email headers) can use the result cache
+        self.result_cache = None
+        if result_cache and self.info.get("cache"):
+            self.result_cache = result_cache
+            # Tests may source scripts from the shared tests/lib/
+            lib_dir = os.path.join(os.path.dirname(os.path.dirname(self.path)), "lib")
+            self._def_hash = dir_hash(self.path, lib_dir)
+
         # Load dynamically the python func
         if "pymod" in self.info:
             test_group = os.path.basename(os.path.dirname(path))
@@ -49,17 +63,19 @@ class Test(object):
     def is_pull_compatible(self):
         return "pull-requests" in self.info and self.info["pull-requests"]
 
-    def write_result(self, result_dir, retcode=0, out="", err="", desc=""):
+    def write_result(self, result_dir, retcode=0, out="", err="", desc="", spilled=False):
         test_dir = os.path.join(result_dir, self.name)
         if not os.path.exists(test_dir):
             os.makedirs(test_dir)
 
         with open(os.path.join(test_dir, "retcode"), "w+") as fp:
             fp.write(str(retcode))
-        if out:
+        # Spilled output has already been written out by the command runner,
+        # out and err only hold its tail
+        if out and not spilled:
             with open(os.path.join(test_dir, "stdout"), "w+") as fp:
                 fp.write(out)
-        if err:
+        if err and not spilled:
             with open(os.path.join(test_dir, "stderr"), "w+") as fp:
                 fp.write(err)
         if desc:
@@ -98,44 +114,90 @@ class Test(object):
         if not os.path.exists(test_dir):
             os.makedirs(test_dir)
 
-        retcode, out, err, desc = self._exec(tree, thing, result_dir)
+        cache_key = None
+        if self.result_cache:
+            start = time.monotonic()
+            cache_key = self.result_cache.key(self.name, self._def_hash, tree,
+                                              self._env(tree, thing))
+            retcode = self.result_cache.replay(cache_key, test_dir)
+            if retcode is not None:
+                self._write_metrics(test_dir, {"wall": round(time.monotonic() - start, 3),
+                                               "cached": True})
+                core.log_end_sec()
+                return retcode == 0
+
+        metrics = {}
+        retcode, out, err, desc = self._exec(tree, thing, result_dir, metrics)
+
+        self.write_result(result_dir, retcode, out, err, desc, spilled="run" in self.info)
+        self._write_metrics(test_dir, metrics)
 
-        self.write_result(result_dir, retcode, out, err, desc)
+        # Don't cache pending results, they are not final
+        if cache_key and retcode != 111:
+            self.result_cache.store(cache_key, test_dir)
 
         core.log_end_sec()
 
         return retcode == 0
 
-    def _exec(self, tree, thing, result_dir):
+    @staticmethod
+    def _write_metrics(test_dir, metrics):
+        if not metrics:
+            return
+        with open(os.path.join(test_dir, "metrics.json"), "w") as fp:
+            json.dump(metrics, fp)
+
+    def _exec(self, tree, thing, result_dir, metrics):
         if "run" in self.info:
-            return self._exec_run(tree, thing, result_dir)
+            return self._exec_run(tree, thing, result_dir, metrics)
         elif "pymod" in self.info:
             core.log("START", datetime.datetime.now().strftime("%H:%M:%S.%f"))
+            start = time.monotonic()
             ret = self._exec_pyfunc(tree, thing, result_dir)
+            # Python tests run in our thread, only the usage of our thread
+            # would be known (not of the commands they spawn), which is not
+            # comparable with the usage of "run" tests, record wall time only
+            metrics["wall"] = round(time.monotonic() - start, 3)
             core.log("END", datetime.datetime.now().strftime("%H:%M:%S.%f"))
             if len(ret) == 2:
                 return ret[0], "", "", ret[1]
             return ret[0], ret[2], "", ret[1]
 
-    def _exec_run(self, tree, thing, result_dir):
+    def _env(self, tree, thing):
+        """Environment for the test, which the results may depend on"""
+        env = { "BRANCH_BASE": tree.branch }
+        if hasattr(thing, 'first_in_series'):
+            env["FIRST_IN_SERIES"] = str(int(thing.first_in_series))
+        env.update(self.env)
+        return env
+
+    def _exec_run(self, tree, thing, result_dir, metrics):
         rfd, wfd = None, None
+        job_pipe = None
         retcode = 0
         try:
             rfd, wfd = os.pipe()
 
             env = { "DESC_FD": str(wfd),
-                    "RESULTS_DIR": os.path.join(result_dir, self.name),
-                    "BRANCH_BASE": tree.branch }
+                    "RESULTS_DIR": os.path.join(result_dir, self.name) }
+            env.update(self._env(tree, thing))
 
-            if hasattr(thing, 'first_in_series'):
-                env["FIRST_IN_SERIES"] = str(int(thing.first_in_series))
+            pass_fds = [wfd]
+            if self.jobserver:
+                job_pipe = self.jobserver.get()
+                env["MAKEFLAGS"] = job_pipe.makeflags()
+                pass_fds += job_pipe.fds
 
             out, err = CMD.cmd_run(self.info["run"], include_stderr=True, cwd=tree.path,
-                                   pass_fds=[wfd], add_env=env)
+                                   pass_fds=pass_fds, add_env=env, metrics=metrics,
+                                   spill_dir=os.path.join(result_dir, self.name))
         except core.cmd.CmdError as e:
             retcode = e.retcode
             out = e.stdout
             err = e.stderr
+        finally:
+            if job_pipe:
+                self.jobserver.put(job_pipe, retcode)
 
         desc = ""
         if rfd is not None:
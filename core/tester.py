@@ -4,13 +4,18 @@
 
 """ The main CI module """
 
+import concurrent.futures
 import configparser
+import json
 import os
+import queue
 import threading
 import re
+import time
 
 import core
-from core import Test, PullError, PatchApplyError
+from core import Test, PullError, PatchApplyError, ResultCache
+from core.jobserver import jobserver_get
 
 
 def write_tree_selection_result(result_dir, s, comment):
@@ -30,10 +35,13 @@ def write_tree_selection_result(result_dir, s, comment):
         if not os.path.exists(patch_dir):
             os.makedirs(patch_dir)
 
+    publish_result(series_dir, "tree_selection")
+
 
 def write_apply_result(series_dir, tree, what, retcode):
     series_apply = os.path.join(series_dir, "apply")
-    os.makedirs(series_apply)
+    # May exist already if the series is being re-tested after a crash
+    os.makedirs(series_apply, exist_ok=True)
 
     core.log("Series " + what, "")
     with open(os.path.join(series_apply, "retcode"), "w+") as fp:
@@ -41,6 +49,37 @@ def write_apply_result(series_dir, tree, what, retcode):
     with open(os.path.join(series_apply, "desc"), "w+") as fp:
         fp.write(f"Patch {what} to {tree.name}")
 
+    publish_result(series_dir, "apply")
+
+
+def write_test_plan(series_dir, series_tests, patch_tests, patches):
+    """Record which tests will run, so that results can be reported as pending"""
+    plan = {
+        "series": [test.name for test in series_tests if not test.is_disabled()],
+        "patch": [test.name for test in patch_tests if not test.is_disabled()],
+        "patches": [str(patch.id) for patch in patches],
+    }
+    tmp = os.path.join(series_dir, ".tester_plan.tmp")
+    with open(tmp, "w") as fp:
+        json.dump(plan, fp)
+    os.rename(tmp, os.path.join(series_dir, ".tester_plan"))
+
+
+def publish_result(series_dir, name, patch=None):
+    """Record that the result of a test is complete
+
+    Results are appended to the series' progress journal as soon as they
+    are written, so they can be uploaded before the whole series is done.
+    A single O_APPEND write, so lanes can publish concurrently.
+    """
+    entry = {"test": name, "patch": str(patch.id) if patch else None}
+    fd = os.open(os.path.join(series_dir, ".tester_progress"),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(entry) + "\n").encode())
+    finally:
+        os.close(fd)
+
 
 def mark_done(result_dir, series):
     series_dir = os.path.join(result_dir, str(series.id))
@@ -63,6 +102,18 @@ class Tester(threading.Thread):
 
         self.series_tests = []
         self.patch_tests = []
+        self.result_cache = None
+        self.test_env = {}
+        self.jobserver = None
+
+        self._lane_pool = None
+        self._lane_tls = threading.local()
+        self._guest_trees = {}
+
+        # Series being tested (id, title, start time), and totals of completed ones
+        self.in_flight = None
+        self.series_done = 0
+        self.series_time = 0.0
 
     def run(self) -> None:
         if self.config is None:
@@ -72,7 +123,8 @@ class Tester(threading.Thread):
         log_dir = self.config.get('log', 'dir', fallback=core.NIPA_DIR)
         core.log_init(
             self.config.get('log', 'type', fallback='org'),
-            self.config.get('log', 'file', fallback=os.path.join(log_dir, f"{self.tree.name}.org")))
+            self.config.get('log', 'file', fallback=os.path.join(log_dir, f"{self.tree.name}.org")),
+            async_write=self.config.getboolean('log', 'async', fallback=False))
 
         core.log_open_sec("Tester init")
         if not os.path.exists(self.result_dir):
@@ -84,8 +136,21 @@ class Tester(threading.Thread):
         self.include = [x.strip() for x in re.split(r'[,\n]', self.config.get('tests', 'include', fallback="")) if len(x)]
         self.exclude = [x.strip() for x in re.split(r'[,\n]', self.config.get('tests', 'exclude', fallback="")) if len(x)]
 
+        cache_dir = self.config.get('tester', 'result_cache', fallback=None)
+        if cache_dir:
+            self.result_cache = ResultCache(cache_dir)
+
+        baseline_dir = self.config.get('tester', 'baseline_dir', fallback=None)
+        if baseline_dir:
+            self.test_env['BASELINE_DIR'] = baseline_dir
+
+        jobserver_slots = self.config.getint('tester', 'jobserver_slots', fallback=0)
+        if jobserver_slots > 0:
+            self.jobserver = jobserver_get(jobserver_slots)
+
         self.series_tests = self.load_tests("series")
         self.patch_tests = self.load_tests("patch")
+        self.init_lanes(self.config.getint('tester', 'patch_lanes', fallback=1))
         core.log_end_sec()
 
         while not self.should_die:
@@ -94,12 +159,70 @@ class Tester(threading.Thread):
                 break
 
             core.log(f"Tester commencing with backlog of {self.queue.qsize()}")
-            self.test_series(self.tree, s)
+            self.tree.prune_chains(self.config.getint('tester', 'chain_max_age', fallback=7) * 86400)
+            if self.result_cache:
+                self.result_cache.prune(self.config.getint('tester', 'result_cache_max_age',
+                                                           fallback=14) * 86400)
+            self.in_flight = {"id": s.id, "title": s.title, "start": time.time()}
+            try:
+                self.test_series(self._tree_for(s), s)
+            finally:
+                self.series_time += time.time() - self.in_flight["start"]
+                self.series_done += 1
+                self.in_flight = None
             self.done_queue.put(s)
             core.log("Tester done processing")
 
+        if self._lane_pool:
+            self._lane_pool.shutdown()
         core.log("Tester exiting")
 
+    def _tree_for(self, series):
+        # Scheduler may hand us series of sibling trees, test those in our own
+        # worktree of the other tree's repo
+        other = None
+        if hasattr(self.queue, 'foreign_tree'):
+            other = self.queue.foreign_tree(series)
+        if not other:
+            return self.tree
+
+        if other.name not in self._guest_trees:
+            self._guest_trees[other.name] = other.work_tree(self.tree.name)
+        tree = self._guest_trees[other.name]
+        core.log(f"Testing series for {other.name} in {tree.name}", "")
+        return tree
+
+    def init_lanes(self, lane_cnt):
+        """Create worktrees for running patch tests in parallel.
+
+        Patch tests are independent of each other, so each test can be
+        run over the whole series in a separate worktree ("lane").
+        """
+        if lane_cnt < 2:
+            return
+        if not self.tree.parent:
+            core.log(f"Tree {self.tree.name} is not a worktree, not using lanes")
+            return
+
+        idle = queue.Queue()
+        for lane in range(lane_cnt):
+            idle.put(self.tree.lane_tree(lane))
+        core.log(f"Created {lane_cnt} patch test lanes")
+
+        self._lane_pool = concurrent.futures.ThreadPoolExecutor(max_workers=lane_cnt,
+                                                                initializer=self._lane_init,
+                                                                initargs=(idle, ))
+
+    def _lane_init(self, idle):
+        # Each pool thread owns one lane worktree for its whole life
+        tree = idle.get()
+        self._lane_tls.tree = tree
+
+        log_dir = self.config.get('log', 'dir', fallback=core.NIPA_DIR)
+        core.log_init(self.config.get('log', 'type', fallback='org'),
+                      os.path.join(log_dir, f"{tree.name}.org"),
+                      async_write=self.config.getboolean('log', 'async', fallback=False))
+
     def get_test_names(self, annotate=True) -> list[str]:
         tests_dir = os.path.abspath(core.CORE_DIR + "../../tests")
         location = self.config.get('dirs', 'tests', fallback=tests_dir)
@@ -129,7 +252,9 @@ class Tester(threading.Thread):
             test = f'{name}/{td}'
             if test not in self.exclude and (len(self.include) == 0 or test in self.include):
                 core.log(f"Adding test {test}")
-                tests.append(Test(os.path.join(tests_subdir, td), td))
+                tests.append(Test(os.path.join(tests_subdir, td), td,
+                                  result_cache=self.result_cache, env=self.test_env,
+                                  jobserver=self.jobserver))
             else:
                 core.log(f"Skipped test {test}")
         core.log_end_sec()
@@ -137,10 +262,14 @@ class Tester(threading.Thread):
         return tests
 
     def test_series(self, tree, series):
+        lock_wait = tree.lock_wait
+
         write_tree_selection_result(self.result_dir, series, series.tree_selection_comment)
         self._test_series(tree, series)
         mark_done(self.result_dir, series)
 
+        core.log(f"Lock wait {tree.lock_wait - lock_wait:.1f}s, total {tree.lock_wait:.1f}s", "")
+
     def _test_series(self, tree, series):
         core.log_open_sec("Running tests in tree %s for %s" % (tree.name, series.title))
 
@@ -163,8 +292,9 @@ class Tester(threading.Thread):
 
     def _test_series_patches(self, tree, series, series_dir):
         tree.reset(fetch=False)
+        base = tree.head_hash()
         try:
-            tree.apply(series)
+            commits = tree.apply_chain(series, base)
         except PatchApplyError:
             already_applied = tree.check_already_applied(series)
             if already_applied:
@@ -173,45 +303,92 @@ class Tester(threading.Thread):
                 write_apply_result(series_dir, tree, "does not apply", 1)
             return
 
+        # Patch tests check out the commit of each patch, a patch which
+        # git am turned into no commit (or more than one) would shift them
+        if len(commits) != len(series.patches):
+            core.log("Commit count mismatch",
+                     f"{len(commits)} commits for {len(series.patches)} patches")
+            write_apply_result(series_dir, tree, "applied as a different number of commits", 1)
+            return
+
+        write_test_plan(series_dir, self.series_tests, self.patch_tests, series.patches)
+
         for test in self.series_tests:
-            test.exec(tree, series, series_dir)
+            self._exec_test(test, tree, series, series_dir, series_dir)
+
+        # Lane trees are bound to our own tree's branch
+        if self._lane_pool and tree is self.tree:
+            self._test_patches_lanes(commits, series, series_dir)
+            return
 
         tcnt = 0
         for test in self.patch_tests:
             tcnt += 1
-            tree.reset(fetch=False)
-
-            pcnt = 0
-            for patch in series.patches:
-                pcnt += 1
-                cnts = f"{tcnt}/{len(self.patch_tests)}|{pcnt}/{len(series.patches)}"
-                core.log_open_sec(f"Testing patch {cnts}| {patch.title}")
-
-                patch_dir = os.path.join(series_dir, str(patch.id))
-                if not os.path.exists(patch_dir):
-                    os.makedirs(patch_dir)
-
-                try:
-                    tree.apply(patch)
-                    test.exec(tree, patch, patch_dir)
-                except PatchApplyError:
-                    write_apply_result(series_dir, tree, f"patch {pcnt} does not apply", 1)
-                    return
-                finally:
-                    core.log_end_sec()
+            self._test_patches(tree, commits, test, tcnt, series, series_dir)
+
+    @staticmethod
+    def _exec_test(test, tree, thing, result_dir, series_dir, patch=None):
+        test.exec(tree, thing, result_dir)
+        if not test.is_disabled():
+            publish_result(series_dir, test.name, patch)
+
+    def _test_patches(self, tree, commits, test, tcnt, series, series_dir):
+        """Run one test on every patch of the series.
+
+        Instead of re-applying the patches check out the commits
+        created when the series was applied.
+        """
+        pcnt = 0
+        for patch, commit in zip(series.patches, commits):
+            pcnt += 1
+            cnts = f"{tcnt}/{len(self.patch_tests)}|{pcnt}/{len(series.patches)}"
+            core.log_open_sec(f"Testing patch {cnts}| {patch.title}")
+
+            patch_dir = os.path.join(series_dir, str(patch.id))
+            os.makedirs(patch_dir, exist_ok=True)
+
+            try:
+                tree.git_reset(commit, hard=True)
+                self._exec_test(test, tree, patch, patch_dir, series_dir, patch)
+            finally:
+                core.log_end_sec()
+
+    def _test_patches_lane(self, commits, test, tcnt, series, series_dir):
+        tree = self._lane_tls.tree
+
+        core.log_open_sec(f"Lane test {test.name} for {series.title}")
+        try:
+            self._test_patches(tree, commits, test, tcnt, series, series_dir)
+        finally:
+            core.log_end_sec()
+
+    def _test_patches_lanes(self, commits, series, series_dir):
+        core.log_open_sec(f"Running {len(self.patch_tests)} patch tests in lanes")
+        try:
+            futures = []
+            tcnt = 0
+            for test in self.patch_tests:
+                tcnt += 1
+                futures.append(self._lane_pool.submit(self._test_patches_lane, commits, test,
+                                                      tcnt, series, series_dir))
+            for f in futures:
+                f.result()
+        finally:
+            core.log_end_sec()
 
     def _test_series_pull(self, tree, series, series_dir):
         try:
             tree.pull(series.pull_url)
         except PullError:
             series_apply = os.path.join(series_dir, "apply")
-            os.makedirs(series_apply)
+            os.makedirs(series_apply, exist_ok=True)
 
             core.log("Pull failed", "")
             with open(os.path.join(series_apply, "retcode"), "w+") as fp:
                 fp.write("1")
             with open(os.path.join(series_apply, "desc"), "w+") as fp:
                 fp.write(f"Pull to {tree.name} failed")
+            publish_result(series_dir, "apply")
             return
 
         patch = series.patches[0]
@@ -222,10 +399,12 @@ class Tester(threading.Thread):
         if not os.path.exists(patch_dir):
             os.makedirs(patch_dir)
 
+        pull_tests = [test for test in self.patch_tests if test.is_pull_compatible()]
+        write_test_plan(series_dir, [], pull_tests, [patch])
+
         try:
-            for test in self.patch_tests:
-                if test.is_pull_compatible():
-                    test.exec(tree, patch, patch_dir)
+            for test in pull_tests:
+                self._exec_test(test, tree, patch, patch_dir, series_dir, patch)
         finally:
             core.log_end_sec()
 
@@ -0,0 +1,209 @@
+# SPDX-License-Identifier: GPL-2.0
+
+"""Tests of tests/lib/baseline.sh with canned kbuild output"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+BASELINE_SH = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           '..', '..', 'tests', 'lib', 'baseline.sh'))
+
+# Full build of the tree before the patch, stdout and stderr combined
+LOG_BEFORE = """\
+make[1]: Entering directory '/src/build_allmodconfig_warn'
+  CC [M]  drivers/fw_error.o
+  CHECK   drivers/fw_error.c
+drivers/fw_error.c:1:1: warning: old warning in fw_error
+  CC [M]  drivers/b.o
+drivers/b.c:2:1: warning: old warning in b
+  MODPOST Module.symvers
+WARNING: modpost: missing MODULE_DESCRIPTION() in drivers/b.o
+  LD [M]  drivers/b.ko
+make[1]: Leaving directory '/src/build_allmodconfig_warn'
+"""
+
+# What the old scripts counted (stderr only) for the incremental build
+# before the patch, with only b.o rebuilt
+STDERR_BEFORE = """\
+drivers/b.c:2:1: warning: old warning in b
+WARNING: modpost: missing MODULE_DESCRIPTION() in drivers/b.o
+"""
+
+# Incremental build with the patch, which touches b.c
+LOG_AFTER = """\
+make[1]: Entering directory '/src/build_allmodconfig_warn'
+  CC [M]  drivers/b.o
+drivers/b.c:2:1: warning: old warning in b
+drivers/b.c:3:1: warning: new warning in b
+  MODPOST Module.symvers
+WARNING: modpost: missing MODULE_DESCRIPTION() in drivers/b.o
+  LD [M]  drivers/b.ko
+make[1]: Leaving directory '/src/build_allmodconfig_warn'
+"""
+
+STDERR_AFTER = """\
+drivers/b.c:2:1: warning: old warning in b
+drivers/b.c:3:1: warning: new warning in b
+WARNING: modpost: missing MODULE_DESCRIPTION() in drivers/b.o
+"""
+
+CMD_FILES = {
+    'drivers/.fw_error.o.cmd': "cmd_drivers/fw_error.o := gcc -c drivers/fw_error.c\n"
+                               "source_drivers/fw_error.o := ../drivers/fw_error.c\n"
+                               "deps_drivers/fw_error.o := \\\n"
+                               "  ../drivers/h.h \\\n",
+    'drivers/.b.o.cmd': "cmd_drivers/b.o := gcc -c drivers/b.c\n"
+                        "source_drivers/b.o := ../drivers/b.c\n"
+                        "deps_drivers/b.o := \\\n"
+                        "  ../include/linux/kernel.h \\\n",
+}
+
+
+def _count(text):
+    return sum('warn' in line.lower() or 'error' in line.lower()
+               for line in text.split('\n'))
+
+
+class TestBaseline(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = os.path.join(self.path, 'store')
+        self.repo = os.path.join(self.path, 'repo')
+        os.makedirs(os.path.join(self.repo, 'drivers'))
+
+        self._write('drivers/fw_error.c', 'int a;\n')
+        self._write('drivers/b.c', 'int b;\n')
+        self._write('drivers/h.h', '\n')
+        self._write('out/.config', 'CONFIG_B=m\n')
+        for name, text in CMD_FILES.items():
+            self._write(os.path.join('out', name), text)
+        self._write('.gitignore', 'out/\n')
+        self._git('init', '-q')
+        self._git('add', '.')
+        self._git('commit', '-q', '-m', 'base')
+        self._write('drivers/b.c', 'int b;\nint c;\n')
+        self._git('commit', '-q', '-a', '-m', 'patch')
+
+        self._write('before.log', LOG_BEFORE)
+        self._write('after.log', LOG_AFTER)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _write(self, name, text):
+        path = os.path.join(self.repo, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(text)
+
+    def _read(self, name):
+        with open(os.path.join(self.repo, name)) as fp:
+            return fp.read()
+
+    def _git(self, *args):
+        env = dict(os.environ, GIT_AUTHOR_NAME='A', GIT_AUTHOR_EMAIL='a@a',
+                   GIT_COMMITTER_NAME='A', GIT_COMMITTER_EMAIL='a@a')
+        subprocess.run(['git'] + list(args), cwd=self.repo, env=env, check=True)
+
+    def _sh(self, script):
+        env = dict(os.environ, BASELINE_DIR=self.store)
+        res = subprocess.run(['bash', '-e', '-c', f'source {BASELINE_SH}\n{script}'],
+                             cwd=self.repo, env=env, stdout=subprocess.PIPE, check=True)
+        return res.stdout.decode()
+
+    def _key(self, rev):
+        return self._sh(f'baseline_key {rev} out/.config extra').strip()
+
+    def test_groups(self):
+        out = self._sh('baseline_groups after.log')
+        self.assertEqual([line for line in out.split('\n') if line and '\t' not in line],
+                         ['CC [M] drivers/b.o', 'MODPOST Module.symvers', 'LD [M] drivers/b.ko'])
+        # Lines make and kbuild print on stdout are not part of the output
+        self.assertNotIn('Entering directory', out)
+        self.assertNotIn('Leaving directory', out)
+        out = self._sh('baseline_groups before.log')
+        self.assertNotIn('CHECK', out)
+        self.assertIn('CC [M] drivers/fw_error.o\tdrivers/fw_error.c:1:1: warning', out)
+
+    def test_affected(self):
+        out = self._sh('baseline_groups after.log > groups\n'
+                       'baseline_affected out groups 0')
+        steps = set(out.strip().split('\n'))
+        self.assertEqual(steps, {'CC [M] drivers/b.o', 'MODPOST Module.symvers',
+                                 'LD [M] drivers/b.ko'})
+
+        # Object not depending on the touched files
+        out = self._sh('baseline_groups before.log > groups\n'
+                       'baseline_affected out groups 0')
+        self.assertNotIn('CC [M] drivers/fw_error.o', out.split('\n'))
+
+    def test_affected_kconfig(self):
+        self._write('drivers/Kconfig', 'config B\n')
+        self._git('add', 'drivers/Kconfig')
+        self._git('commit', '-q', '--amend', '-m', 'patch')
+        out = self._sh('baseline_groups before.log > groups\n'
+                       'baseline_affected out groups 0')
+        self.assertIn('CC [M] drivers/fw_error.o', out.split('\n'))
+
+    def _counts(self, before_groups_script):
+        """Counts of warnings before and after, as computed by the build scripts"""
+        self._sh('baseline_groups after.log > groups_n\n'
+                 'baseline_affected out groups_n 0 > affected\n' +
+                 before_groups_script + '\n'
+                 'baseline_output groups_n affected groups_o stored > tmpfile_o\n'
+                 'baseline_output groups_n /dev/null > tmpfile_n\n')
+        return _count(self._read('tmpfile_o')), _count(self._read('tmpfile_n'))
+
+    def test_counts_match_stderr_counting(self):
+        expected = (_count(STDERR_BEFORE), _count(STDERR_AFTER))
+        self.assertEqual(expected, (2, 3))
+
+        # Miss, the tree before the patch gets built
+        self.assertEqual(self._counts(': > stored\n'
+                                      'baseline_groups before.log > groups_o'), expected)
+
+        # Hit, the output before the patch comes from the store
+        self._sh(f'baseline_groups before.log > g\nbaseline_put {self._key("HEAD~")} g')
+        counts = self._counts(f': > groups_o\nbaseline_get {self._key("HEAD~")} stored\n'
+                              f'test -z "$(baseline_missing affected stored)"')
+        self.assertEqual(counts, expected)
+
+    def test_partial_hit(self):
+        # Stored by the build of an earlier patch, which didn't rebuild b.o
+        self._write('partial.log', LOG_BEFORE.replace('  CC [M]  drivers/b.o\n', '')
+                                             .replace('drivers/b.c:2:1: warning: old warning in b\n',
+                                                      ''))
+        self._sh(f'baseline_groups partial.log > g\nbaseline_put {self._key("HEAD~")} g')
+        out = self._sh('baseline_groups after.log > groups_n\n'
+                       'baseline_affected out groups_n 0 > affected\n'
+                       f'baseline_get {self._key("HEAD~")} stored\n'
+                       'baseline_missing affected stored')
+        self.assertEqual(out.strip(), 'CC [M] drivers/b.o')
+
+        # Missing steps built, the rest from the store
+        counts = self._counts(f'baseline_get {self._key("HEAD~")} stored\n'
+                              'baseline_groups before.log > groups_o')
+        self.assertEqual(counts, (2, 3))
+
+    def test_put_merges_steps(self):
+        key = self._key('HEAD')
+        self._sh(f'baseline_groups before.log > g\nbaseline_put {key} g')
+        self._sh(f'baseline_groups after.log > g\nbaseline_put {key} g')
+        out = self._sh(f'baseline_get {key} stored\ncat stored')
+        # Steps of the second build replace the same steps of the first one
+        self.assertIn('new warning in b', out)
+        self.assertEqual(out.count('old warning in b'), 1)
+        self.assertIn('old warning in fw_error', out)
+
+    def test_key(self):
+        self.assertNotEqual(self._key('HEAD'), self._key('HEAD~'))
+        key = self._key('HEAD')
+        self._write('out/.config', 'CONFIG_B=y\n')
+        self.assertNotEqual(self._key('HEAD'), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+# SPDX-License-Identifier: GPL-2.0
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import core
+from core.authorship import Mailmap
+from core.get_maintainer import GetMaintainer
+from core.maintainers import Maintainers
+from core.patch import Patch
+
+
+MAINTAINERS = """\
+Descriptions of section entries and preferred order
+---------------------------------------------------
+
+	M: *Mail* patches to: FullName <address@domain>
+
+Maintainers List
+----------------
+
+BAR DRIVER
+M:	Bar Maintainer <bar@example.com>
+S:	Maintained
+F:	drivers/bar/*
+
+BAZ HEADERS
+M:	Baz Maintainer <baz@example.com>
+S:	Odd Fixes
+F:	include/baz/*.h
+
+NETWORKING DRIVERS
+M:	Net Maintainer <net@example.com>
+R:	Net Reviewer <netrev@example.com>
+L:	netdev@example.com
+S:	Maintained
+F:	drivers/
+X:	drivers/bar/secret.c
+
+QUX LIBRARY
+M:	Qux Maintainer <qux@example.com>
+S:	Supported
+N:	qux
+K:	\\bqux_[a-z]+\\(
+
+THE REST
+M:	Linus Torvalds <torvalds@linux-foundation.org>
+L:	linux-kernel@example.com
+S:	Buried alive in reporters
+F:	*
+F:	*/
+"""
+
+MAILMAP = """\
+Dev One <dev1@example.com> <dev1@old.example.com>
+Dev Two <dev2@example.com>
+Proper Name <proper@example.com> Commit Name <shared@example.com>
+"""
+
+
+def _names(entries):
+    return sorted(e.title for e in entries)
+
+
+class TestMaintainers(unittest.TestCase):
+    def setUp(self):
+        self.maint = Maintainers()
+        self.maint.load_data(MAINTAINERS.encode())
+
+    def test_prefix(self):
+        self.assertEqual(_names(self.maint.find_by_path('drivers/net/a.c')),
+                         ['NETWORKING DRIVERS', 'THE REST'])
+
+    def test_exclude(self):
+        self.assertEqual(_names(self.maint.find_by_path('drivers/bar/secret.c')),
+                         ['BAR DRIVER', 'THE REST'])
+
+    def test_glob_depth(self):
+        # "dir/*" only matches files directly in dir
+        self.assertIn('BAR DRIVER', _names(self.maint.find_by_path('drivers/bar/a.c')))
+        self.assertNotIn('BAR DRIVER', _names(self.maint.find_by_path('drivers/bar/sub/a.c')))
+        self.assertIn('BAZ HEADERS', _names(self.maint.find_by_path('include/baz/a.h')))
+        self.assertNotIn('BAZ HEADERS', _names(self.maint.find_by_path('include/baz/x/a.h')))
+        self.assertNotIn('BAZ HEADERS', _names(self.maint.find_by_path('include/baz/a.c')))
+        # "*" only matches top level files, "*/" everything, neither
+        # is ever an exact match
+        rest = [e for e in self.maint.entries if e.title == 'THE REST'][0]
+        self.assertIn('THE REST', _names(self.maint.find_by_path('Makefile')))
+        self.assertIn('THE REST', _names(self.maint.find_by_path('net/core/dev.c')))
+        self.assertEqual(rest.file_match_depth('Makefile'), -1)
+        self.assertEqual(rest.file_match_depth('net/core/dev.c'), -1)
+
+    def test_file_match_depth(self):
+        net = [e for e in self.maint.entries if e.title == 'NETWORKING DRIVERS'][0]
+        bar = [e for e in self.maint.entries if e.title == 'BAR DRIVER'][0]
+        self.assertEqual(net.file_match_depth('drivers/bar/a.c'), 1)
+        self.assertEqual(bar.file_match_depth('drivers/bar/a.c'), 3)
+        self.assertIsNone(bar.file_match_depth('net/a.c'))
+
+    def test_name_regex(self):
+        self.assertIn('QUX LIBRARY', _names(self.maint.find_by_path('lib/qux_helpers.c')))
+        self.assertNotIn('QUX LIBRARY', _names(self.maint.find_by_path('lib/quux.c')))
+
+    def test_keywords(self):
+        qux = [e for e in self.maint.entries if e.title == 'QUX LIBRARY'][0]
+        self.assertTrue(qux.match_keywords('\tret = qux_init(dev);'))
+        self.assertFalse(qux.match_keywords('\tret = myqux_init(dev);'))
+        self.assertFalse(qux.match_keywords('\tqux_init = 1;'))
+
+    def test_find_by_owner(self):
+        self.assertEqual(_names(self.maint.find_by_owner('Someone <netrev@example.com>')),
+                         ['NETWORKING DRIVERS'])
+
+
+class TestMailmap(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(MAILMAP)
+        self.mailmap = Mailmap(self.path)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_map(self):
+        self.assertEqual(self.mailmap.map('Dev 1 <dev1@old.example.com>'),
+                         'Dev One <dev1@example.com>')
+        self.assertEqual(self.mailmap.map('D. Two <DEV2@example.com>'),
+                         'Dev Two <DEV2@example.com>')
+        self.assertEqual(self.mailmap.map('Commit Name <shared@example.com>'),
+                         'Proper Name <proper@example.com>')
+        self.assertEqual(self.mailmap.map('Other Name <shared@example.com>'),
+                         'Other Name <shared@example.com>')
+        self.assertEqual(self.mailmap.map('Nobody <nobody@example.com>'),
+                         'Nobody <nobody@example.com>')
+
+
+class TestGetMaintainer(unittest.TestCase):
+    """Roles for patches against a small repo with a known history"""
+    @classmethod
+    def _git(cls, *args, author='Dev One <dev1@old.example.com>'):
+        name, addr = author[:-1].split(' <')
+        env = dict(os.environ, GIT_AUTHOR_NAME=name, GIT_AUTHOR_EMAIL=addr,
+                   GIT_COMMITTER_NAME=name, GIT_COMMITTER_EMAIL=addr)
+        res = subprocess.run(['git'] + list(args), cwd=cls.path, env=env, check=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return res.stdout.decode()
+
+    @classmethod
+    def _commit(cls, path, line, author, signers=()):
+        full = os.path.join(cls.path, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'a') as fp:
+            fp.write(line + '\n')
+        cls._git('add', path)
+        msg = f"change {path}\n\n" + ''.join(f"Signed-off-by: {s}\n" for s in signers)
+        cls._git('commit', '-q', '-m', msg, author=author)
+        return cls._git('rev-parse', 'HEAD').strip()
+
+    @classmethod
+    def setUpClass(cls):
+        core.log_init('stdout', '')
+
+        cls.path = tempfile.mkdtemp()
+        cls._git('init', '-q', '-b', 'main')
+        with open(os.path.join(cls.path, 'MAINTAINERS'), 'w') as fp:
+            fp.write(MAINTAINERS)
+        with open(os.path.join(cls.path, '.mailmap'), 'w') as fp:
+            fp.write(MAILMAP)
+        cls._git('add', 'MAINTAINERS', '.mailmap')
+        cls._git('commit', '-q', '-m', 'init')
+
+        one = 'Dev One <dev1@old.example.com>'
+        two = 'Dev Two <dev2@example.com>'
+        for i in range(3):
+            cls._commit('lib/misc.c', f'one {i}', one, [one])
+        cls.blamed = cls._commit('lib/misc.c', 'two', two,
+                                 [two, 'Maint Ainer <maint@example.com>'])
+
+        cls.tree = types.SimpleNamespace(path=cls.path, branch='main',
+                                         state_dir=lambda: os.path.join(cls.path, '.git', 'nipa'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+
+    @staticmethod
+    def _patch(path, fixes=None):
+        msg = "Subject: [PATCH] test\nFrom: Sub Mitter <sub@example.com>\n\nchange\n\n"
+        if fixes:
+            msg += f"Fixes: {fixes[:12]} (\"change lib/misc.c\")\n"
+        msg += "Signed-off-by: Sub Mitter <sub@example.com>\n---\n"
+        msg += f"diff --git a/{path} b/{path}\n--- a/{path}\n+++ b/{path}\n"
+        msg += "@@ -1,1 +1,2 @@\n one 0\n+new\n"
+        return Patch(msg)
+
+    def _run(self, patch, min_percent=5):
+        res = {}
+        for line in GetMaintainer(self.tree, min_percent=min_percent).run(patch):
+            addr, roles = line[:-1].split(' (', 1)
+            res[addr] = roles.split(',')
+        return res
+
+    def test_maintained_section(self):
+        res = self._run(self._patch('drivers/bar/a.c'))
+        self.assertEqual(res['Bar Maintainer <bar@example.com>'], ['maintainer:BAR DRIVER'])
+        self.assertEqual(res['Net Maintainer <net@example.com>'], ['maintainer:NETWORKING DRIVERS'])
+        self.assertEqual(res['Net Reviewer <netrev@example.com>'], ['reviewer:NETWORKING DRIVERS'])
+        self.assertEqual(res['netdev@example.com'], ['open list:NETWORKING DRIVERS'])
+        self.assertEqual(res['linux-kernel@example.com'], ['open list'])
+        # Exact match with a maintained section, no git fallback
+        self.assertFalse(any('commit_signer' in r for roles in res.values() for r in roles))
+        # Chief penguin is never listed
+        self.assertFalse(any('torvalds' in addr for addr in res))
+
+    def test_git_fallback(self):
+        res = self._run(self._patch('lib/misc.c'))
+        # Mailmap merges the old and new address of Dev One
+        self.assertEqual(res['Dev One <dev1@example.com>'],
+                         ['commit_signer:3/4=75%', 'authored:3/4=75%', 'added_lines:3/4=75%'])
+        self.assertEqual(res['Dev Two <dev2@example.com>'],
+                         ['commit_signer:1/4=25%', 'authored:1/4=25%', 'added_lines:1/4=25%'])
+        self.assertEqual(res['Maint Ainer <maint@example.com>'], ['commit_signer:1/4=25%'])
+
+    def test_min_percent(self):
+        res = self._run(self._patch('lib/misc.c'), min_percent=35)
+        self.assertIn('Dev One <dev1@example.com>', res)
+        self.assertNotIn('Dev Two <dev2@example.com>', res)
+        self.assertNotIn('Maint Ainer <maint@example.com>', res)
+
+    def test_blamed_fixes(self):
+        res = self._run(self._patch('drivers/bar/a.c', fixes=self.blamed))
+        self.assertEqual(res['Dev Two <dev2@example.com>'], ['blamed_fixes:1/1=100%'])
+        self.assertEqual(res['Maint Ainer <maint@example.com>'], ['blamed_fixes:1/1=100%'])
+
+    def test_keywords_and_names(self):
+        patch = self._patch('lib/misc.c')
+        patch.raw_patch = patch.raw_patch.replace('+new', '+\tqux_init(dev);')
+        res = self._run(patch)
+        self.assertEqual(res['Qux Maintainer <qux@example.com>'], ['supporter:QUX LIBRARY'])
+        res = self._run(self._patch('lib/qux_util.c'))
+        self.assertEqual(res['Qux Maintainer <qux@example.com>'], ['supporter:QUX LIBRARY'])
+
+
+if __name__ == '__main__':
+    unittest.main()
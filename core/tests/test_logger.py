@@ -0,0 +1,97 @@
+# SPDX-License-Identifier: GPL-2.0
+
+import lzma
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.logger import JsonlLogger, OrgLogger, log_render
+
+
+def _wait_compress():
+    for thread in threading.enumerate():
+        if thread.name == "log-compress":
+            thread.join()
+
+
+class TestLogRender(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.src = os.path.join(self.path, 'poller.jsonl')
+
+        logger = JsonlLogger(self.src)
+        logger.open_sec("Checking series 1234")
+        logger.log("Applying", "* patch <1/2>\n* patch <2/2>\n")
+        logger.end_sec()
+        logger.log("Done", "")
+        logger.fini()
+
+    def tearDown(self):
+        _wait_compress()
+        shutil.rmtree(self.path)
+
+    def _render(self, fmt, src=None):
+        out = os.path.join(self.path, os.path.basename(src or self.src) + '.' + fmt)
+        log_render(src or self.src, fmt, out)
+        with open(out) as fp:
+            return fp.read()
+
+    def test_org(self):
+        self.assertEqual(self._render('org'),
+                         "# -*-Org-*-\n"
+                         "* Checking series 1234\n"
+                         "** Applying\n"
+                         " * patch <1/2>\n * patch <2/2>\n\n"
+                         "* Done\n")
+
+    def test_xml(self):
+        self.assertEqual(self._render('xml'),
+                         '<?xml version="1.0" encoding="UTF-8" ?>\n<log>\n'
+                         "<sec>\n<header>Checking series 1234</header>\n"
+                         "<sec>\n<header>Applying</header>\n"
+                         "<data>* patch &lt;1/2&gt;\n* patch &lt;2/2&gt;\n</data>\n"
+                         "</sec>\n</sec>\n"
+                         "<sec>\n<header>Done</header>\n<data></data>\n</sec>\n"
+                         "</log>")
+
+    def test_xz(self):
+        with open(self.src, 'rb') as fp, lzma.open(self.src + '.xz', 'w') as zf:
+            zf.write(fp.read())
+        self.assertEqual(self._render('xml', self.src + '.xz'), self._render('xml'))
+
+
+class TestLogRotate(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.log = os.path.join(self.path, 'poller.org')
+
+    def tearDown(self):
+        _wait_compress()
+        shutil.rmtree(self.path)
+
+    def test_startup(self):
+        with open(self.log, 'w') as fp:
+            fp.write("previous run\n")
+
+        logger = OrgLogger(self.log)
+        logger.log("New run", "")
+        logger.fini()
+        _wait_compress()
+
+        names = os.listdir(self.path)
+        self.assertEqual(len(names), 2)
+        old = [n for n in names if n != 'poller.org'][0]
+        self.assertTrue(old.endswith('.xz'))
+        with lzma.open(os.path.join(self.path, old), 'rt') as fp:
+            self.assertEqual(fp.read(), "previous run\n")
+        with open(self.log) as fp:
+            self.assertNotIn("previous run", fp.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
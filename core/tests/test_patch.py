@@ -0,0 +1,249 @@
+# SPDX-License-Identifier: GPL-2.0
+
+import os
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import core
+from core.patch import Patch
+from tests.patch.check_selftest.test import extract_files as selftest_files
+from tests.series.fixes_present.test import fixes_present
+from tests.series.maintainers.test import extract_files as maintainers_files
+
+
+HEADERS = """\
+From 0123456789abcdef0123456789abcdef01234567 Mon Sep 17 00:00:00 2001
+From: Sub Mitter <sub@example.com>
+Subject: [PATCH net v2 1/2] net: fix the thing which
+ was broken
+In-Reply-To: <cover@example.com>
+Message-Id: <patch1@example.com>
+
+"""
+
+MESSAGE = """\
+The thing was broken.
+
+Fixes: 0123456789ab ("net: add the thing")
+Fixes: https://example.com/bug/1
+Fixes: fedcba987654 ("net: rework the thing")
+Signed-off-by: Sub Mitter <sub@example.com>
+Signed-off-by: Maint Ainer <maint@example.com>
+---
+v2: now with a Fixes tag
+Fixes: 111111111111 ("only in the notes")
+
+"""
+
+DIFFSTAT = """\
+ drivers/net/foo.c                             |  4 +++-
+ .../ethernet/vendor/long/path/to/file.c       |  2 +-
+ scripts/run.sh                                |  0
+ 2 files changed, 4 insertions(+), 2 deletions(-)
+
+"""
+
+DIFF_MODIFY = """\
+diff --git a/drivers/net/foo.c b/drivers/net/foo.c
+index 1111111..2222222 100644
+--- a/drivers/net/foo.c
++++ b/drivers/net/foo.c
+@@ -10,4 +10,6 @@ static int foo(void)
+ \tint a;
+-\treturn 0;
++\t/* Fixes: not a tag, in the code */
++\ta = 1;
++\treturn a;
+ }
+--
++--- not a file header
+@@ -40 +42 @@ static int bar(void)
+-\told();
++\tnew();
+"""
+
+DIFF_RENAME = """\
+diff --git a/net/old_name.c b/net/new_name.c
+similarity index 100%
+rename from net/old_name.c
+rename to net/new_name.c
+diff --git a/net/moved.c b/net/core/moved.c
+similarity index 90%
+rename from net/moved.c
+rename to net/core/moved.c
+index 3333333..4444444 100644
+--- a/net/moved.c
++++ b/net/core/moved.c
+@@ -1,2 +1,2 @@
+ #include <net/sock.h>
+-#include "moved.h"
++#include "../moved.h"
+
+"""
+
+DIFF_BINARY = """\
+diff --git a/Documentation/images/new.png b/Documentation/images/new.png
+new file mode 100644
+index 0000000..5555555
+GIT binary patch
+literal 12
+TcmZQzWMX7wU}9hdVPXIP01N;E
+
+literal 0
+HcmV?d00001
+
+diff --git a/firmware/blob.bin b/firmware/blob.bin
+index 6666666..7777777 100644
+Binary files a/firmware/blob.bin and b/firmware/blob.bin differ
+"""
+
+DIFF_MODE = """\
+diff --git a/scripts/run.sh b/scripts/run.sh
+old mode 100644
+new mode 100755
+diff --git a/drivers/net/gone.c b/drivers/net/gone.c
+deleted file mode 100644
+index 8888888..0000000
+--- a/drivers/net/gone.c
++++ /dev/null
+@@ -1,2 +0,0 @@
+-int gone;
+-int really;
+diff --git a/drivers/net/new.c b/drivers/net/new.c
+new file mode 100644
+index 0000000..9999999
+--- /dev/null
++++ b/drivers/net/new.c
+@@ -0,0 +1 @@
++int new;
+"""
+
+
+def _files(parsed):
+    return {f.path: f for f in parsed.files}
+
+
+class TestParsedPatch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        core.log_init('stdout', '')
+
+    def test_headers_only(self):
+        patch = Patch(HEADERS + MESSAGE + DIFFSTAT + DIFF_MODIFY)
+        self.assertIsNone(patch._parsed)
+        self.assertEqual(patch.subject, "[PATCH net v2 1/2] net: fix the thing which\n was broken")
+
+        parsed = patch.parsed
+        self.assertIs(patch.parsed, parsed)
+        self.assertEqual(parsed.headers['In-Reply-To'], "<cover@example.com>")
+        self.assertEqual(parsed.headers['Message-Id'], "<patch1@example.com>")
+        # Folded header lines are not the end of the headers
+        self.assertEqual(parsed.signed_off_by, ["Sub Mitter <sub@example.com>",
+                                                "Maint Ainer <maint@example.com>"])
+
+    def test_fixes(self):
+        parsed = Patch(HEADERS + MESSAGE + DIFFSTAT + DIFF_MODIFY).parsed
+        # Tags of the commit message only, not the notes or the diff
+        self.assertEqual(parsed.fixes, ['0123456789ab ("net: add the thing")',
+                                        'https://example.com/bug/1',
+                                        'fedcba987654 ("net: rework the thing")'])
+        self.assertEqual(parsed.fixes_commits, ['0123456789ab', 'fedcba987654'])
+
+        # Without the --- separator the message ends at the diff
+        parsed = Patch(HEADERS + "Fixes: 0123456789ab (\"x\")\n\n" + DIFF_MODIFY).parsed
+        self.assertEqual(parsed.fixes_commits, ['0123456789ab'])
+        self.assertEqual(list(_files(parsed)), ['drivers/net/foo.c'])
+
+    def test_modify(self):
+        parsed = Patch(HEADERS + MESSAGE + DIFFSTAT + DIFF_MODIFY).parsed
+        self.assertEqual(parsed.diffstat, [('drivers/net/foo.c', 4),
+                                           ('.../ethernet/vendor/long/path/to/file.c', 2),
+                                           ('scripts/run.sh', 0)])
+        foo = _files(parsed)['drivers/net/foo.c']
+        self.assertEqual(len(parsed.files), 1)
+        self.assertEqual((foo.status, foo.old_path), ('M', 'drivers/net/foo.c'))
+        self.assertEqual(foo.hunks, [(10, 4, 10, 6), (40, 1, 42, 1)])
+        # Removed "--" and added "--- " lines are part of the hunk
+        self.assertEqual((foo.added, foo.removed), (5, 3))
+        self.assertEqual(parsed.touched_files(), ['drivers/net/foo.c',
+                                                  '.../ethernet/vendor/long/path/to/file.c',
+                                                  'scripts/run.sh'])
+
+    def test_rename(self):
+        parsed = Patch(HEADERS + MESSAGE + DIFF_RENAME).parsed
+        files = _files(parsed)
+        self.assertEqual(list(files), ['net/new_name.c', 'net/core/moved.c'])
+        pure = files['net/new_name.c']
+        self.assertEqual((pure.status, pure.old_path, pure.hunks), ('R', 'net/old_name.c', []))
+        moved = files['net/core/moved.c']
+        self.assertEqual((moved.status, moved.old_path), ('R', 'net/moved.c'))
+        self.assertEqual((moved.added, moved.removed), (1, 1))
+        self.assertEqual(parsed.file_names(status='AMR'), ['net/new_name.c', 'net/core/moved.c'])
+        self.assertEqual(parsed.file_names(status='M'), [])
+        self.assertEqual(parsed.touched_files(), ['net/new_name.c', 'net/old_name.c',
+                                                  'net/core/moved.c', 'net/moved.c'])
+
+    def test_binary(self):
+        parsed = Patch(HEADERS + MESSAGE + DIFF_BINARY).parsed
+        files = _files(parsed)
+        self.assertEqual(list(files), ['Documentation/images/new.png', 'firmware/blob.bin'])
+        png = files['Documentation/images/new.png']
+        self.assertEqual((png.status, png.hunks, png.added, png.removed), ('A', [], 0, 0))
+        blob = files['firmware/blob.bin']
+        self.assertEqual((blob.status, blob.hunks), ('M', []))
+
+    def test_mode_add_delete(self):
+        parsed = Patch(HEADERS + MESSAGE + DIFF_MODE).parsed
+        files = _files(parsed)
+        self.assertEqual(list(files), ['scripts/run.sh', 'drivers/net/gone.c', 'drivers/net/new.c'])
+        mode = files['scripts/run.sh']
+        self.assertEqual((mode.status, mode.hunks, mode.added, mode.removed), ('M', [], 0, 0))
+        gone = files['drivers/net/gone.c']
+        self.assertEqual((gone.status, gone.removed), ('D', 2))
+        new = files['drivers/net/new.c']
+        self.assertEqual((new.status, new.added, new.hunks), ('A', 1, [(0, 0, 1, 1)]))
+        self.assertEqual(parsed.file_names(status='AM'), ['scripts/run.sh', 'drivers/net/new.c'])
+
+
+class TestParsedPatchUsers(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        core.log_init('stdout', '')
+
+    def test_renames_are_modified(self):
+        series = types.SimpleNamespace(patches=[Patch(HEADERS + MESSAGE + DIFF_RENAME + DIFF_MODE)])
+        new, mod = maintainers_files(series)
+        self.assertEqual(sorted(new), ['drivers/net/new.c'])
+        self.assertEqual(sorted(mod), ['net/core/moved.c', 'net/new_name.c', 'scripts/run.sh'])
+
+        rename = DIFF_RENAME.replace('net/', 'tools/testing/selftests/net/')
+        new, mod = selftest_files(Patch(HEADERS + MESSAGE + rename))
+        self.assertEqual(new, [])
+        self.assertEqual(sorted(mod), ['tools/testing/selftests/net/core/moved.c',
+                                       'tools/testing/selftests/net/new_name.c'])
+
+    def test_fixes_present(self):
+        tree = types.SimpleNamespace(pfx='net')
+        no_tags = HEADERS + "The thing was broken.\n\n"
+        # A Fixes line in the notes or the code is not a tag
+        notes = "---\nv2: Fixes: 0123456789ab (\"x\")\nFixes: 0123456789ab (\"x\")\n\n"
+        series = types.SimpleNamespace(patches=[Patch(no_tags + notes + DIFF_MODIFY)])
+        self.assertEqual(fixes_present(tree, series, None)[0], 1)
+
+        series = types.SimpleNamespace(patches=[Patch(HEADERS + MESSAGE + DIFF_MODIFY)])
+        self.assertEqual(fixes_present(tree, series, None)[0], 0)
+
+        # Renames count as touching files
+        docs = DIFF_RENAME.replace('net/', 'Documentation/networking/')
+        series = types.SimpleNamespace(patches=[Patch(no_tags + "---\n" + docs)])
+        self.assertEqual(fixes_present(tree, series, None),
+                         (0, "No Fixes tags, but series doesn't touch code"))
+        series = types.SimpleNamespace(patches=[Patch(no_tags + "---\n" + docs + DIFF_MODE)])
+        self.assertEqual(fixes_present(tree, series, None)[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
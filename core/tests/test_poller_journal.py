@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: GPL-2.0
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import core
+from pw_poller import PwPoller, SeriesJournal
+
+
+class FakePatchwork:
+    def __init__(self, broken):
+        self.broken = broken
+
+    def get(self, what, series_id):
+        if series_id in self.broken:
+            raise Exception("Patchwork is down")
+        return {'id': series_id, 'total': 1}
+
+
+class TestJournalRecovery(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        core.log_init('stdout', '')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.journal = os.path.join(self.path, 'poller.journal')
+        self.result_dir = os.path.join(self.path, 'results')
+        os.makedirs(self.result_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _crash(self):
+        """Journal of a poller which crashed while writing the last record"""
+        journal = SeriesJournal(self.journal)
+        journal.set_since('2026-01-01T00:00:00')
+        for sid in [1, 2, 3, 4, 5, 6]:
+            journal.received(sid, force_tree='net' if sid == 4 else None)
+        for sid in [1, 2, 3, 5, 6]:
+            journal.queued(sid, 'net-next')
+        journal.started(1)
+        journal.started(2)
+        journal.done(1)
+        # Received again, e.g. re-posted to the socket while queued
+        journal.received(3)
+        journal.queued(3, 'net-next')
+        # Tester finished 6 but we didn't record it
+        os.makedirs(os.path.join(self.result_dir, '6'))
+        with open(os.path.join(self.result_dir, '6', '.tester_done'), 'w'):
+            pass
+        journal.done(5)
+        journal._fp.close()
+
+        size = os.path.getsize(self.journal)
+        with open(self.journal, 'r+') as fp:
+            # Lose the end of the record marking 5 as done
+            fp.truncate(size - 10)
+
+    def _poller(self, broken=()):
+        poller = PwPoller.__new__(PwPoller)
+        poller.result_dir = self.result_dir
+        poller._journal = SeriesJournal(self.journal)
+        poller._in_flight = set()
+        poller._pw = FakePatchwork(broken)
+        poller.queued = []
+
+        def process(pw_series, force_tree):
+            poller._journal.queued(pw_series['id'], force_tree or 'net-next')
+            poller._in_flight.add(pw_series['id'])
+            poller.queued.append((pw_series['id'], force_tree))
+            return True
+
+        poller._process_series = process
+        return poller
+
+    def test_replay(self):
+        self._crash()
+
+        poller = self._poller(broken=[4])
+        self.assertEqual(poller._journal.since, '2026-01-01T00:00:00')
+        self.assertEqual(list(poller._journal.pending), [2, 3, 4, 5, 6])
+
+        poller.replay_journal()
+        # Unfinished series queued once each, the failed one stays pending
+        self.assertEqual(poller.queued, [(2, None), (3, None), (5, None)])
+        self.assertEqual(list(poller._journal.pending), [2, 3, 4, 5])
+        poller._journal._fp.close()
+
+        # Crash again before anything is tested, the failed one is retried
+        poller = self._poller()
+        self.assertEqual(list(poller._journal.pending), [2, 3, 4, 5])
+        poller.replay_journal()
+        self.assertEqual(poller.queued, [(2, None), (3, None), (4, 'net'), (5, None)])
+        poller._journal._fp.close()
+
+    def test_replay_done(self):
+        self._crash()
+
+        poller = self._poller()
+        poller.replay_journal()
+        for sid, _ in poller.queued:
+            poller._journal.done(sid)
+        poller._journal._fp.close()
+
+        poller = self._poller()
+        self.assertEqual(poller._journal.pending, {})
+        poller.replay_journal()
+        self.assertEqual(poller.queued, [])
+        poller._journal._fp.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+# SPDX-License-Identifier: GPL-2.0
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import core
+from core.result_cache import ResultCache, dir_hash
+
+
+TEST_SCRIPT = """\
+#!/bin/bash
+# Runs in the tree
+echo run >> ../runs
+echo "Output of the test"
+echo "Errors of the test" >&2
+echo "Found 2 warnings" >&$DESC_FD
+exit 250
+"""
+
+
+class FakeTree:
+    def __init__(self, path):
+        self.path = path
+        self.name = 'test'
+        self.branch = 'main'
+
+    def git(self, args):
+        env = dict(os.environ, GIT_AUTHOR_NAME='A', GIT_AUTHOR_EMAIL='a@a',
+                   GIT_COMMITTER_NAME='A', GIT_COMMITTER_EMAIL='a@a')
+        res = subprocess.run(['git'] + args, cwd=self.path, env=env, check=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return res.stdout.decode()
+
+    def commit(self, path, text):
+        with open(os.path.join(self.path, path), 'w') as fp:
+            fp.write(text)
+        self.git(['add', path])
+        self.git(['commit', '-q', '-m', 'change ' + path])
+
+
+class TestResultCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        core.log_init('stdout', '')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.path, 'cache'))
+
+        self.tree = FakeTree(os.path.join(self.path, 'tree'))
+        os.makedirs(self.tree.path)
+        self.tree.git(['init', '-q', '-b', 'main'])
+        self.tree.commit('a.c', 'int a;\n')
+        self.tree.commit('b.c', 'int b;\n')
+
+        self.tests = os.path.join(self.path, 'tests', 'patch')
+        os.makedirs(os.path.join(self.path, 'tests', 'lib'))
+        with open(os.path.join(self.path, 'tests', 'lib', 'lib.sh'), 'w') as fp:
+            fp.write('true\n')
+        self.test_dir = os.path.join(self.tests, 'cached')
+        os.makedirs(self.test_dir)
+        with open(os.path.join(self.test_dir, 'info.json'), 'w') as fp:
+            json.dump({"run": ["test.sh"], "cache": True}, fp)
+        with open(os.path.join(self.test_dir, 'test.sh'), 'w') as fp:
+            fp.write(TEST_SCRIPT)
+        os.chmod(os.path.join(self.test_dir, 'test.sh'), 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _key(self, name='build', env=None):
+        test_hash = dir_hash(self.test_dir, os.path.join(self.path, 'tests', 'lib'))
+        return ResultCache.key(name, test_hash, self.tree, env or {"BRANCH_BASE": "main"})
+
+    def _entries(self):
+        return [os.path.join(sub, key)
+                for sub in os.listdir(self.cache.path) if sub != '.last_prune'
+                for key in os.listdir(os.path.join(self.cache.path, sub))]
+
+    def test_key_inputs(self):
+        key = self._key()
+        after = self.tree.git(['rev-parse', 'HEAD^{tree}'])
+        self.assertEqual(self._key(), key)
+
+        keys = {key}
+        keys.add(self._key(name='other'))
+        keys.add(self._key(env={"BRANCH_BASE": "main", "FIRST_IN_SERIES": "1"}))
+        # Test definition and the shared libraries
+        with open(os.path.join(self.test_dir, 'test.sh'), 'a') as fp:
+            fp.write('# changed\n')
+        keys.add(self._key())
+        with open(os.path.join(self.path, 'tests', 'lib', 'lib.sh'), 'a') as fp:
+            fp.write('# changed\n')
+        keys.add(self._key())
+        # Tree after the patch
+        self.tree.git(['reset', '-q', '--hard', 'HEAD~'])
+        self.tree.commit('b.c', 'int b2;\n')
+        keys.add(self._key())
+        # Tree before the patch, same tree after
+        self.tree.git(['reset', '-q', '--hard', 'HEAD~'])
+        self.tree.commit('c.c', '')
+        self.tree.commit('b.c', 'int b;\n')
+        self.tree.git(['rm', '-q', 'c.c'])
+        self.tree.git(['commit', '-q', '--amend', '-m', 'add b.c, remove c.c'])
+        self.assertEqual(self.tree.git(['rev-parse', 'HEAD^{tree}']), after)
+        keys.add(self._key())
+
+        self.assertEqual(len(keys), 7)
+        for key in keys:
+            self.assertIsNone(self.cache.replay(key, os.path.join(self.path, 'out')))
+
+    def test_same_code_hits(self):
+        key = self._key()
+        # Same trees under different commits (e.g. re-posted series)
+        self.tree.git(['commit', '-q', '--amend', '-m', 'reposted'])
+        self.assertEqual(self._key(), key)
+
+    def test_replay(self):
+        test = core.Test(self.test_dir, 'cached', result_cache=self.cache)
+        results = [os.path.join(self.path, 'results', str(i)) for i in range(2)]
+        for result_dir in results:
+            os.makedirs(result_dir)
+            self.assertFalse(test.exec(self.tree, None, result_dir))
+
+        # Second run came from the cache
+        with open(os.path.join(self.path, 'runs')) as fp:
+            self.assertEqual(fp.read(), "run\n")
+        for name in ['retcode', 'desc', 'stdout', 'stderr']:
+            with open(os.path.join(results[0], 'cached', name)) as fp:
+                first = fp.read()
+            with open(os.path.join(results[1], 'cached', name)) as fp:
+                self.assertEqual(fp.read(), first)
+        with open(os.path.join(results[1], 'cached', 'retcode')) as fp:
+            self.assertEqual(fp.read(), "250")
+        with open(os.path.join(results[1], 'cached', 'desc')) as fp:
+            self.assertEqual(fp.read(), "Found 2 warnings\n")
+        with open(os.path.join(results[1], 'cached', 'metrics.json')) as fp:
+            self.assertTrue(json.load(fp)["cached"])
+
+    def test_concurrent_store(self):
+        key = self._key()
+        srcs = []
+        for i in range(8):
+            src = os.path.join(self.path, 'results', str(i))
+            os.makedirs(src)
+            for name in ['retcode', 'stdout', 'stderr']:
+                with open(os.path.join(src, name), 'w') as fp:
+                    fp.write(str(i) * 10000 if name != 'retcode' else str(i))
+            srcs.append(src)
+
+        start = threading.Barrier(len(srcs))
+
+        def store(src):
+            core.log_init('stdout', '')
+            start.wait()
+            self.cache.store(key, src)
+
+        threads = [threading.Thread(target=store, args=(src, )) for src in srcs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # One entry, no leftovers of the losers, contents of a single store
+        self.assertEqual(self._entries(), [os.path.join(key[:2], key)])
+        out = os.path.join(self.path, 'out')
+        retcode = self.cache.replay(key, out)
+        for name in ['stdout', 'stderr']:
+            with open(os.path.join(out, name)) as fp:
+                self.assertEqual(fp.read(), str(retcode) * 10000)
+
+    def _old_entry(self, name):
+        src = os.path.join(self.path, 'results', name)
+        os.makedirs(src)
+        with open(os.path.join(src, 'retcode'), 'w') as fp:
+            fp.write('0')
+        key = self._key(name=name)
+        self.cache.store(key, src)
+        past = time.time() - 3600
+        os.utime(os.path.join(self.cache.path, key[:2], key), (past, past))
+        return os.path.join(key[:2], key)
+
+    def test_prune(self):
+        old = self._old_entry('old')
+        self.cache.prune(60)
+        self.assertNotIn(old, self._entries())
+
+        # Pruned recently, by us or another user of the cache
+        old = self._old_entry('older')
+        self.cache.prune(60)
+        self.assertIn(old, self._entries())
+        other = ResultCache(self.cache.path)
+        other.prune(60)
+        self.assertIn(old, self._entries())
+
+        stamp = os.path.join(self.cache.path, '.last_prune')
+        past = time.time() - self.cache.prune_interval - 1
+        os.utime(stamp, (past, past))
+        other.prune(60)
+        self.assertNotIn(old, self._entries())
+        # Only old entries go
+        new = os.path.join(self.path, 'results', 'new')
+        os.makedirs(new)
+        self.cache.store(self._key(name='new'), new)
+        os.utime(stamp, (past, past))
+        self.cache.prune(60)
+        self.assertEqual(len(self._entries()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: GPL-2.0
+
+import configparser
+import os
+import sys
+import threading
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from core.scheduler import Scheduler, series_is_rfc
+
+
+def _series(name, patches=1, subject=None):
+    return types.SimpleNamespace(name=name, subject=subject or f"[PATCH net-next] {name}",
+                                 patches=[None] * patches)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        config = configparser.ConfigParser()
+        config.read_string("[scheduler]\nsiblings = net, net-next, bpf\n")
+        self.trees = {name: object() for name in ['net', 'net-next', 'bpf', 'other']}
+        self.sched = Scheduler(config, self.trees, fix_trees=['net'])
+
+    def _drain(self, name):
+        ret = []
+        while self.sched.qsize(name):
+            ret.append(self.sched.get(name).name)
+        return ret
+
+    def test_rfc(self):
+        self.assertTrue(series_is_rfc(_series('a', subject="[RFC PATCH net-next 0/3] a")))
+        self.assertTrue(series_is_rfc(_series('a', subject="[PATCH RFC v2] a")))
+        self.assertFalse(series_is_rfc(_series('a', subject="[PATCH net] RFC compliance")))
+
+    def test_order(self):
+        self.sched.put('net-next', _series('large', patches=15))
+        self.sched.put('net-next', _series('rfc', subject="[RFC net-next] rfc"))
+        self.sched.put('net-next', _series('small', patches=2))
+        self.sched.put('net-next', _series('small-later', patches=2))
+        self.assertEqual(self._drain('net-next'), ['small', 'small-later', 'large', 'rfc'])
+
+    def test_steal_prefers_fixes(self):
+        self.sched.put('net-next', _series('feature'))
+        self.sched.put('net', _series('fix'))
+        self.sched.put('net-next', _series('feature-later'))
+
+        # Own queue first
+        self.assertEqual(self.sched.get('net-next').name, 'feature')
+        # Idle tester of a sibling picks the best series of all siblings
+        self.assertEqual(self.sched.get('bpf').name, 'fix')
+        self.assertEqual(self.sched.get('bpf').name, 'feature-later')
+        stats = self.sched.stats()
+        self.assertEqual(stats['net']['stolen'], 1)
+        self.assertEqual(stats['net-next']['stolen'], 1)
+        self.assertEqual(stats['net-next']['done'], 2)
+
+    def test_no_steal_outside_siblings(self):
+        self.sched.put('net', _series('fix'))
+        got = []
+        tester = threading.Thread(target=lambda: got.append(self.sched.get('other')))
+        tester.start()
+        tester.join(0.1)
+        self.assertTrue(tester.is_alive())
+        self.assertEqual(self.sched.qsize('net'), 1)
+
+        self.sched.put('other', None)
+        tester.join()
+        self.assertEqual(got, [None])
+
+    def test_stop_one(self):
+        got = []
+        lock = threading.Lock()
+
+        def tester():
+            series = self.sched.get('net')
+            with lock:
+                got.append(series)
+
+        testers = [threading.Thread(target=tester) for _ in range(3)]
+        for t in testers:
+            t.start()
+
+        self.sched.put('net', None)
+        for _ in range(100):
+            with lock:
+                if got:
+                    break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        # Exactly one exits
+        self.assertEqual(got, [None])
+        self.assertEqual(sum(t.is_alive() for t in testers), 2)
+
+        self.sched.put('net', _series('fix'))
+        self.sched.put('net', None)
+        for t in testers:
+            t.join()
+        self.assertEqual([getattr(s, 'name', None) for s in got[1:]].count('fix'), 1)
+        self.assertEqual(got.count(None), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+# SPDX-License-Identifier: GPL-2.0
+
+import os
+import re
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import core
+import netdev.tree_match
+import wireless.tree_match
+from core.patch import Patch
+from core.path_classifier import PathClassifier, REQUIRED, ACCEPTABLE, EXCLUDED, FOREIGN
+
+
+def _old_match_dotted(pfx, fn):
+    dirs = pfx.split('/')
+    while True:
+        dirs.pop(0)
+        dotted = '.../' + '/'.join(dirs)
+        if dotted == '.../':
+            return False
+
+        if fn.startswith(dotted):
+            return True
+
+
+def _old_should_be_local(module, raw_email):
+    """Per-pattern matching the prefix trie replaced, as reference"""
+    all_files = module._acceptable_files.union(module._required_files)
+    required_found = False
+    foreign_found = False
+
+    r_diffstat = re.compile(r'^\s*([-\w/._,]+)\s+\|\s+\d+\s*[-+]*\s*$')
+    r_header = re.compile(r'\+\+\+ b/([-\w/._,]+)$')
+    for line in raw_email.split('\n'):
+        match = r_header.match(line)
+        if not match:
+            match = r_diffstat.match(line)
+        if not match:
+            continue
+
+        file_name = match.group(1)
+        if file_name.startswith('.../'):
+            compare = _old_match_dotted
+        else:
+            compare = lambda pfx, fn: fn.startswith(pfx)
+
+        if any(compare(fn, file_name) for fn in module._excluded_files):
+            foreign_found = True
+            continue
+        found = False
+        for fn in all_files:
+            if compare(fn, file_name):
+                found = True
+                required_found = required_found or fn in module._required_files
+        if not found:
+            foreign_found = True
+
+    if not required_found:
+        return False
+    if foreign_found:
+        return None
+    return True
+
+
+def _old_needs_async(s):
+    bad_files = {
+        'net/sock.h',
+        'net/tcp.h',
+        'linux/bpf.h',
+        'linux/netdevice.h',
+        'linux/sock',
+        'linux/tcp.h'
+    }
+    for p in s.patches:
+        for needle in bad_files:
+            if p.raw_patch.find(needle) > 0:
+                return True
+    return False
+
+
+def _raw(files, body="change", diff_line="+\tnew = 1;"):
+    """Patch touching files, names starting with '.../' only show up in the diffstat,
+    as when diffstat abbreviates a long path"""
+    raw = f"Subject: [PATCH net-next] test\nFrom: A <a@a>\n\n{body}\n\n"
+    raw += "Signed-off-by: A <a@a>\n---\n"
+    for name in files:
+        raw += f" {name} | 2 +-\n"
+    raw += f" {len(files)} files changed, {len(files)} insertions(+), {len(files)} deletions(-)\n\n"
+    for name in files:
+        if name.startswith('.../'):
+            continue
+        raw += f"diff --git a/{name} b/{name}\n--- a/{name}\n+++ b/{name}\n"
+        raw += f"@@ -1,2 +1,2 @@\n ctx\n-\told = 1;\n{diff_line}\n"
+    return raw
+
+
+# File names, and their class under the netdev and wireless tables
+FILES = [
+    ('net/core/dev.c', REQUIRED, FOREIGN),
+    ('net/ceph/messenger.c', EXCLUDED, FOREIGN),
+    ('net/cephx.c', EXCLUDED, FOREIGN),
+    ('net/sunrpc/xprt.c', EXCLUDED, FOREIGN),
+    ('net/mac80211/rx.c', REQUIRED, REQUIRED),
+    ('net/wireless/nl80211.c', REQUIRED, REQUIRED),
+    ('drivers/net/ethernet/intel/e1000/e1000_main.c', REQUIRED, FOREIGN),
+    ('drivers/net/wireless/ath/ath11k/mac.c', REQUIRED, REQUIRED),
+    ('include/linux/netdevice.h', REQUIRED, ACCEPTABLE),
+    ('include/linux/netfilter.h', REQUIRED, ACCEPTABLE),
+    ('include/linux/ieee80211-ht.h', ACCEPTABLE, REQUIRED),
+    ('include/net/mac80211.h', REQUIRED, REQUIRED),
+    ('include/linux/mm.h', ACCEPTABLE, ACCEPTABLE),
+    ('Documentation/networking/ip-sysctl.rst', REQUIRED, ACCEPTABLE),
+    ('Documentation/admin-guide/README.rst', ACCEPTABLE, ACCEPTABLE),
+    ('MAINTAINERS', ACCEPTABLE, ACCEPTABLE),
+    ('lib/test_bpf.c', REQUIRED, REQUIRED),
+    ('kernel/bpf/verifier.c', REQUIRED, FOREIGN),
+    ('kernel/trace/bpf_trace.c', REQUIRED, FOREIGN),
+    ('kernel/sched/core.c', FOREIGN, FOREIGN),
+    ('tools/testing/selftests/net/forwarding/lib.sh', REQUIRED, ACCEPTABLE),
+    ('tools/testing/selftests/bpf/progs/test.c', ACCEPTABLE, ACCEPTABLE),
+    ('drivers/gpu/drm/drm_drv.c', FOREIGN, FOREIGN),
+    # Abbreviated by diffstat, matched by prefixes with leading directories
+    # dropped; the '.../' entry of the acceptable tables itself never matches
+    ('.../ethernet/intel/e1000/e1000_main.c', REQUIRED, FOREIGN),
+    ('.../wireless/ath/ath11k/mac.c', FOREIGN, REQUIRED),
+    ('.../net/forwarding/lib.sh', REQUIRED, FOREIGN),
+    ('.../gpu/drm/drm_drv.c', FOREIGN, FOREIGN),
+]
+
+# Combinations of the files above, files touched by one patch
+COMBOS = [
+    ['net/core/dev.c', 'include/linux/netdevice.h'],
+    ['net/core/dev.c', 'kernel/sched/core.c'],
+    ['net/core/dev.c', 'net/ceph/messenger.c'],
+    ['MAINTAINERS', 'include/linux/mm.h'],
+    ['kernel/sched/core.c', 'drivers/gpu/drm/drm_drv.c'],
+    ['drivers/net/wireless/ath/ath11k/mac.c', 'include/net/mac80211.h',
+     'Documentation/admin-guide/README.rst'],
+    ['.../wireless/ath/ath11k/mac.c', 'net/mac80211/rx.c'],
+    ['.../gpu/drm/drm_drv.c', 'kernel/sched/core.c'],
+    ['include/linux/ieee80211-ht.h', 'net/sunrpc/xprt.c'],
+]
+
+MODULES = [(netdev.tree_match, 1), (wireless.tree_match, 2)]
+
+
+class TestTreeMatch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        core.log_init('stdout', '')
+
+    def test_classes(self):
+        for module, col in MODULES:
+            classifier = PathClassifier(required=module._required_files,
+                                        acceptable=module._acceptable_files,
+                                        excluded=module._excluded_files)
+            for entry in FILES:
+                with self.subTest(module=module.__name__, file=entry[0]):
+                    self.assertEqual(classifier.classify(entry[0]), entry[col])
+
+    def test_same_as_per_pattern(self):
+        cases = [[entry[0]] for entry in FILES] + COMBOS
+        for module, _ in MODULES:
+            for files in cases:
+                with self.subTest(module=module.__name__, files=files):
+                    raw = _raw(files)
+                    verdict, classes = module._tree_name_should_be_local_files(Patch(raw))
+                    self.assertEqual(verdict, _old_should_be_local(module, raw))
+                    self.assertEqual(sorted(sum(classes.values(), [])), sorted(files))
+
+    def test_series(self):
+        series = types.SimpleNamespace(patches=[Patch(_raw(['net/core/dev.c'])),
+                                                Patch(_raw(['kernel/sched/core.c']))])
+        self.assertEqual(netdev.tree_match.series_tree_name_should_be_local(series),
+                         (False, True))
+        series.patches[1] = Patch(_raw(['net/core/dev.c', 'kernel/sched/core.c']))
+        self.assertEqual(netdev.tree_match.series_tree_name_should_be_local(series),
+                         (None, True))
+
+    def test_needs_async(self):
+        # File names, the only thing which counts now
+        for files, expected in [(['include/net/tcp.h'], True),
+                                (['include/linux/netdevice.h', 'net/core/dev.c'], True),
+                                (['include/linux/sockptr.h'], True),
+                                (['tools/include/uapi/linux/bpf.h'], True),
+                                (['net/core/dev.c'], False),
+                                (['include/net/tcp_ao.h'], False)]:
+            with self.subTest(files=files):
+                series = types.SimpleNamespace(patches=[Patch(_raw(files))])
+                self.assertEqual(netdev.tree_match.series_needs_async(series), expected)
+                self.assertEqual(_old_needs_async(series), expected)
+                self.assertFalse(wireless.tree_match.series_needs_async(series))
+
+        # Headers mentioned in the commit message or the contents of the
+        # diff no longer count, the old check searched the whole email
+        for raw in [_raw(['net/core/dev.c'], body="Like in net/tcp.h, move the helper"),
+                    _raw(['net/ipv4/tcp.c'], diff_line="+#include <linux/tcp.h>")]:
+            series = types.SimpleNamespace(patches=[Patch(raw)])
+            self.assertFalse(netdev.tree_match.series_needs_async(series))
+            self.assertTrue(_old_needs_async(series))
+
+
+if __name__ == '__main__':
+    unittest.main()
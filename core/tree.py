@@ -4,9 +4,11 @@
 
 """ The git tree module """
 
+import hashlib
 import multiprocessing
 import os
 import tempfile
+import threading
 import time
 from typing import List
 
@@ -33,25 +35,185 @@ class WorktreeNesting(Exception):
     pass
 
 
+class CommitTitleIndex:
+    """Index of commit subjects of the last commits of a branch
+
+    The index is updated incrementally, only commits added since the last
+    update are walked, as long as the branch was fast-forwarded.
+    """
+    def __init__(self, branch, depth=1000):
+        self.branch = branch
+        self.depth = depth
+        self.tip = None
+        self.titles = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(title):
+        return ' '.join(title.split())
+
+    def update(self, tree):
+        tip = tree.git(['rev-parse', self.branch]).strip()
+
+        with self._lock:
+            if tip == self.tip:
+                return
+
+            incremental = self.tip and len(self.titles) < 2 * self.depth
+            if incremental:
+                try:
+                    tree.git_merge_base(self.tip, tip, is_ancestor=True)
+                except CMD.CmdError:
+                    incremental = False
+
+            if incremental:
+                rev_range = [f'{self.tip}..{tip}']
+            else:
+                rev_range = [f'-{self.depth}', tip]
+                self.titles = {}
+
+            out = tree.git(['log', '--format=%H %s'] + rev_range)
+            for line in out.split('\n'):
+                if not line:
+                    continue
+                commit, title = line.split(' ', 1)
+                self.titles.setdefault(self.normalize(title), commit)
+            self.tip = tip
+
+        core.log(f"Title index for {self.branch} at {tip}, {len(self.titles)} commits", "")
+
+    def find(self, title):
+        return self.titles.get(self.normalize(title))
+
+
+class FetchCoordinator:
+    """Coordinates fetches of all Tree objects of a repo
+
+    Concurrent fetches of the same remote are coalesced into one.
+    A fetch is skipped if the previous successful one completed less
+    than freshness seconds ago. When fetching fails but an earlier fetch
+    succeeded callers proceed with the last good refs, and the fetch is
+    retried by the next caller after retry_delay seconds. Only when there
+    was no successful fetch yet callers block and retry. Callers waiting
+    for an in-flight fetch share its outcome, if it failed they proceed with
+    the last good refs or get its error, they don't start fetches of
+    their own.
+    """
+    def __init__(self, freshness=0, retries=10, retry_delay=30):
+        self.freshness = freshness
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._cond = threading.Condition()
+        self._in_flight = set()
+        self._last_ok = {}
+        self._next_try = {}
+        # Exception the last fetch of the remote failed with, None if it succeeded
+        self._error = {}
+
+    def _can_skip(self, remote):
+        now = time.monotonic()
+        if remote not in self._last_ok:
+            return False
+        if now - self._last_ok[remote] < self.freshness:
+            core.log(f"Skipping fetch of {remote}, fetched {now - self._last_ok[remote]:.0f}s ago", "")
+            return True
+        if now < self._next_try.get(remote, 0):
+            core.log(f"Skipping fetch of {remote}, recently failed, using last good refs", "")
+            return True
+        return False
+
+    def fetch(self, tree, remote):
+        with self._cond:
+            if remote in self._in_flight:
+                core.log(f"Waiting for in-flight fetch of {remote}", "")
+                while remote in self._in_flight:
+                    self._cond.wait()
+                err = self._error.get(remote)
+                if err is None:
+                    return
+                if remote in self._last_ok:
+                    core.log(f"In-flight fetch of {remote} failed, using last good refs", "")
+                    return
+                raise err
+            elif self._can_skip(remote):
+                return
+            self._in_flight.add(remote)
+
+        ok = False
+        err = None
+        try:
+            ok = self._fetch(tree, remote)
+        except Exception as e:
+            err = e
+            raise
+        finally:
+            with self._cond:
+                self._in_flight.remove(remote)
+                if ok:
+                    self._last_ok[remote] = time.monotonic()
+                    self._error[remote] = None
+                else:
+                    self._next_try[remote] = time.monotonic() + self.retry_delay
+                    self._error[remote] = err or Exception(f"Fetching {remote} failed")
+                self._cond.notify_all()
+
+    def _fetch(self, tree, remote):
+        # Single attempt if we have something to fall back on
+        retries = 1 if remote in self._last_ok else self.retries
+        for i in range(retries):
+            try:
+                tree.git(['fetch', remote], repo_wide=True)
+                return True
+            except CMD.CmdError as e:
+                core.log(f"Fetching failed (attempt {i + 1})", repr(e))
+                if retries == 1:
+                    return False
+                if i >= retries - 1:
+                    raise
+                time.sleep(self.retry_delay)
+        return False
+
+
 class Tree:
     """The git tree class
 
     Git tree class which controls a git tree
 
     current_branch: use whathever is currently checked out as branch
+    fetch_freshness: skip fetches if the remote was fetched less than
+                     this many seconds ago
     """
     def __init__(self, name, pfx, fspath, remote=None, branch=None,
-                 wt_id=None, parent=None, current_branch=False):
+                 wt_id=None, parent=None, current_branch=False, fetch_freshness=0):
         self.name = name
         self.pfx = pfx
         self.path = os.path.abspath(fspath)
         self.remote = remote
         self.branch = branch
+        self.parent = parent
 
+        # Operations on the shared object store / refs (fetch, worktree add)
+        # take the repo-wide lock, everything else uses the per-worktree lock.
+        # The lock order is always: worktree lock, then repo lock.
         if parent:
-            self.lock = parent.lock
+            self.repo_lock = parent.repo_lock
         else:
-            self.lock = multiprocessing.RLock()
+            self.repo_lock = multiprocessing.RLock()
+        self.lock = multiprocessing.RLock()
+        # Total time spent waiting for locks, in seconds
+        self.lock_wait = 0.0
+
+        # Commit title indexes are per branch, shared by all worktrees
+        # as are the commit reachability caches
+        if parent:
+            self._title_indexes = parent._title_indexes
+            self._reach_caches = parent._reach_caches
+            self.fetcher = parent.fetcher
+        else:
+            self._title_indexes = {}
+            self._reach_caches = {}
+            self.fetcher = FetchCoordinator(freshness=fetch_freshness)
 
         if current_branch:
             self.branch = self.current_branch()
@@ -60,6 +222,7 @@ class Tree:
 
         self._wt_id = wt_id
         self._saved_path = None
+        self._state_dir = None
 
         self._check_tree()
 
@@ -71,16 +234,41 @@ class Tree:
         name = f'wt-{worker_id}'
         new_path = os.path.join(self.path, name)
         if not os.path.exists(new_path):
-            self.git(["worktree", "add", name])
+            self.git(["worktree", "add", name], repo_wide=True)
 
         new_name = self.name + f'-{worker_id}'
         return Tree(new_name, self.pfx, new_path, self.remote, self.branch,
                     wt_id=worker_id, parent=self)
 
-    def git(self, args: List[str]):
-        self.lock.acquire(timeout=300)
+    def lane_tree(self, lane):
+        # Create a sibling worktree of this worktree, used to run
+        # independent tests of the same series in parallel
+        if not self.parent:
+            raise Exception(f"Tree {self.name} is not a worktree")
+        return self.parent.work_tree(f'{self._wt_id}-{lane}')
+
+    def _lock_acquire(self, lock, name):
+        # Running git without the lock could corrupt the worktree or refs,
+        # keep waiting, but make long waits visible
+        start = time.monotonic()
+        while not lock.acquire(timeout=300):
+            core.log(f"Still waiting for {name} lock after {time.monotonic() - start:.0f}s", "")
+        wait = time.monotonic() - start
+
+        self.lock_wait += wait
+        if wait > 1:
+            core.log(f"Waited {wait:.1f}s for {name} lock", "")
+
+    def git(self, args: List[str], repo_wide=False):
+        self._lock_acquire(self.lock, "worktree")
         try:
-            return CMD.cmd_run(["git"] + args, cwd=self.path)
+            if repo_wide:
+                self._lock_acquire(self.repo_lock, "repo")
+            try:
+                return CMD.cmd_run(["git"] + args, cwd=self.path)
+            finally:
+                if repo_wide:
+                    self.repo_lock.release()
         finally:
             self.lock.release()
 
@@ -118,14 +306,7 @@ class Tree:
         return self.git(cmd)
 
     def git_fetch(self, remote):
-        for i in range(10):
-            try:
-                return self.git(['fetch', remote])
-            except CMD.CmdError as e:
-                core.log(f"Fetching failed (attempt {i + 1})", repr(e))
-                time.sleep(30)
-                if i >= 9:
-                    raise
+        return self.fetcher.fetch(self, remote)
 
     def git_reset(self, target, hard=False):
         cmd = ['reset', target]
@@ -160,6 +341,14 @@ class Tree:
     def head_hash(self):
         return self.git(['rev-parse', 'HEAD']).strip()
 
+    def state_dir(self):
+        """Directory for state kept by tests and indexes of the repo,
+        shared by all its worktrees (nipa/ in the git common dir)"""
+        if self._state_dir is None:
+            common = self.git(['rev-parse', '--git-common-dir']).strip()
+            self._state_dir = os.path.realpath(os.path.join(self.path, common, 'nipa'))
+        return self._state_dir
+
     def reset(self, fetch=None):
         core.log_open_sec("Reset tree " + self.name)
         try:
@@ -187,37 +376,76 @@ class Tree:
         return result
 
     def contains(self, commit):
-        core.log_open_sec("Checking for commit " + commit)
+        return self.contains_all([commit])[commit]
+
+    def contains_all(self, commits):
+        """Check which of the commits are reachable from the branch
+
+        Fetches the tree once and checks all commits with a single git
+        call. Results are cached until the branch tip moves.
+
+        Returns dict mapping each commit to True / False.
+        """
+        core.log_open_sec("Checking for commits " + ' '.join(commits))
         try:
-            self.reset()
-            self.git_merge_base(commit, 'HEAD', is_ancestor=True)
-            ret = True
-        except CMD.CmdError:
-            ret = False
+            if self.remote:
+                self.git_fetch(self.remote)
+            tip = self.git(['rev-parse', self.branch]).strip()
+
+            cache = self._reach_caches.get(self.branch)
+            if cache is None or cache['tip'] != tip:
+                cache = {'tip': tip, 'commits': {}}
+                self._reach_caches[self.branch] = cache
+
+            todo = [c for c in commits if c not in cache['commits']]
+            core.log(f"Cached {len(commits) - len(todo)}, checking {len(todo)}", "")
+            if todo:
+                # Unknown hashes are skipped by name-rev, so default to False
+                found = dict.fromkeys(todo, False)
+                out = self.git(['name-rev', f'--refs={self.branch}'] + todo)
+                for line in out.split('\n'):
+                    bits = line.split()
+                    if len(bits) == 2 and bits[0] in found:
+                        found[bits[0]] = bits[1] != 'undefined'
+                cache['commits'].update(found)
+
+            ret = {c: cache['commits'][c] for c in commits}
+            core.log("Result", ret)
         finally:
             core.log_end_sec()
 
         return ret
 
-    def _find_patch(self, patch):
-        out = self.git_find_patch(patch.title)
-        return out
+    def title_index(self):
+        idx = self._title_indexes.get(self.branch)
+        if idx is None:
+            idx = CommitTitleIndex(self.branch)
+            self._title_indexes[self.branch] = idx
+        idx.update(self)
+        return idx
 
     def is_applied(self, thing):
-        ret = True
+        """Check if patches with the same titles are already in the branch"""
+        idx = self.title_index()
 
         if isinstance(thing, Patch):
-            ret &= bool(self._find_patch(thing))
+            patches = [thing]
         elif hasattr(thing, "patches"):
-            for patch in thing.patches:
-                ret &= bool(self._find_patch(patch))
+            patches = thing.patches
+        else:
+            patches = []
 
+        ret = True
+        for patch in patches:
+            ret &= bool(idx.find(patch.title))
         return ret
 
     def check_already_applied(self, thing):
         core.log_open_sec("Checking if applied " + thing.title)
         try:
-            self.reset()
+            # Index is built from the branch, not HEAD, no need to reset
+            if self.remote:
+                self.git_fetch(self.remote)
             ret = self.is_applied(thing)
         finally:
             core.log_end_sec()
@@ -240,6 +468,70 @@ class Tree:
                 pass
             raise PatchApplyError(e.stderr) from e
 
+    @staticmethod
+    def _chain_ref(base, patches):
+        h = hashlib.sha256(base.encode())
+        for patch in patches:
+            h.update(hashlib.sha256(patch.raw_patch.encode()).digest())
+        return 'refs/nipa/chains/' + h.hexdigest()
+
+    def apply_chain(self, series, base):
+        """Apply the series on top of base, reusing a previously built chain.
+
+        Commits created by applying a series are recorded under a ref keyed
+        by the base commit and the contents of the patches. The ref lives in
+        the shared object store so the chain is reused by all worktrees of
+        the repo, and by retests of the same series.
+
+        Returns list of commit hashes, normally one for each patch of the
+        series; a cached chain of the wrong length is rebuilt, but git am may
+        still not create a commit for every patch.
+        """
+        ref = self._chain_ref(base, series.patches)
+
+        core.log_open_sec("Applying chain " + series.title)
+        try:
+            try:
+                tip = self.git(['rev-parse', '--verify', '-q', ref]).strip()
+            except CMD.CmdError:
+                tip = None
+
+            if tip:
+                commits = self.git(['rev-list', '--reverse', f'{base}..{tip}']).split()
+                if len(commits) == len(series.patches):
+                    core.log("Reusing cached chain", ref)
+                    self.git_reset(tip, hard=True)
+                    return commits
+                core.log("Cached chain doesn't match the series, rebuilding",
+                         f"{ref}: {len(commits)} commits, {len(series.patches)} patches")
+
+            self.git_reset(base, hard=True)
+            self.apply(series)
+            self.git(['update-ref', ref, 'HEAD'])
+
+            commits = self.git(['rev-list', '--reverse', f'{base}..HEAD']).split()
+        finally:
+            core.log_end_sec()
+
+        return commits
+
+    def prune_chains(self, max_age):
+        """Remove cached commit chains older than max_age seconds"""
+        cutoff = time.time() - max_age
+
+        out = self.git(['for-each-ref', '--format=%(refname) %(committerdate:unix)',
+                        'refs/nipa/chains/'])
+        for line in out.split('\n'):
+            if not line:
+                continue
+            ref, ts = line.split()
+            if int(ts) > cutoff:
+                continue
+            try:
+                self.git(['update-ref', '-d', ref])
+            except CMD.CmdError:
+                pass  # somebody else pruned it already
+
     def apply(self, thing):
         if isinstance(thing, Patch):
             self._apply_patch_safe(thing)
@@ -253,7 +545,11 @@ class Tree:
         core.log_open_sec("Test-applying " + thing.title)
         try:
             self.reset()
-            self.apply(thing)
+            if hasattr(thing, "patches"):
+                # Seed the chain cache, testers will likely use the same base
+                self.apply_chain(thing, self.head_hash())
+            else:
+                self.apply(thing)
             ret = True
         except PatchApplyError:
             ret = False
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0
+
+"""Compare the native get_maintainer with scripts/get_maintainer.pl
+
+Runs both implementations on a corpus of patches, either patch files or
+the commits of a range in the tree (formatted with git format-patch), and
+reports the patches for which the addresses (and optionally the roles)
+differ. Exits with 1 if any patch differs.
+
+The patches are not applied, both implementations look at the tree as it
+is checked out, so use a tree which is not being used by a tester.
+"""
+
+import argparse
+import re
+import subprocess
+import sys
+
+from core import Patch
+from core import Tree
+from core import log_init
+from core.get_maintainer import get_maintainer
+
+emailpat = re.compile(r'([^ <"]*@[^ >"]*)')
+
+
+def parse_output(lines):
+    """Output lines to a dict of address -> roles"""
+    ret = {}
+    for line in lines:
+        match = emailpat.search(line)
+        if not match:
+            continue
+        roles = ''
+        if line.endswith(')') and ' (' in line:
+            roles = line[line.rindex(' (') + 2:-1]
+        ret[match.group(1).lower()] = roles
+    return ret
+
+
+def range_patches(tree_path, rev_range):
+    shas = subprocess.run(['git', 'rev-list', '--reverse', '--no-merges', rev_range],
+                          cwd=tree_path, stdout=subprocess.PIPE, check=True)
+    for sha in shas.stdout.decode().split():
+        raw = subprocess.run(['git', 'format-patch', '-1', '--stdout', sha],
+                             cwd=tree_path, stdout=subprocess.PIPE, check=True)
+        yield sha[:12], raw.stdout.decode('utf-8', 'replace')
+
+
+def file_patches(paths):
+    for path in paths:
+        with open(path, 'r', errors='replace') as fp:
+            yield path, fp.read()
+
+
+def compare(tree, name, raw, min_percent, roles):
+    patch = Patch(raw)
+    script = parse_output(get_maintainer(tree, patch, 'script', min_percent))
+    native = parse_output(get_maintainer(tree, patch, 'native', min_percent))
+
+    diff = []
+    for addr in sorted(set(script) | set(native)):
+        if addr not in native:
+            diff.append(f"  only script: {addr} ({script[addr]})")
+        elif addr not in script:
+            diff.append(f"  only native: {addr} ({native[addr]})")
+        elif roles and script[addr] != native[addr]:
+            diff.append(f"  roles of {addr}: script ({script[addr]}) native ({native[addr]})")
+
+    if diff:
+        print(f"{name}: {patch.title or patch.subject}")
+        print('\n'.join(diff))
+    return not diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tree', required=True, help='path to the kernel tree')
+    parser.add_argument('--branch', help='upstream branch of the tree, indexed by the native '
+                                         'implementation (default: none, index up to HEAD)')
+    parser.add_argument('--min-percent', type=int, default=35,
+                        help='--git-min-percent to run with (default: 35, as cc_maintainers)')
+    parser.add_argument('--roles', action='store_true',
+                        help='also report differences in the roles of the addresses')
+    parser.add_argument('--range', help='compare on the commits of this range of the tree')
+    parser.add_argument('--log', default='get_maintainer_parity.org',
+                        help='log file (default: get_maintainer_parity.org)')
+    parser.add_argument('patches', nargs='*', help='patch files to compare on')
+    args = parser.parse_args()
+
+    if not args.range and not args.patches:
+        parser.error("Need a --range or patch files")
+
+    log_init('org', args.log)
+    tree = Tree('parity', 'parity', args.tree, branch=args.branch)
+
+    corpus = file_patches(args.patches)
+    if args.range:
+        corpus = range_patches(tree.path, args.range)
+
+    total = 0
+    same = 0
+    for name, raw in corpus:
+        total += 1
+        same += compare(tree, name, raw, args.min_percent, args.roles)
+
+    print(f"{same} of {total} patches identical")
+    sys.exit(0 if same == total else 1)
+
+
+if __name__ == "__main__":
+    main()
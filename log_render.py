@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-2.0
+
+"""Render a JSONL log into the org or xml log format
+
+Takes a log written with [log] type = jsonl, possibly one of its rotated
+and xz-compressed parts, and writes it out in the format of the org or
+xml logger.
+"""
+
+import argparse
+import os
+
+from core import log_render
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('src', help='JSONL log, .xz compressed logs are decompressed')
+    parser.add_argument('--format', choices=['org', 'xml'], default='org',
+                        help='format to render in (default: org)')
+    parser.add_argument('--out', help='output file (default: source name with the '
+                                      'extension of the format)')
+    args = parser.parse_args()
+
+    out = args.out
+    if not out:
+        base = args.src[:-3] if args.src.endswith('.xz') else args.src
+        out = os.path.splitext(base)[0] + '.' + args.format
+    if os.path.abspath(out) == os.path.abspath(args.src):
+        parser.error("Output would overwrite the source log")
+
+    log_render(args.src, args.format, out)
+
+
+if __name__ == "__main__":
+    main()
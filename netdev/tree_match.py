@@ -6,7 +6,8 @@
 
 import re
 
-from core import log, log_open_sec, log_end_sec
+from core import log
+from core.path_classifier import PathClassifier, EXCLUDED, FOREIGN
 
 
 def series_tree_name_direct(conf_trees, series):
@@ -15,143 +16,88 @@ def series_tree_name_direct(conf_trees, series):
             return t
 
 
-def _file_name_match_start(pfx, fn):
-    return fn.startswith(pfx)
-
-
-def _file_name_match_dotted(pfx, fn):
-    dirs = pfx.split('/')
-    while True:
-        dirs.pop(0)
-        dotted = '.../' + '/'.join(dirs)
-        if dotted == '.../':
-            return False
-
-        if fn.startswith(dotted):
-            return True
-
-
-def _tree_name_should_be_local_files(raw_email):
+_acceptable_files = {
+    '.../',
+    'CREDITS',
+    'MAINTAINERS',
+    'Documentation/',
+    'include/',
+    'rust/',
+    'tools/',
+    'drivers/phy/',
+    'drivers/vhost/',
+}
+_required_files = {
+    'Documentation/devicetree/bindings/net/',
+    'Documentation/netlink/',
+    'Documentation/networking/',
+    'include/uapi/linux/nfc.h',
+    'include/linux/ethtool.h',
+    'include/linux/firmware/broadcom/tee_bnxt_fw.h',
+    'include/linux/genetlink.h',
+    'include/linux/netdevice.h',
+    'include/linux/net',
+    'include/linux/phy.h',
+    'include/linux/rtnetlink.h',
+    'include/linux/skbuff.h',
+    'include/net/',
+    'include/phy/',
+    # lib/ is pretty broad but patch volume is low
+    'lib/',
+    'net/',
+    'drivers/atm/',
+    'drivers/bluetooth/',
+    'drivers/dibs/',
+    'drivers/dpll/',
+    'drivers/firmware/broadcom/tee_bnxt_fw.c',
+    'drivers/isdn/',
+    'drivers/net/',
+    'drivers/dsa/',
+    'drivers/nfc/',
+    'drivers/ptp/',
+    'drivers/net/ethernet/',
+    'drivers/usb/atm/',
+    'kernel/bpf/',
+    'tools/net/',
+    'tools/testing/selftests/drivers/net/',
+    'tools/testing/selftests/tc-testing/',
+    'tools/testing/selftests/net/',
+
+    'kernel/trace/bpf_trace.c',
+    'drivers/leds/trigger/ledtrig-netdev.c',
+}
+_excluded_files = {
+    'net/ceph',
+    'net/sunrpc',
+}
+_classifier = PathClassifier(required=_required_files,
+                             acceptable=_acceptable_files,
+                             excluded=_excluded_files)
+
+
+def _tree_name_should_be_local_files(patch):
     """
-    Returns True: patch should have been explicitly designated for local tree
+    Returns tuple of the verdict and the patch's files by class, the verdict is
+            True: patch should have been explicitly designated for local tree
             False: patch has nothing to do with local trees
             None: patch has mixed contents, it touches local code, but also code outside
     """
-    acceptable_files = {
-        '.../',
-        'CREDITS',
-        'MAINTAINERS',
-        'Documentation/',
-        'include/',
-        'rust/',
-        'tools/',
-        'drivers/phy/',
-        'drivers/vhost/',
-    }
-    required_files = {
-        'Documentation/devicetree/bindings/net/',
-        'Documentation/netlink/',
-        'Documentation/networking/',
-        'include/uapi/linux/nfc.h',
-        'include/linux/ethtool.h',
-        'include/linux/firmware/broadcom/tee_bnxt_fw.h',
-        'include/linux/genetlink.h',
-        'include/linux/netdevice.h',
-        'include/linux/net',
-        'include/linux/phy.h',
-        'include/linux/rtnetlink.h',
-        'include/linux/skbuff.h',
-        'include/net/',
-        'include/phy/',
-        # lib/ is pretty broad but patch volume is low
-        'lib/',
-        'net/',
-        'drivers/atm/',
-        'drivers/bluetooth/',
-        'drivers/dibs/',
-        'drivers/dpll/',
-        'drivers/firmware/broadcom/tee_bnxt_fw.c',
-        'drivers/isdn/',
-        'drivers/net/',
-        'drivers/dsa/',
-        'drivers/nfc/',
-        'drivers/ptp/',
-        'drivers/net/ethernet/',
-        'drivers/usb/atm/',
-        'kernel/bpf/',
-        'tools/net/',
-        'tools/testing/selftests/drivers/net/',
-        'tools/testing/selftests/tc-testing/',
-        'tools/testing/selftests/net/',
-
-        'kernel/trace/bpf_trace.c',
-        'drivers/leds/trigger/ledtrig-netdev.c',
-    }
-    excluded_files = {
-        'net/ceph',
-        'net/sunrpc',
-    }
-    all_files = acceptable_files.union(required_files)
-    required_found = False
-    foreign_found = False
-
-    lines = raw_email.split('\n')
-    r_diffstat = re.compile(r'^\s*([-\w/._,]+)\s+\|\s+\d+\s*[-+]*\s*$')
-    r_header = re.compile(r'\+\+\+ b/([-\w/._,]+)$')
-    for line in lines:
-        match = r_header.match(line)
-        if not match:
-            match = r_diffstat.match(line)
-        if not match:
-            continue
-
-        found = False
-        excluded = False
-        file_name = match.group(1)
-        log_open_sec(f'Checking file name {file_name}')
-        if file_name.startswith('.../'):
-            compare = _file_name_match_dotted
-        else:
-            compare = _file_name_match_start
-
-        for fn in excluded_files:
-            if compare(fn, file_name):
-                log(f'Excluded by {fn}', "")
-                excluded = True
-                break
-        if excluded:
-            foreign_found = True
-            log_end_sec()
-            continue
-        for fn in all_files:
-            matches = compare(fn, file_name)
-            if not matches:
-                continue
-            log(f'Matched by {fn}', "")
-            found = True
-            required_found = required_found or fn in required_files
-        log_end_sec()
-        if not found:
-            log(f'File name {file_name} was not matched by any list', "")
-            foreign_found = True
-
-    log(f'Required found: {required_found}, foreign_found: {foreign_found}', "")
-    if not required_found:
-        return False
-    if foreign_found:
-        return None
-    return True
+    classes = _classifier.classify_all(patch.parsed.touched_files())
+    return _classifier.local_state(classes), classes
 
 
-def _tree_name_should_be_local(raw_email):
-    return _tree_name_should_be_local_files(raw_email)
+def _tree_name_should_be_local(patch):
+    return _tree_name_should_be_local_files(patch)
 
 
 def series_tree_name_should_be_local(series):
     all_local = True
     some_local = False
+    total = {}
     for p in series.patches:
-        ret = _tree_name_should_be_local(p.raw_patch)
+        ret, classes = _tree_name_should_be_local(p)
+        for cls, names in classes.items():
+            total.setdefault(cls, {}).update(dict.fromkeys(names))
         # Returns tri-state True, None, False. And works well:
         #     True and None -> None
         #     True and False -> False
@@ -161,6 +107,10 @@ def series_tree_name_should_be_local(series):
         #     True or False -> True
         #     False or None -> False
         some_local = some_local or ret
+
+    counts = ', '.join(f'{cls}: {len(names)}' for cls, names in total.items())
+    outside = list(total.get(FOREIGN, {})) + list(total.get(EXCLUDED, {}))
+    log(f'Local files: {all_local}/{some_local} ({counts})', '\n'.join(outside))
     return all_local, some_local
 
 
@@ -182,14 +132,16 @@ def series_ignore_missing_tree_name(series):
 
 def series_is_a_fix_for(s, tree):
     commits = []
-    regex = re.compile(r'^Fixes: [a-f0-9]* \(')
     for p in s.patches:
-        commits += regex.findall(p.raw_patch)
-    for c in commits:
-        if not tree.contains(c):
-            return False
+        commits += p.parsed.fixes_commits
+    if not commits:
+        return False
+
+    reachable = tree.contains_all(list(dict.fromkeys(commits)))
+    if not all(reachable.values()):
+        return False
 
-    return commits and tree.check_applies(s)
+    return tree.check_applies(s)
 
 
 def series_needs_async(s) -> bool:
@@ -202,7 +154,8 @@ def series_needs_async(s) -> bool:
         'linux/tcp.h'
     }
     for p in s.patches:
-        for needle in bad_files:
-            if p.raw_patch.find(needle) > 0:
-                return True
+        for file_name in p.parsed.touched_files():
+            for needle in bad_files:
+                if needle in file_name:
+                    return True
     return False
@@ -9,5 +9,5 @@ to communicate with Patchwork as well as descendant classes representing
 core objects retrieved from Patchwork.
 """
 
-from .patchwork import Patchwork, PatchworkCheckState
+from .patchwork import Patchwork, PatchworkCheckState, PatchworkPostException
 from .pw_series import PwSeries
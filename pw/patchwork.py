@@ -2,6 +2,7 @@
 #
 # Copyright (C) 2019 Netronome Systems, Inc.
 
+import concurrent.futures
 import datetime
 try:
     import simplejson as json
@@ -14,14 +15,15 @@ import time
 import urllib
 
 import core
+from .response_cache import ResponseCache
 
 # TODO: document
 
 
 class PatchworkCheckState:
     PENDING = "pending"
-    SUCCESS = "success",
-    WARNING = "warning",
+    SUCCESS = "success"
+    WARNING = "warning"
     FAIL = "fail"
 
 
@@ -35,7 +37,26 @@ class Patchwork(object):
         allowed_methods = Retry.DEFAULT_ALLOWED_METHODS | {'POST', 'PATCH'}
         retry = Retry(connect=10, status=10, status_forcelist={502, 504},
                       allowed_methods=allowed_methods, backoff_factor=1)
-        adapter = HTTPAdapter(max_retries=retry)
+        # Number of GET requests issued in parallel when fetching in bulk
+        self._fetch_concurrency = config.getint('patchwork', 'fetch_concurrency', fallback=8)
+        self._fetch_pool = None
+        # Number of checks posted in parallel by post_checks()
+        self._post_concurrency = config.getint('patchwork', 'post_concurrency',
+                                               fallback=self._fetch_concurrency)
+        self._post_pool = None
+        # mboxes fetched ahead of time by prefetch_series_mboxes()
+        self._prefetched = {}
+        self._cache = None
+        cache_dir = config.get('patchwork', 'cache_dir', fallback=None)
+        if cache_dir:
+            self._cache = ResponseCache(cache_dir,
+                                        ttl=config.getint('patchwork', 'cache_ttl', fallback=0),
+                                        mbox_ttl=config.getint('patchwork', 'cache_mbox_ttl',
+                                                               fallback=3600),
+                                        max_age=config.getint('patchwork', 'cache_max_age',
+                                                              fallback=7) * 86400)
+        adapter = HTTPAdapter(max_retries=retry,
+                              pool_maxsize=max(self._fetch_concurrency, self._post_concurrency, 10))
         self._session.mount('http://', adapter)
         self._session.mount('https://', adapter)
 
@@ -59,14 +80,23 @@ class Patchwork(object):
             except ValueError:
                 raise Exception("Patchwork project not found", config_project)
 
-    def _request(self, url):
+    def _session_get(self, url, mbox=False):
+        # Does not log, may be called from the fetch pool
+        # Responses to queries (lists, filters) are never cached
+        if not self._cache or '?' in url:
+            return self._session.get(url)
+        return self._cache.get(self._session, url, mbox=mbox)
+
+    def _request(self, url, mbox=False):
         core.log_open_sec(f"Patchwork {self.server} request: {url}")
         start = datetime.datetime.now()
         core.log("Start", str(start))
 
         try:
-            ret = self._session.get(url)
+            ret = self._session_get(url, mbox=mbox)
             core.log("Response", ret)
+            if getattr(ret, 'from_cache', False):
+                core.log("Served from cache", "")
             try:
                 core.log("Response data", ret.json())
             except json.decoder.JSONDecodeError:
@@ -78,31 +108,99 @@ class Patchwork(object):
 
         return ret
 
+    def _request_batch(self, urls, mbox=False):
+        """GET multiple URLs concurrently, responses are returned in order"""
+        if len(urls) < 2 or self._fetch_concurrency < 2:
+            return [self._request(url, mbox=mbox) for url in urls]
+
+        if not self._fetch_pool:
+            self._fetch_pool = concurrent.futures.ThreadPoolExecutor(self._fetch_concurrency)
+
+        core.log_open_sec(f"Patchwork {self.server} batch of {len(urls)} requests")
+        start = datetime.datetime.now()
+        core.log("Start", str(start))
+
+        try:
+            # Pool threads have no logger, only log from this thread
+            ret = list(self._fetch_pool.map(lambda url: self._session_get(url, mbox), urls))
+            for url, r in zip(urls, ret):
+                core.log(url, f"{r} (cached)" if getattr(r, 'from_cache', False) else r)
+        finally:
+            end = datetime.datetime.now()
+            core.log("Response time GET batch (sec)", (end - start).total_seconds())
+            core.log_end_sec()
+
+        return ret
+
     def request(self, url):
         return self._request(url).json()
 
-    def request_all(self, url):
-        items = []
+    @staticmethod
+    def _parse_links(response):
+        """Parse the Link header, returns a dict of rel -> URL"""
+        links = {}
+        # There are multiple links separated by commas
+        # and each link has the format of <url>; rel="type"
+        for link in response.headers.get('Link', '').split(','):
+            info = link.split(';')
+            if len(info) < 2:
+                continue
+            rel = info[1].strip()
+            if rel.startswith('rel='):
+                links[rel[4:].strip('"')] = info[0].strip()[1:-1]
+        return links
+
+    @staticmethod
+    def _page_url(url, page):
+        parts = urllib.parse.urlsplit(url)
+        query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+                 if k != 'page']
+        query.append(('page', str(page)))
+        return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+    @staticmethod
+    def _page_number(url):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+        try:
+            return int(query['page'][0])
+        except (KeyError, ValueError):
+            return None
+
+    def iter_request_all(self, url):
+        """Iterate over the items of a paged response, following the links.
+
+        Items are yielded as pages arrive. When the first page tells us
+        where the last one is the remaining pages are fetched concurrently.
+        """
+        response = self._request(url)
+        yield from response.json()
+
+        links = self._parse_links(response)
+        url = links.get('next')
+        if not url:
+            return
+
+        first = self._page_number(url)
+        last = self._page_number(links['last']) if 'last' in links else None
+        if first and last and self._fetch_concurrency > 1:
+            urls = [self._page_url(url, page) for page in range(first, last + 1)]
+            for i in range(0, len(urls), self._fetch_concurrency):
+                for response in self._request_batch(urls[i:i + self._fetch_concurrency]):
+                    yield from response.json()
+            return
 
         while url:
             response = self._request(url)
-            items += response.json()
+            yield from response.json()
+            url = self._parse_links(response).get('next')
 
-            if 'Link' not in response.headers:
-                break
-            url = ''
-            links = response.headers['Link'].split(',')
-            for link in links:
-                info = link.split(';')
-                if info[1].strip() == 'rel="next"':
-                    url = info[0][1:-1]
-
-        return items
+    def request_all(self, url):
+        return list(self.iter_request_all(url))
 
     def get(self, object_type, identifier):
         return self._get(f'{object_type}/{identifier}/').json()
 
-    def get_all(self, object_type, filters=None, api='1.1'):
+    def iter_all(self, object_type, filters=None, api='1.1'):
         if filters is None:
             filters = {}
         params = ''
@@ -110,27 +208,10 @@ class Patchwork(object):
             if val is not None:
                 params += f'{key}={val}&'
 
-        items = []
+        return self.iter_request_all(self._api_url(f'{object_type}/?{params}', api=api))
 
-        response = self._get(f'{object_type}/?{params}', api=api)
-        # Handle paging, by chasing the "Link" elements
-        while response:
-            for o in response.json():
-                items.append(o)
-
-            if 'Link' not in response.headers:
-                break
-
-            # There are multiple links separated by commas
-            links = response.headers['Link'].split(',')
-            # And each link has the format of <url>; rel="type"
-            response = None
-            for link in links:
-                info = link.split(';')
-                if info[1].strip() == 'rel="next"':
-                    response = self._request(info[0][1:-1])
-
-        return items
+    def get_all(self, object_type, filters=None, api='1.1'):
+        return list(self.iter_all(object_type, filters, api=api))
 
     def get_by_msgid(self, object_type, msgid):
         msgid = urllib.parse.quote(msgid)
@@ -139,14 +220,63 @@ class Patchwork(object):
     def get_mbox_direct(self, url):
         return self._request(url).content.decode()
 
+    def _mbox_url(self, object_type, identifier):
+        return f'{self._proto}{self.server}/{object_type}/{identifier}/mbox/'
+
     def get_mbox(self, object_type, identifier):
-        url = f'{self._proto}{self.server}/{object_type}/{identifier}/mbox/'
-        return self._request(url).content.decode()
+        if (object_type, identifier) in self._prefetched:
+            return self._prefetched.pop((object_type, identifier))
+        # Series mboxes change as patches get added, don't keep them
+        # for longer than other objects
+        mbox = object_type in ('patch', 'cover')
+        return self._request(self._mbox_url(object_type, identifier),
+                             mbox=mbox).content.decode()
+
+    def get_mboxes(self, objects):
+        """Fetch mboxes for a list of (object_type, identifier) concurrently.
+
+        Returns a dict keyed by the (object_type, identifier) tuples.
+        """
+        ret = {}
+        missing = []
+        for obj in objects:
+            if obj in self._prefetched:
+                ret[obj] = self._prefetched.pop(obj)
+            elif obj not in missing:
+                missing.append(obj)
+
+        mbox = all(obj[0] in ('patch', 'cover') for obj in missing)
+        responses = self._request_batch([self._mbox_url(*obj) for obj in missing],
+                                        mbox=mbox)
+        for obj, r in zip(missing, responses):
+            ret[obj] = r.content.decode()
+        return ret
 
-    def _get(self, req, api='1.1'):
+    @staticmethod
+    def series_mbox_objects(pw_series):
+        objects = []
+        if pw_series['cover_letter']:
+            objects.append(('cover', pw_series['cover_letter']['id']))
+        for p in pw_series['patches']:
+            objects.append(('patch', p['id']))
+        return objects
+
+    def prefetch_series_mboxes(self, series):
+        """Fetch all the mboxes for a batch of series concurrently,
+        get_mbox() and get_mboxes() will then use the prefetched data"""
+        self._prefetched = {}
+        objects = []
+        for pw_series in series:
+            objects += self.series_mbox_objects(pw_series)
+        self._prefetched = self.get_mboxes(objects)
+
+    def _api_url(self, req, api='1.1'):
         if api:
             api += "/"
-        return self._request(f'{self._proto}{self.server}/api/{api}{req}')
+        return f'{self._proto}{self.server}/api/{api}{req}'
+
+    def _get(self, req, api='1.1'):
+        return self._request(self._api_url(req, api=api))
 
     def _post(self, req, headers, data, api='1.1'):
         url = f'{self._proto}{self.server}/api/{api}/{req}'
@@ -203,6 +333,10 @@ class Patchwork(object):
         return self.get_all('projects')
 
     def get_patches_all(self, delegate=None, project=None, since=None, action_required=None):
+        return list(self.iter_patches_all(delegate=delegate, project=project, since=since,
+                                          action_required=action_required))
+
+    def iter_patches_all(self, delegate=None, project=None, since=None, action_required=None):
         if project is None:
             project = self._project
         query = {'project': project}
@@ -215,7 +349,7 @@ class Patchwork(object):
         if action_required:
             query['state'] = '1&state=2'
             query['archived'] = 'false'
-        return self.get_all('patches', query)
+        return self.iter_all('patches', query)
 
     def get_new_series(self, project=None, since=None):
         if project is None:
@@ -230,15 +364,18 @@ class Patchwork(object):
         if not events:
             return [], since
         since = events[-1]['date']
-        series = [self.get('series', e['payload']['series']['id']) for e in events]
+        urls = [self._api_url(f"series/{e['payload']['series']['id']}/") for e in events]
+        series = [r.json() for r in self._request_batch(urls)]
         return series, since
 
-    def post_check(self, patch, name, state, url, desc):
+    def _auth_headers(self):
         headers = {}
         if self._token:
             headers['Authorization'] = f'Token {self._token}'
+        return headers
 
-        data = {
+    def _check_data(self, name, state, url, desc):
+        return {
             'user': self._user,
             'state': state,
             'target_url': url,
@@ -246,10 +383,53 @@ class Patchwork(object):
             'description': desc
         }
 
-        r = self._post(f'patches/{patch}/checks/', headers=headers, data=data)
+    def post_check(self, patch, name, state, url, desc):
+        r = self._post(f'patches/{patch}/checks/', headers=self._auth_headers(),
+                       data=self._check_data(name, state, url, desc))
         if r.status_code != 201:
             raise PatchworkPostException(r)
 
+    def post_checks(self, checks):
+        """Post multiple checks concurrently
+
+        checks is a list of dicts with the arguments of post_check().
+        Returns a list with None for each check which got posted
+        and the exception for each one which failed, in order.
+        """
+        if not checks:
+            return []
+        if not self._post_pool:
+            self._post_pool = concurrent.futures.ThreadPoolExecutor(max(self._post_concurrency, 1))
+
+        headers = self._auth_headers()
+
+        def post(check):
+            # Pool threads have no logger, only log from the calling thread
+            url = f'{self._proto}{self.server}/api/1.1/patches/{check["patch"]}/checks/'
+            data = self._check_data(check['name'], check['state'], check['url'], check['desc'])
+            try:
+                r = self._session.post(url, headers=headers, data=data)
+            except requests.exceptions.RequestException as e:
+                return e, e
+            if r.status_code != 201:
+                return r, PatchworkPostException(r)
+            return r, None
+
+        core.log_open_sec(f"Patchwork {self.server} post of {len(checks)} checks")
+        start = datetime.datetime.now()
+        core.log("Start", str(start))
+
+        try:
+            ret = list(self._post_pool.map(post, checks))
+            for check, (r, _) in zip(checks, ret):
+                core.log(f"{check['patch']} {check['name']}: {check['state']}", r)
+        finally:
+            end = datetime.datetime.now()
+            core.log("Response time POST batch (sec)", (end - start).total_seconds())
+            core.log_end_sec()
+
+        return [err for _, err in ret]
+
     def update_state(self, patch, state):
         headers = {}
         if self._token:
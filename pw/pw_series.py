@@ -20,8 +20,11 @@ class PwSeries(Series):
         # pull_url loaded from patch 0, not from cover; it's for pure pulls only
         self.pull_url = None
 
+        # Fetch the cover and all the patches at once
+        mboxes = pw.get_mboxes(pw.series_mbox_objects(pw_series))
+
         if pw_series['cover_letter']:
-            pw_cover_letter = pw.get_mbox('cover', pw_series['cover_letter']['id'])
+            pw_cover_letter = mboxes[('cover', pw_series['cover_letter']['id'])]
             self.set_cover_letter(pw_cover_letter)
         elif self.pw_series['patches']:
             self.subject = self.pw_series['patches'][0]['name']
@@ -35,7 +38,7 @@ class PwSeries(Series):
         # Fast path incomplete series
         if not pw_series['received_all']:
             for p in self.pw_series['patches']:
-                raw_patch = pw.get_mbox('patch', p['id'])
+                raw_patch = mboxes[('patch', p['id'])]
                 self.patches.append(Patch(raw_patch, p['id']))
             return
 
@@ -71,7 +74,7 @@ class PwSeries(Series):
             log("Patch order - count does not add up?!", "")
 
         for pid in pids:
-            raw_patch = pw.get_mbox('patch', pid)
+            raw_patch = mboxes[('patch', pid)]
             self.add_patch(Patch(raw_patch, pid))
 
         if not pw_series['cover_letter']:
@@ -100,28 +103,22 @@ class PwSeries(Series):
         all_reply = None
 
         log_open_sec("Searching for implicit cover/pull request")
+        r_in_reply = re.compile(r'^<(.*)>$')
         for p in self.patches:
-            lines = p.raw_patch.split('\n')
-            r_in_reply = re.compile(r'^In-Reply-To: <(.*)>$')
-            reply_to = None
-
-            for line in lines:
-                if line == "":   # end of headers
-                    if reply_to is None:
-                        log("Patch had no reply header", "")
-                        all_reply = False
-                    break
-                match = r_in_reply.match(line)
-                if not match:
-                    continue
-
-                reply_to = match.group(1)
-                log("Patch reply header", reply_to)
-                if all_reply is None:
-                    all_reply = reply_to
-                elif all_reply != reply_to:
-                    all_reply = False
-                    log("Mismatch in replies", "")
+            reply_to = p.parsed.headers['In-Reply-To']
+            match = r_in_reply.match(reply_to.strip()) if reply_to else None
+            if not match:
+                log("Patch had no reply header", "")
+                all_reply = False
+                break
+
+            reply_to = match.group(1)
+            log("Patch reply header", reply_to)
+            if all_reply is None:
+                all_reply = reply_to
+            elif all_reply != reply_to:
+                all_reply = False
+                log("Mismatch in replies", "")
         log("Result", all_reply)
         if all_reply:
             covers = self.pw.get_all('patches', filters={'msgid': all_reply}, api='1.2')
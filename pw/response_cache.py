@@ -0,0 +1,155 @@
+# SPDX-License-Identifier: GPL-2.0
+
+""" On-disk cache of patchwork responses, shared by processes on the host """
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+class ResponseCache:
+    """Cache of patchwork GET responses
+
+    Responses are reused for ttl seconds (mbox_ttl for mboxes, which
+    don't change often, only collect review tags) and then revalidated with
+    a conditional request (If-None-Match / If-Modified-Since), or fetched
+    again if patchwork gave no validators. Responses without an ETag or
+    Last-Modified header are only stored if they can be reused for some time.
+
+    Entries are written atomically, the cache directory can be shared
+    by all the patchwork clients on the host. Entries not stored or
+    revalidated for max_age seconds are pruned, at most once per
+    prune_interval across all the users of the cache.
+    """
+    # Response headers worth keeping, Link is needed for paging
+    _headers = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+    prune_interval = 60 * 60
+
+    def __init__(self, path, ttl=0, mbox_ttl=0, max_age=7 * 24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self.mbox_ttl = mbox_ttl
+        self.max_age = max_age
+        self._next_prune = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.path, key[:2], key)
+
+    def _load(self, url):
+        entry = self._entry(url)
+        try:
+            with open(entry + '.json', 'r') as fp:
+                meta = json.load(fp)
+            with open(entry + '.body', 'rb') as fp:
+                body = fp.read()
+        except (OSError, json.JSONDecodeError):
+            return None, None
+        return meta, body
+
+    @staticmethod
+    def _write(path, data):
+        tmp_fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(tmp_fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+
+    def _store(self, url, meta, body):
+        entry = self._entry(url)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        # Body first, the metadata makes the entry visible
+        self._write(entry + '.body', body)
+        self._write(entry + '.json', json.dumps(meta).encode())
+
+        if time.time() >= self._next_prune:
+            self._next_prune = time.time() + self.prune_interval
+            self.prune()
+
+    def _prune_due(self):
+        """Claim the next prune, returns False if the cache was pruned recently"""
+        stamp = os.path.join(self.path, '.last_prune')
+        now = time.time()
+        try:
+            if now - os.path.getmtime(stamp) < self.prune_interval:
+                return False
+        except FileNotFoundError:
+            pass
+        with open(stamp, 'a'):
+            pass
+        os.utime(stamp, (now, now))
+        return True
+
+    def prune(self):
+        """Remove entries older than max_age
+
+        Does not log, may be called from the fetch pool. Other users of the
+        cache may be pruning (or storing) at the same time.
+        """
+        if not self._prune_due():
+            return
+
+        cutoff = time.time() - self.max_age
+        for sub in os.listdir(self.path):
+            sub_path = os.path.join(self.path, sub)
+            if not os.path.isdir(sub_path):
+                continue
+            try:
+                names = os.listdir(sub_path)
+            except FileNotFoundError:
+                continue
+            # Both files of an entry are rewritten on each store,
+            # this also catches temp files left behind by crashes
+            for name in names:
+                path = os.path.join(sub_path, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def _response(url, meta, body):
+        r = requests.Response()
+        r.status_code = 200
+        r.url = url
+        r.headers = CaseInsensitiveDict(meta['headers'])
+        r.encoding = meta.get('encoding')
+        r._content = body
+        r.from_cache = True
+        return r
+
+    def get(self, session, url, mbox=False):
+        ttl = self.mbox_ttl if mbox else self.ttl
+        meta, body = self._load(url)
+
+        headers = {}
+        if meta:
+            if time.time() - meta['time'] < ttl:
+                return self._response(url, meta, body)
+            if 'ETag' in meta['headers']:
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if 'Last-Modified' in meta['headers']:
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+
+        r = session.get(url, headers=headers)
+        if r.status_code == 304 and meta:
+            meta['time'] = time.time()
+            self._store(url, meta, body)
+            return self._response(url, meta, body)
+
+        if r.status_code == 200 and \
+           (ttl > 0 or 'ETag' in r.headers or 'Last-Modified' in r.headers):
+            meta = {
+                'url': url,
+                'time': time.time(),
+                'encoding': r.encoding,
+                'headers': {k: r.headers[k] for k in self._headers if k in r.headers},
+            }
+            self._store(url, meta, r.content)
+        return r
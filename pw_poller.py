@@ -8,8 +8,10 @@ import configparser
 import datetime
 import json
 import os
+import selectors
 import shutil
 import socket
+import threading
 import time
 import queue
 from typing import Dict
@@ -20,6 +22,7 @@ from core import NipaLifetime
 from core import log, log_open_sec, log_end_sec, log_init
 from core import Tester
 from core import Tree
+from core.scheduler import Scheduler
 from pw import Patchwork
 from pw import PwSeries
 import core
@@ -29,6 +32,106 @@ class IncompleteSeries(Exception):
     pass
 
 
+class SeriesJournal:
+    """Append-only journal of series going through the poller
+
+    Every transition of a series (received, queued, started, done) and
+    the patchwork event timestamp we have processed up to are appended
+    and synced to disk, so that after a crash we know exactly which series
+    still need testing. The journal is compacted on start and whenever
+    it grows large, leaving only the series which are still pending.
+    """
+    def __init__(self, path, max_records=10000):
+        self.path = path
+        self.since = None
+        # Series not done yet, by id, in the order they were received
+        self.pending = {}
+
+        self._lock = threading.Lock()
+        self._fp = None
+        self._records = 0
+        self._max_records = max_records
+
+        self._load()
+        self._compact()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as fp:
+                for line in fp:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn write of the last record
+                        break
+                    self._apply(rec)
+        except FileNotFoundError:
+            pass
+
+    def _apply(self, rec):
+        ev = rec['ev']
+        if ev == 'since':
+            self.since = rec['since']
+        elif ev == 'received':
+            self.pending[rec['id']] = {'force_tree': rec.get('force_tree')}
+        elif ev == 'queued' and rec['id'] in self.pending:
+            self.pending[rec['id']]['tree'] = rec['tree']
+        elif ev == 'started' and rec['id'] in self.pending:
+            self.pending[rec['id']]['started'] = rec['ts']
+        elif ev == 'done':
+            self.pending.pop(rec['id'], None)
+
+    def _compact(self):
+        records = []
+        if self.since:
+            records.append({'ev': 'since', 'since': self.since})
+        for sid, info in self.pending.items():
+            records.append({'ev': 'received', 'id': sid, 'force_tree': info['force_tree']})
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fp:
+            for rec in records:
+                fp.write(json.dumps(rec) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.path)
+
+        if self._fp:
+            self._fp.close()
+        self._fp = open(self.path, 'a')
+        self._records = len(records)
+
+    def _append(self, rec, sync=True):
+        rec['ts'] = time.time()
+        with self._lock:
+            self._apply(rec)
+            self._fp.write(json.dumps(rec) + '\n')
+            self._fp.flush()
+            if sync:
+                os.fsync(self._fp.fileno())
+
+            self._records += 1
+            if self._records > self._max_records:
+                self._compact()
+
+    def received(self, series_id, force_tree=None):
+        self._append({'ev': 'received', 'id': series_id, 'force_tree': force_tree})
+
+    def queued(self, series_id, tree):
+        self._append({'ev': 'queued', 'id': series_id, 'tree': tree})
+
+    def started(self, series_id):
+        # Informational only, recovery works the same whether a series has
+        # started or not, so don't make the testers wait for the disk
+        self._append({'ev': 'started', 'id': series_id}, sync=False)
+
+    def done(self, series_id):
+        self._append({'ev': 'done', 'id': series_id})
+
+    def set_since(self, since):
+        self._append({'ev': 'since', 'since': since})
+
+
 class PwPoller:
     def __init__(self, config) -> None:
         self._worker_id = 0
@@ -37,6 +140,7 @@ class PwPoller:
         self.result_dir = config.get('dirs', 'results', fallback=os.path.join(NIPA_DIR, "results"))
         self.worker_dir = config.get('dirs', 'workers', fallback=os.path.join(NIPA_DIR, "workers"))
         tree_dir = config.get('dirs', 'trees', fallback=os.path.join(NIPA_DIR, "../"))
+        fetch_freshness = config.getint('poller', 'fetch_freshness', fallback=0)
         self._trees = { }
         for tree in config['trees']:
             opts = [x.strip() for x in config['trees'][tree].split(',')]
@@ -48,17 +152,27 @@ class PwPoller:
                 branch = opts[3]
             src = os.path.join(tree_dir, fspath)
             # name, pfx, fspath, remote=None, branch=None
-            self._trees[tree] = Tree(tree, prefix, src, remote=remote, branch=branch)
+            self._trees[tree] = Tree(tree, prefix, src, remote=remote, branch=branch,
+                                     fetch_freshness=fetch_freshness)
 
         if os.path.exists(self.worker_dir):
             shutil.rmtree(self.worker_dir)
         os.makedirs(self.worker_dir)
 
+        listmodname = config.get('list', 'module', fallback='netdev')
+        self.list_module = import_module(listmodname)
+
+        self._journal = SeriesJournal(config.get('poller', 'journal', fallback='poller.journal'))
+        # Series handed to the testers and not done yet, replayed series may
+        # come back from patchwork if we crashed before recording the event time
+        self._in_flight = set()
+        self._scheduler = Scheduler(config, self._trees, fix_trees=[self.list_module.current_tree],
+                                    on_get=lambda s: self._journal.started(s.id))
         self._done_queue = queue.Queue()
         self._workers = []
         self._work_queues = {}
         for k, tree in self._trees.items():
-            self._work_queues[k] = queue.Queue()
+            self._work_queues[k] = self._scheduler.queue(k)
 
             worker_cnt = config.getint('workers', tree.name, fallback=1)
             for worker_id in range(worker_cnt):
@@ -79,9 +193,8 @@ class PwPoller:
         self._recheck_period = config.getint('poller', 'recheck_period', fallback=3)
         self._recheck_lookback = config.getint('poller', 'recheck_lookback', fallback=9)
 
-        listmodname = config.get('list', 'module', fallback='netdev')
-        self.list_module = import_module(listmodname)
-
+        # Serializes processing of series between polling and the socket
+        self._process_lock = threading.Lock()
         self._local_sock = None
         self._start_lock_sock(config)
 
@@ -183,7 +296,10 @@ class PwPoller:
             if not s.tree_name in self._work_queues:
                 log(f"skip {pw_series['id']} for unknown tree {s.tree_name}", "")
                 return
+            self._journal.queued(s.id, s.tree_name)
+            self._in_flight.add(s.id)
             self._work_queues[s.tree_name].put(s)
+            return True
         else:
             core.write_tree_selection_result(self.result_dir, s, comment)
             core.mark_done(self.result_dir, s)
@@ -191,10 +307,46 @@ class PwPoller:
     def process_series(self, pw_series, force_tree=None) -> None:
         log_open_sec(f"Checking series {pw_series['id']} with {pw_series['total']} patches")
         try:
-            self._process_series(pw_series, force_tree)
+            if pw_series['id'] in self._in_flight:
+                log(f"Series {pw_series['id']} already queued", "")
+                return
+
+            self._journal.received(pw_series['id'], force_tree)
+            try:
+                queued = self._process_series(pw_series, force_tree)
+            except IncompleteSeries:
+                # Patchwork will tell us again once the series is complete
+                self._journal.done(pw_series['id'])
+                raise
+            # Other exceptions leave the series pending, it will be retried
+            # from the journal on next start
+            if not queued:
+                self._journal.done(pw_series['id'])
         finally:
             log_end_sec()
 
+    def replay_journal(self) -> None:
+        """Queue again the series which were pending when we last stopped"""
+        pending = list(self._journal.pending.items())
+        if not pending:
+            return
+
+        log_open_sec(f"Replaying {len(pending)} series from the journal")
+        for series_id, info in pending:
+            if os.path.exists(os.path.join(self.result_dir, str(series_id), ".tester_done")):
+                log(f"Series {series_id} already tested", "")
+                self._journal.done(series_id)
+                continue
+            try:
+                pw_series = self._pw.get("series", series_id)
+                self.process_series(pw_series, force_tree=info['force_tree'])
+            except IncompleteSeries:
+                pass
+            except Exception as e:
+                # Leave it pending, we'll try again on next start
+                log(f"Failed to replay series {series_id}", str(e))
+        log_end_sec()
+
     def _start_lock_sock(self, config) -> None:
         socket_path = config.get('poller', 'local_sock_path', fallback=None)
         if not socket_path:
@@ -208,26 +360,117 @@ class PwPoller:
         self._local_sock.bind(socket_path)
         self._local_sock.listen(5)
 
-        log(f"Socket listener started on {socket_path}", "")
+        # Socket is served by its own thread, requests other than status
+        # (which may have to wait for the poller) are handed to a worker
+        # thread, with its own log
+        log_dir = config.get('log', 'dir', fallback=NIPA_DIR)
+        self._sock_log = (config.get('log', 'type', fallback='org'),
+                          os.path.join(log_dir, "poller-sock.org"),
+                          config.getboolean('log', 'async', fallback=False))
+        self._sock_requests = queue.Queue()
+        thread = threading.Thread(target=self._local_sock_run, name="poller-sock", daemon=True)
+        thread.start()
+        thread = threading.Thread(target=self._local_sock_worker, name="poller-sock-worker",
+                                  daemon=True)
+        thread.start()
 
-    def _check_local_sock(self) -> None:
-        if not self._local_sock:
-            return
+        log(f"Socket listener started on {socket_path}", "")
 
+    def _local_sock_run(self) -> None:
+        sel = selectors.DefaultSelector()
+        sel.register(self._local_sock, selectors.EVENT_READ)
+        pending = {}
+        while True:
+            for key, _ in sel.select():
+                if key.fileobj is self._local_sock:
+                    try:
+                        conn, _ = self._local_sock.accept()
+                    except BlockingIOError:
+                        continue
+                    conn.setblocking(False)
+                    pending[conn] = b""
+                    sel.register(conn, selectors.EVENT_READ)
+                    continue
+
+                conn = key.fileobj
+                try:
+                    chunk = conn.recv(4096)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    chunk = b""
+                pending[conn] += chunk
+                # Request is complete once a read comes back short
+                if len(chunk) == 4096:
+                    continue
+
+                sel.unregister(conn)
+                conn.setblocking(True)
+                data = pending.pop(conn)
+                if data.strip() == b"status":
+                    # Doesn't touch the series processing, answer right away
+                    self._send_status(conn)
+                else:
+                    self._sock_requests.put((conn, data))
+
+    def _local_sock_worker(self) -> None:
+        log_init(self._sock_log[0], self._sock_log[1], async_write=self._sock_log[2])
+
+        while True:
+            conn, data = self._sock_requests.get()
+            self._handle_local_sock(conn, data)
+
+    def status(self) -> dict:
+        queues = self._scheduler.stats()
+        now = time.time()
+
+        workers = []
+        trees = {k: {"workers": 0, "done": 0, "time": 0.0, "left": 0.0} for k in queues}
+        for worker in self._workers:
+            in_flight = worker.in_flight
+            tree_name = worker.tree.parent.name
+            tree = trees[tree_name]
+            tree["workers"] += 1
+            tree["done"] += worker.series_done
+            tree["time"] += worker.series_time
+
+            workers.append({"name": worker.tree.name,
+                            "tree": tree_name,
+                            "series": in_flight and in_flight["id"],
+                            "title": in_flight and in_flight["title"],
+                            "elapsed": in_flight and round(now - in_flight["start"])})
+
+        # Estimate time to drain each tree's queue from average series test time
+        eta = {}
+        for name, tree in trees.items():
+            if not tree["done"] or not tree["workers"]:
+                eta[name] = None
+                continue
+            avg = tree["time"] / tree["done"]
+            left = queues[name]["depth"] * avg
+            for w in workers:
+                if w["series"] and w["tree"] == name:
+                    left += max(avg - w["elapsed"], 0)
+            eta[name] = round(left / tree["workers"])
+
+        return {"queues": queues, "workers": workers, "eta": eta}
+
+    def _send_status(self, conn) -> None:
+        # Runs in the selector thread, must not raise
         try:
-            conn, _ = self._local_sock.accept()
-        except BlockingIOError:
-            return
+            try:
+                resp = json.dumps(self.status()) + "\n"
+            except Exception as e:
+                resp = f"ERROR: {e}\n"
+            conn.sendall(resp.encode("utf-8"))
+        except OSError:
+            pass
+        finally:
+            conn.close()
 
+    def _handle_local_sock(self, conn, data) -> None:
         log_open_sec("Processing local socket connection")
         try:
-            data = b""
-            while True:
-                chunk = conn.recv(4096)
-                data += chunk
-                if len(chunk) < 4096:
-                    break
-
             if data:
                 data = data.decode("utf-8")
                 series_ids = []
@@ -253,8 +496,9 @@ class PwPoller:
 
                 for tree, series_id in series_ids:
                     try:
-                        pw_series = self._pw.get("series", series_id)
-                        self.process_series(pw_series, force_tree=tree)
+                        with self._process_lock:
+                            pw_series = self._pw.get("series", series_id)
+                            self.process_series(pw_series, force_tree=tree)
                         conn.sendall(f"OK: {series_id}\n".encode("utf-8"))
                     except Exception as e:
                         log("Error processing series", str(e))
@@ -268,7 +512,10 @@ class PwPoller:
             log_end_sec()
 
     def run(self, life) -> None:
-        since = self._state['last_event_ts']
+        since = self._journal.since or self._state['last_event_ts']
+
+        with self._process_lock:
+            self.replay_journal()
 
         try:
             # We poll every 2 minutes after this
@@ -284,19 +531,23 @@ class PwPoller:
                 since += datetime.timedelta(microseconds=1)
                 since  = since.isoformat()
 
-                for pw_series in json_resp:
-                    try:
-                        self.process_series(pw_series)
-                    except IncompleteSeries:
-                        # didn't make it to the list fully, patchwork
-                        # shouldn't have had this event at all though
-                        pass
-
-                self._check_local_sock()
+                with self._process_lock:
+                    self._pw.prefetch_series_mboxes(json_resp)
+                    for pw_series in json_resp:
+                        try:
+                            self.process_series(pw_series)
+                        except IncompleteSeries:
+                            # didn't make it to the list fully, patchwork
+                            # shouldn't have had this event at all though
+                            pass
+                self._journal.set_since(since)
 
                 while not self._done_queue.empty():
                     s = self._done_queue.get()
+                    self._journal.done(s.id)
+                    self._in_flight.discard(s.id)
                     log(f"Testing complete for series {s['id']}", "")
+                log("Scheduler queues", self._scheduler.stats())
 
                 secs = 120 - (datetime.datetime.now() - req_time).total_seconds()
                 if secs > 0:
@@ -328,7 +579,8 @@ if __name__ == "__main__":
 
     log_dir = config.get('log', 'dir', fallback=NIPA_DIR)
     log_init(config.get('log', 'type', fallback='org'),
-             config.get('log', 'file', fallback=os.path.join(log_dir, "poller.org")))
+             config.get('log', 'file', fallback=os.path.join(log_dir, "poller.org")),
+             async_write=config.getboolean('log', 'async', fallback=False))
 
     life = NipaLifetime(config)
     poller = PwPoller(config)
@@ -5,13 +5,16 @@
 # Copyright (c) 2020 Facebook
 
 import configparser
+import json
 import os
 import signal
+import tempfile
+import time
 import inotify_simple as inotify
 
 from core import NIPA_DIR
 from core import log, log_open_sec, log_end_sec, log_init
-from pw import Patchwork, PatchworkCheckState
+from pw import Patchwork, PatchworkCheckState, PatchworkPostException
 
 # TODO: document
 should_stop = False
@@ -58,63 +61,306 @@ class PwTestResult:
             self.desc = "Link"
 
 
-def _pw_upload_results(series_dir, pw, config):
-    series = os.path.basename(series_dir)
-    result_server = config.get('results', 'server', fallback='https://google.com')
+def _check_key(check):
+    return f"{check['patch']}/{check['name']}"
 
-    # Collect series checks first
-    series_results = []
-    for root, dirs, _ in os.walk(series_dir):
-        for test in dirs:
-            if is_int(test):
-                continue
 
-            tr = PwTestResult(test, series_dir, f"{result_server}/{series}/{test}")
-            series_results.append(tr)
+def _check_value(check):
+    return [check['state'], check['url'], check['desc']]
 
-        break
 
-    log(f"Found {len(series_results)} series results")
+def _write_json(path, data):
+    tmp_fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(tmp_fd, 'w') as fp:
+        json.dump(data, fp)
+    os.replace(tmp, path)
 
-    for root, dirs, _ in os.walk(series_dir):
-        for patch in dirs:
-            if not is_int(patch):
-                continue
 
-            for tr in series_results:
-                pw.post_check(patch=patch, name=tr.test, state=tr.state, url=tr.url, desc=tr.desc)
+class PostedState:
+    """Checks of a series as last posted to patchwork, by patch and test"""
+    file_name = '.pw_posted'
 
-            patch_dir = os.path.join(root, patch)
-            for _, test_dirs, _ in os.walk(patch_dir):
-                for test in test_dirs:
-                    tr = PwTestResult(test, patch_dir, f"{result_server}/{series}/{patch}/{test}")
-                    pw.post_check(patch=patch, name=tr.test, state=tr.state, url=tr.url,
-                                  desc=tr.desc)
+    def __init__(self, series_dir):
+        self.path = os.path.join(series_dir, self.file_name)
+        try:
+            with open(self.path, 'r') as fp:
+                self.checks = json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            self.checks = {}
+
+    def unchanged(self, check):
+        return self.checks.get(_check_key(check)) == _check_value(check)
+
+    def posted(self, check):
+        self.checks[_check_key(check)] = _check_value(check)
+
+    def save(self):
+        _write_json(self.path, self.checks)
+
+
+def _retryable(err):
+    """Whether posting a check which failed with err may succeed later"""
+    if isinstance(err, PatchworkPostException):
+        status = err.args[0].status_code
+        # Server errors, timeouts and rate limiting, other errors (bad
+        # request, auth, patch gone...) will keep failing
+        return status >= 500 or status in (408, 429)
+    return True
+
+
+class RetryQueue:
+    """Checks which failed to post, persisted so that they survive restarts
+
+    Each check is retried with exponential back off, starting at delay
+    seconds and capped at max_delay. A check is dropped from the queue
+    once posted, or when a newer result for the same patch and test
+    gets posted. Checks which fail with a non-retryable error, or still
+    fail after max_attempts retries, are dropped (and logged).
+    """
+    def __init__(self, path, delay=60, max_delay=60 * 60, max_attempts=24):
+        self.path = path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        try:
+            with open(self.path, 'r') as fp:
+                self.entries = json.load(fp)
+        except (OSError, json.JSONDecodeError):
+            self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _key(series_dir, check):
+        return f"{series_dir}|{_check_key(check)}"
+
+    def _save(self):
+        _write_json(self.path, self.entries)
+
+    def update(self, series_dir, posted, failed):
+        """Record the outcome of posting checks for series_dir"""
+        for check in posted:
+            self.entries.pop(self._key(series_dir, check), None)
+        for check in failed:
+            self.entries[self._key(series_dir, check)] = {
+                "series_dir": series_dir,
+                "check": check,
+                "attempts": 0,
+                "next": time.time() + self.delay,
+            }
+        if posted or failed:
+            self._save()
+
+    def retry(self, pw):
+        now = time.time()
+        due = [key for key, entry in self.entries.items() if entry["next"] <= now]
+        if not due:
+            return
 
-                log(f"Patch {patch} - found {len(test_dirs)} results")
-                break
-        break
+        log_open_sec(f'Retrying {len(due)} of {len(self.entries)} failed checks')
+        try:
+            errors = pw.post_checks([self.entries[key]["check"] for key in due])
+
+            by_series = {}
+            dropped = 0
+            for key, err in zip(due, errors):
+                entry = self.entries[key]
+                if err is None:
+                    by_series.setdefault(entry["series_dir"], []).append(entry["check"])
+                    del self.entries[key]
+                    continue
 
+                entry["attempts"] += 1
+                if not _retryable(err) or entry["attempts"] >= self.max_attempts:
+                    log(f'Giving up on check {key} after {entry["attempts"]} attempts', err)
+                    del self.entries[key]
+                    dropped += 1
+                else:
+                    entry["next"] = now + min(self.delay * 2 ** entry["attempts"], self.max_delay)
+            for series_dir, checks in by_series.items():
+                state = PostedState(series_dir)
+                for check in checks:
+                    state.posted(check)
+                state.save()
+            self._save()
+            log(f'Posted {sum(len(c) for c in by_series.values())} checks, dropped {dropped}, '
+                f'{len(self.entries)} still queued')
+        finally:
+            log_end_sec()
+
+
+def _read_plan(series_dir):
+    """Tests the tester is going to run, written before it starts running them"""
+    try:
+        with open(os.path.join(series_dir, '.tester_plan'), 'r') as fp:
+            return json.load(fp)
+    except (OSError, json.JSONDecodeError):
+        return {"series": [], "patch": [], "patches": []}
 
-def pw_upload_results(series_dir, pw, config):
-    log_open_sec(f'Upload results for {os.path.basename(series_dir)}')
+
+def _read_progress(series_dir):
+    """Tests whose results are complete, as (patch, test), patch is None for series tests"""
+    done = set()
     try:
-        _pw_upload_results(series_dir, pw, config)
+        with open(os.path.join(series_dir, '.tester_progress'), 'r') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn write, the rest of the entry is still coming
+                    continue
+                done.add((entry["patch"], entry["test"]))
+    except OSError:
+        pass
+    return done
+
+
+def _list_dirs(path):
+    for _, dirs, _ in os.walk(path):
+        return dirs
+    return []
+
+
+def _collect_checks(series_dir, config, final):
+    """Checks to report for the series
+
+    Once the tester is done (final) all the results are reported. Before
+    that only results the tester published as complete are reported,
+    and the tests it plans to run but did not finish yet are reported
+    as pending.
+    """
+    series = os.path.basename(series_dir)
+    result_server = config.get('results', 'server', fallback='https://google.com')
+
+    plan = _read_plan(series_dir)
+    done = _read_progress(series_dir)
+    pending_cnt = 0
+
+    def result(patch, test, root_dir, url):
+        nonlocal pending_cnt
+
+        if final or (patch, test) in done:
+            # Planned tests which never ran get their pending placeholders
+            # replaced in _pw_upload_results()
+            if os.path.isdir(os.path.join(root_dir, test)):
+                return PwTestResult(test, root_dir, url)
+            return None
+
+        pending_cnt += 1
+        tr = PwTestResult(test, root_dir, url)
+        tr.state = PatchworkCheckState.PENDING
+        tr.desc = "Pending"
+        return tr
+
+    # Collect series checks first
+    series_tests = [d for d in _list_dirs(series_dir) if not is_int(d)]
+    series_tests += [t for t in plan["series"] if t not in series_tests]
+    series_results = {}
+    for test in series_tests:
+        tr = result(None, test, series_dir, f"{result_server}/{series}/{test}")
+        if tr:
+            series_results[test] = tr
+
+    log(f"Found {len(series_results)} series results")
+
+    patches = [d for d in _list_dirs(series_dir) if is_int(d)]
+    patches += [p for p in plan["patches"] if p not in patches]
+
+    # Patchwork checks are per patch, series results are reported for each
+    checks = []
+    for patch in patches:
+        patch_dir = os.path.join(series_dir, patch)
+        patch_tests = _list_dirs(patch_dir)
+        patch_tests += [t for t in plan["patch"] if t not in patch_tests]
+
+        results = list(series_results.values())
+        for test in patch_tests:
+            tr = result(patch, test, patch_dir, f"{result_server}/{series}/{patch}/{test}")
+            if tr:
+                results.append(tr)
+
+        log(f"Patch {patch} - found {len(results) - len(series_results)} results")
+
+        for tr in results:
+            checks.append({"patch": patch, "name": tr.test, "state": tr.state,
+                           "url": tr.url, "desc": tr.desc})
+
+    if pending_cnt:
+        log(f"{pending_cnt} results still pending")
+    return checks
+
+
+def _pw_upload_results(series_dir, pw, config, retry_queue, final=True):
+    checks = _collect_checks(series_dir, config, final)
+    state = PostedState(series_dir)
+
+    if final:
+        # Don't leave pending placeholders behind for tests which never
+        # produced a result (crashed tester, test disabled mid-run etc.)
+        keys = {_check_key(check) for check in checks}
+        for key, value in state.checks.items():
+            if key not in keys and value[0] == PatchworkCheckState.PENDING:
+                patch, name = key.split('/', 1)
+                checks.append({"patch": patch, "name": name, "state": PatchworkCheckState.FAIL,
+                               "url": value[1], "desc": "Test did not complete"})
+
+    todo = [check for check in checks if not state.unchanged(check)]
+    log(f"Posting {len(todo)} checks, {len(checks) - len(todo)} unchanged since last posted")
+
+    errors = pw.post_checks(todo)
+    posted = [check for check, err in zip(todo, errors) if err is None]
+    failed = []
+    for check, err in zip(todo, errors):
+        if err is None:
+            continue
+        if _retryable(err):
+            failed.append(check)
+        else:
+            log(f"Failed to post check {_check_key(check)}, not retrying", err)
+    for check in posted:
+        state.posted(check)
+    state.save()
+
+    retry_queue.update(series_dir, posted, failed)
+    if failed:
+        log(f"Failed to post {len(failed)} checks, queued for retry")
+
+
+def pw_upload_results(series_dir, pw, config, retry_queue, final=True):
+    what = 'results' if final else 'partial results'
+    log_open_sec(f'Upload {what} for {os.path.basename(series_dir)}')
+    try:
+        _pw_upload_results(series_dir, pw, config, retry_queue, final)
     finally:
         log_end_sec()
 
 
 def pw_upload_results_cb(series_dir, ctx):
-    pw_upload_results(series_dir, ctx['pw'], ctx['config'])
+    pw_upload_results(series_dir, ctx['pw'], ctx['config'], ctx['retry_queue'])
+
+
+def pw_upload_progress_cb(series_dir, ctx):
+    pw_upload_results(series_dir, ctx['pw'], ctx['config'], ctx['retry_queue'], final=False)
+
+
+def pw_upload_idle_cb(ctx):
+    ctx['retry_queue'].retry(ctx['pw'])
 
 
 class TestWatcher(object):
-    def __init__(self, base_path, trigger, complete, cb, cb_ctx):
+    def __init__(self, base_path, trigger, complete, cb, cb_ctx, idle_cb=None,
+                 progress=(), progress_cb=None):
         self.base_path = base_path
         self.trigger = trigger
         self.complete = complete
         self.cb = cb
         self.cb_ctx = cb_ctx
+        self.idle_cb = idle_cb
+        # Files updated while the dir is being worked on, progress_cb gets
+        # called (at most once per batch of events) when they change
+        self.progress = progress
+        self.progress_cb = progress_cb
 
         self.wd2name = {}
         self.inotify = inotify.INotify()
@@ -137,6 +383,15 @@ class TestWatcher(object):
         self.cb(os.path.join(self.base_path, name), self.cb_ctx)
         os.mknod(complete)
 
+    def _progress_dir(self, name):
+        path = os.path.join(self.base_path, name)
+        if os.path.exists(os.path.join(path, self.trigger)) or \
+           os.path.exists(os.path.join(path, self.complete)):
+            return
+
+        log(f"Progress for dir {name}", "")
+        self.progress_cb(path, self.cb_ctx)
+
     def _handle_new_dir(self, name):
         path = os.path.join(self.base_path, name)
         trigger = os.path.join(path, self.trigger)
@@ -149,12 +404,18 @@ class TestWatcher(object):
             return
 
         # Install the watch, to avoid race conditions with the check
-        wd = self.inotify.add_watch(path, inotify.flags.CREATE | inotify.flags.MOVED_TO)
+        flags = inotify.flags.CREATE | inotify.flags.MOVED_TO
+        if self.progress_cb:
+            flags |= inotify.flags.MODIFY
+        wd = self.inotify.add_watch(path, flags)
         self.wd2name[wd] = name
         log(f"New watch: {wd} => {name}", '')
 
         if os.path.exists(trigger):
             self._trigger_dir(name)
+        elif self.progress_cb and \
+                any(os.path.exists(os.path.join(path, f)) for f in self.progress):
+            self._progress_dir(name)
 
     def initial_scan(self):
         # Install the watch first
@@ -172,6 +433,7 @@ class TestWatcher(object):
             raise Exception('Not initialized')
 
         while not should_stop:
+            progress = []
             for event in self.inotify.read(timeout=2000):
                 if event.mask & inotify.flags.IGNORED or \
                    event.wd < 0 or \
@@ -182,12 +444,22 @@ class TestWatcher(object):
                     if event.mask & inotify.flags.ISDIR:
                         self._handle_new_dir(event.name)
                 else:  # subdir
+                    if event.name in self.progress:
+                        if self.progress_cb and self.wd2name[event.wd] not in progress:
+                            progress.append(self.wd2name[event.wd])
+                        continue
                     print(f'File event for {self.wd2name[event.wd]} => {event.name}')
                     if event.name == self.trigger:
                         self._trigger_dir(self.wd2name[event.wd])
                     elif event.name == self.complete:
                         self._complete_dir(event.wd)
 
+            for name in progress:
+                self._progress_dir(name)
+
+            if self.idle_cb:
+                self.idle_cb(self.cb_ctx)
+
 
 def main():
     # Init state
@@ -205,10 +477,16 @@ def main():
 
     signal.signal(signal.SIGTERM, handler)
     signal.signal(signal.SIGINT, handler)
+    retry_queue = RetryQueue(config.get('upload', 'retry_queue',
+                                        fallback=os.path.join(results_dir, '.pw_retry')),
+                             max_attempts=config.getint('upload', 'retry_max_attempts', fallback=24))
+
     tw = TestWatcher(results_dir, '.tester_done', '.pw_done', pw_upload_results_cb, {
         'pw': pw,
-        'config': config
-    })
+        'config': config,
+        'retry_queue': retry_queue,
+    }, idle_cb=pw_upload_idle_cb,
+       progress=('.tester_plan', '.tester_progress'), progress_cb=pw_upload_progress_cb)
     tw.initial_scan()
     tw.watch()
 
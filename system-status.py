@@ -166,6 +166,58 @@ def add_runtime(result, cfg):
     return res
 
 
+def add_test_metrics(cfg):
+    """Aggregate metrics.json files written by the testers next to the results"""
+    max_age = cfg.get("max-age-days", 5) * 24 * 60 * 60
+    now = time.time()
+
+    res = {}
+    for series in os.listdir(cfg["path"]):
+        series_dir = os.path.join(cfg["path"], series)
+        if not os.path.isdir(series_dir) or now - os.path.getmtime(series_dir) > max_age:
+            continue
+        for root, _, files in os.walk(series_dir):
+            if "metrics.json" not in files:
+                continue
+            try:
+                with open(os.path.join(root, "metrics.json"), 'r') as fp:
+                    metrics = json.load(fp)
+            except (OSError, json.JSONDecodeError):
+                continue
+
+            test = os.path.basename(root)
+            if test not in res:
+                res[test] = {"cnt": 0, "cached": 0, "wall": 0, "ru_cnt": 0, "cpu": 0,
+                             "maxrss_kb": 0, "inblock": 0, "oublock": 0}
+            t = res[test]
+            t["cnt"] += 1
+            if metrics.get("cached"):
+                t["cached"] += 1
+            t["wall"] += metrics.get("wall", 0)
+            # Python tests and cached results only report wall time
+            if "utime" not in metrics:
+                continue
+            t["ru_cnt"] += 1
+            t["cpu"] += metrics.get("utime", 0) + metrics.get("stime", 0)
+            t["maxrss_kb"] = max(t["maxrss_kb"], metrics.get("maxrss_kb", 0))
+            t["inblock"] += metrics.get("inblock", 0)
+            t["oublock"] += metrics.get("oublock", 0)
+
+    total_cpu = sum(t["cpu"] for t in res.values()) or 1
+    ret = {}
+    for k, t in res.items():
+        ret[k] = {"cnt": t["cnt"],
+                  "cached": t["cached"],
+                  "avg-wall": t["wall"] / t["cnt"]}
+        if t["ru_cnt"]:
+            ret[k].update({"avg-cpu": t["cpu"] / t["ru_cnt"],
+                           "pct-cpu": t["cpu"] / total_cpu * 100,
+                           "max-rss-kb": t["maxrss_kb"],
+                           "avg-inblock": t["inblock"] / t["ru_cnt"],
+                           "avg-oublock": t["oublock"] / t["ru_cnt"]})
+    return ret
+
+
 def add_remote_services(result, remote):
     r = requests.get(remote['url'])
     data = json.loads(r.content.decode('utf-8'))
@@ -260,7 +312,7 @@ def main():
         cfg = json.load(fp)
 
     log_files = {}
-    run_logs = 'log-files' in cfg
+    run_logs = 'log-files' in cfg or 'metrics' in cfg
 
     db = {}
     run_db = 'db' in cfg
@@ -274,7 +326,11 @@ def main():
             run_logs = datetime.datetime.now() - prev_date > datetime.timedelta(hours=3)
             print("Since log scan", datetime.datetime.now() - prev_date, "Will rescan:", run_logs)
             prev_date = prev["log-files"]["prev-date"]
-            log_files = {"prev-date": prev_date, "data": prev["log-files"]["data"]}
+            log_files = {"prev-date": prev_date}
+            # Either may be missing, depending on what's configured
+            for key in ["data", "metrics"]:
+                if key in prev["log-files"]:
+                    log_files[key] = prev["log-files"][key]
 
         if "db" in prev and "prev-date" in prev["db"]:
             prev_date = datetime.datetime.fromisoformat(prev["db"]["prev-date"])
@@ -301,6 +357,8 @@ def main():
     if "log-files" in cfg and run_logs:
         res = add_runtime(result, cfg["log-files"])
         result["log-files"]["data"] = res
+    if "metrics" in cfg and run_logs:
+        result["log-files"]["metrics"] = add_test_metrics(cfg["metrics"])
     for name in cfg["services"]:
         add_one_service(result, name)
 
@@ -0,0 +1,215 @@
+#!/bin/bash
+# SPDX-License-Identifier: GPL-2.0
+#
+# Store of build output, shared by all testers on the host. Enabled by
+# the tester exporting BASELINE_DIR.
+#
+# Builds run with their output synced per target (make -Otarget, stdout
+# and stderr combined), so that the output can be split into groups, one
+# per kbuild step ("  CC [M]  drivers/foo.o" followed by whatever the
+# compiler and checkers printed for it). Groups are stored keyed by the tree
+# which was built and its config, so the output from before the patch
+# of the steps a patch affects can be looked up by the base tree alone,
+# whatever the patch touches. The tree before the patch only has to be
+# built when some of the affected steps are not in the store.
+
+baseline_max_age_days=7
+
+# baseline_key <rev> <config file> <extra key material...>
+baseline_key() {
+    local rev=$1
+    local config=$2
+    shift 2
+
+    (
+	git rev-parse $rev^{tree}
+	sha1sum < $config
+	echo "$@"
+    ) | sha1sum | cut -d' ' -f1
+}
+
+# baseline_groups <build log> - split the build output into groups
+#
+# Prints a line with the name of each step followed by "<step>\t<line>"
+# for each line of its output. Output before the first step belongs to
+# the step "". Lines make and kbuild print on stdout (step headers,
+# directory changes) are not part of the output, so that only what
+# the compilers and checkers printed gets counted, like when counting
+# lines on stderr.
+baseline_groups() {
+    awk '
+	/^  [A-Z][A-Z0-9_]*( \[[A-Z]\])? +[^ ]+$/ {
+	    # Checkers run as part of the compilation of the object
+	    if ($1 == "CHECK" && cur != "")
+		next
+	    cur = $0
+	    gsub(/ +/, " ", cur)
+	    sub(/^ /, "", cur)
+	    print cur
+	    next
+	}
+	/^make(\[[0-9]+\])?: (Entering|Leaving) directory/ { next }
+	{ print cur "\t" $0 }' $1
+}
+
+# baseline_affected <output dir> <groups> <relink> - steps affected by the patch
+#
+# Compilation steps are affected if the object depends (according to its
+# kbuild .cmd file) on any file touched by the patch. Other steps (linking,
+# modpost...) are affected if any object is, or if relinking was forced.
+# Config changes don't show up as touched files, all steps are affected
+# when the patch touches Kconfig.
+baseline_affected() {
+    local all=0
+
+    git diff --name-only HEAD~ | grep -q -E "Kconfig$" && all=1
+
+    awk -F'\t' -v out=$1 -v relink=$3 -v all=$all -v top=$(pwd)/ '
+	FILENAME == ARGV[1] {
+	    changed[$0] = 1
+	    next
+	}
+	NF != 1 || $1 == "" || $1 in steps { next }
+	all {
+	    steps[$1] = 1
+	    print $1
+	    next
+	}
+	{
+	    steps[$1] = 1
+	    n = split($1, w, " ")
+	    obj = w[n]
+	    if (obj !~ /\.o$/) {
+		other[$1] = 1
+		next
+	    }
+
+	    i = match(obj, /[^\/]*$/)
+	    cmd = out "/" substr(obj, 1, i - 1) "." substr(obj, i) ".cmd"
+	    found = 0
+	    hit = 0
+	    while ((getline line < cmd) > 0) {
+		found = 1
+		sub(/^[ \t]+/, "", line)
+		sub(/[ \t\\]+$/, "", line)
+		sub(/^source_[^ ]* := /, "", line)
+		if (index(line, top) == 1)
+		    line = substr(line, length(top) + 1)
+		sub(/^(\.\.\/)+/, "", line)
+		if (line in changed) {
+		    hit = 1
+		    break
+		}
+	    }
+	    close(cmd)
+	    # No dependency info, assume the worst
+	    if (hit || !found) {
+		print $1
+		any = 1
+	    }
+	}
+	END {
+	    if (any || relink)
+		for (s in other)
+		    print s
+	}' <(git diff --name-only HEAD~ HEAD) $2
+}
+
+# baseline_missing <affected> <groups...> - affected steps none of the groups have
+baseline_missing() {
+    awk -F'\t' '
+	FILENAME == ARGV[1] {
+	    want[$0] = 1
+	    next
+	}
+	NF == 1 { delete want[$1] }
+	END {
+	    for (s in want)
+		print s
+	}' "$@"
+}
+
+# baseline_output <groups after> <affected> <groups before...>
+#
+# Print the output of the build with the patch, step by step, with
+# the output of the affected steps replaced by their output before the patch
+# (from the first of the groups before which has the step). Steps which
+# don't exist before the patch print nothing. With /dev/null as affected
+# prints the output of the build with the patch as is.
+baseline_output() {
+    awk -F'\t' '
+	function text(rec) {
+	    return substr(rec, index(rec, "\t") + 1)
+	}
+	FILENAME == ARGV[1] {
+	    if (NF == 1) {
+		if (!($1 in pos)) {
+		    pos[$1] = ++n
+		    step[n] = $1
+		}
+	    } else {
+		after[$1] = after[$1] text($0) "\n"
+	    }
+	    next
+	}
+	FILENAME == ARGV[2] {
+	    affected[$0] = 1
+	    next
+	}
+	NF == 1 {
+	    if (!($1 in src))
+		src[$1] = FILENAME
+	    next
+	}
+	src[$1] == FILENAME { before[$1] = before[$1] text($0) "\n" }
+	END {
+	    printf "%s", after[""]
+	    for (i = 1; i <= n; i++) {
+		s = step[i]
+		if (!(s in affected))
+		    printf "%s", after[s]
+		else if (s in src)
+		    printf "%s", before[s]
+	    }
+	}' "$@"
+}
+
+# baseline_get <key> <file> - copy stored groups to file, fail on miss
+baseline_get() {
+    local entry=$BASELINE_DIR/$1.groups
+
+    [ -n "$BASELINE_DIR" ] || return 1
+    [ -f $entry ] || return 1
+
+    cp $entry $2
+    # Refresh the age, entries still in use don't get pruned
+    touch $entry
+}
+
+# baseline_put <key> <groups> - add groups to the store, prune old entries
+#
+# Groups already stored for the key are replaced by the new ones for
+# the same steps. Concurrent updates of the same key may lose some of
+# the groups, which only costs a build later on.
+baseline_put() {
+    local entry=$BASELINE_DIR/$1.groups
+    local tmp
+
+    [ -n "$BASELINE_DIR" ] || return 0
+
+    mkdir -p $BASELINE_DIR
+    tmp=$(mktemp -p $BASELINE_DIR)
+    [ -f $entry ] || entry=/dev/null
+    awk -F'\t' '
+	$1 == "" { next }
+	FILENAME == ARGV[1] {
+	    if (NF == 1)
+		seen[$1] = 1
+	    print
+	    next
+	}
+	!($1 in seen)' $2 $entry > $tmp
+    mv $tmp $BASELINE_DIR/$1.groups
+
+    find $BASELINE_DIR -name '*.groups' -mtime +$baseline_max_age_days -delete
+}
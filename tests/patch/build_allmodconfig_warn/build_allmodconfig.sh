@@ -6,11 +6,22 @@
 cc="ccache gcc"
 output_dir=build_allmodconfig_warn/
 ncpu=$(grep -c processor /proc/cpuinfo)
-build_flags="-Oline -j $ncpu W=1 C=1"
+jobs="-j $ncpu"
+# Let a jobserver shared by the tester limit the parallelism
+[[ "$MAKEFLAGS" == *jobserver-auth* ]] && jobs=""
+# Output synced per target, so that it can be split per build step
+build_flags="-Otarget $jobs W=1 C=1"
 tmpfile_o=$(mktemp)
 tmpfile_n=$(mktemp)
+tmplog=$(mktemp)
+groups_n=$(mktemp)
+groups_o=$(mktemp)
+groups_s=$(mktemp)
+affected=$(mktemp)
 rc=0
 
+source $(dirname $0)/../../lib/baseline.sh
+
 prep_config() {
   make CC="$cc" O=$output_dir allmodconfig
   ./scripts/config --file $output_dir/.config -d werror
@@ -35,55 +46,71 @@ echo "CC=$cc"
 $cc --version | head -n1
 
 HEAD=$(git rev-parse HEAD)
+key_extra="$cc $($cc --version | head -n1) $build_flags $(sha1sum < $0)"
 
 echo "Tree base:"
 git log -1 --pretty='%h ("%s")' HEAD~
 
-if [ x$FIRST_IN_SERIES == x0 ] && \
-   ! git diff --name-only HEAD~ | grep -q -E "Kconfig$"
-then
-    echo "Skip baseline build, not the first patch and no Kconfig updates"
-else
-    echo "Baseline building the tree"
-
-    prep_config
-    make CC="$cc" O=$output_dir $build_flags
-fi
-
 # Check if new files were added, new files will cause mod re-linking
 # so all module and linker related warnings will pop up in the "after"
 # but not "before". To avoid this we need to force re-linking on
 # the "before", too.
 touch_relink=/dev/null
+relink=0
 if ! git log --diff-filter=A HEAD~.. --exit-code >>/dev/null || \
    git diff --name-only HEAD~ | grep -q -E "Makefile$" || \
    git diff --name-only HEAD~ | grep -q -E "Kconfig$"
 then
     echo "Trying to force re-linking, new files were added"
     touch_relink=${output_dir}/include/generated/utsrelease.h
+    relink=1
 fi
 
-touch $touch_relink
-
-git checkout -q HEAD~
+echo "Building the tree with the patch"
 
-echo "Building the tree before the patch"
+# Also force rebuild "after" in case the file added isn't important.
+touch $touch_relink
 
 prep_config
-make CC="$cc" O=$output_dir $build_flags 2> >(tee $tmpfile_o >&2)
-clean_up_output $tmpfile_o
-incumbent=$(grep -i -c "\(warn\|error\)" $tmpfile_o)
+make CC="$cc" O=$output_dir $build_flags 2>&1 | tee $tmplog
+[ ${PIPESTATUS[0]} -eq 0 ] || rc=1
+clean_up_output $tmplog
+baseline_groups $tmplog > $groups_n
+# Output of steps not affected by the next patch is its output before the patch
+baseline_put $(baseline_key HEAD $output_dir/.config "$key_extra") $groups_n
+
+baseline_affected $output_dir $groups_n $relink > $affected
+echo "Build steps affected by the patch: $(wc -l < $affected)"
+
+stored=/dev/null
+if git diff --name-only HEAD~ | grep -q -E "Kconfig$"; then
+    echo "Config before the patch differs, not using stored output"
+elif baseline_get $(baseline_key HEAD~ $output_dir/.config "$key_extra") $groups_s; then
+    stored=$groups_s
+fi
 
-echo "Building the tree with the patch"
+missing=$(baseline_missing $affected $stored | wc -l)
+if [ $missing -eq 0 ]; then
+    echo "Using stored output from before the patch"
+else
+    echo "Building the tree before the patch, $missing steps not stored"
 
-git checkout -q $HEAD
+    git checkout -q HEAD~
+    touch $touch_relink
 
-# Also force rebuild "after" in case the file added isn't important.
-touch $touch_relink
+    prep_config
+    make CC="$cc" O=$output_dir $build_flags 2>&1 | tee $tmplog
+    clean_up_output $tmplog
+    baseline_groups $tmplog > $groups_o
+    baseline_put $(baseline_key HEAD $output_dir/.config "$key_extra") $groups_o
 
-prep_config
-make CC="$cc" O=$output_dir $build_flags 2> >(tee $tmpfile_n >&2) || rc=1
-clean_up_output $tmpfile_n
+    # No need to rebuild, checkout makes the objects built before the patch stale
+    git checkout -q $HEAD
+fi
+
+baseline_output $groups_n $affected $groups_o $stored > $tmpfile_o
+baseline_output $groups_n /dev/null > $tmpfile_n
+incumbent=$(grep -i -c "\(warn\|error\)" $tmpfile_o)
 current=$(grep -i -c "\(warn\|error\)" $tmpfile_n)
 
 echo "Errors and warnings before: $incumbent this patch: $current" >&$DESC_FD
@@ -107,6 +134,6 @@ if [ $current -gt $incumbent ]; then
   rc=1
 fi
 
-rm $tmpfile_o $tmpfile_n
+rm $tmpfile_o $tmpfile_n $tmplog $groups_n $groups_o $groups_s $affected
 
 exit $rc
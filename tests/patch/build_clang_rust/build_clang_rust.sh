@@ -6,7 +6,10 @@
 cc=clang
 output_dir=build_clang_rust/
 ncpu=$(grep -c processor /proc/cpuinfo)
-build_flags="-Oline -j $ncpu W=1"
+jobs="-j $ncpu"
+# Let a jobserver shared by the tester limit the parallelism
+[[ "$MAKEFLAGS" == *jobserver-auth* ]] && jobs=""
+build_flags="-Oline $jobs W=1"
 rc=0
 
 prep_config() {
@@ -108,7 +111,7 @@ echo "Building the tree with the patch"
 git checkout -q $HEAD
 
 prep_config
-make LLVM=1 O=$output_dir $build_flags -j $ncpu 2> >(tee $tmpfile_n >&2) || rc=1
+make LLVM=1 O=$output_dir $build_flags 2> >(tee $tmpfile_n >&2) || rc=1
 
 current=$(grep -i -c "\(warn\|error\)" $tmpfile_n)
 
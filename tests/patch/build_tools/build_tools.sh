@@ -3,7 +3,10 @@
 
 output_dir=build_tools/
 ncpu=$(grep -c processor /proc/cpuinfo)
-build_flags="-Oline -j $ncpu"
+jobs="-j $ncpu"
+# Let a jobserver shared by the tester limit the parallelism
+[[ "$MAKEFLAGS" == *jobserver-auth* ]] && jobs=""
+build_flags="-Oline $jobs"
 rc=0
 
 pr() {
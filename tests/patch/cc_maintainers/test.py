@@ -6,16 +6,22 @@
 Test if relevant maintainers were CCed
 """
 
+import configparser
 import datetime
 import email
 import email.utils
 import json
 import os
 import re
+import sqlite3
 import subprocess
-import tempfile
+import threading
+import time
+import uuid
 from typing import Tuple
 
+from core.get_maintainer import get_maintainer
+
 emailpat = re.compile(r'([^ <"]*@[^ >"]*)')
 
 ignore_emails = {
@@ -63,82 +69,179 @@ local_map = ["Vladimir Oltean <vladimir.oltean@nxp.com> <olteanv@gmail.com>",
 # Maintainer auto-staleness checking
 #
 
-class StalenessEntry:
-    def __init__(self, e, since_months):
-        self.email = e
-
-        self._load_time = None
-        self._query_output = None
-        self._query_depth = None
-        self._newest_mid = None
-
-        self._month_age = None
-
-        self.reload(since_months)
-
-    def __repr__(self):
-        return f'Staleness({self.email}, age:{self._month_age} search depth:{self._query_depth}, ' + \
-               f'mid:{self._newest_mid})'
+class StalenessDB:
+    """Activity of email addresses on lore, to tell who is no longer around
+
+    The results of lei queries are stored in sqlite, shared by all workers
+    and processes using the same repo. The check only reads the database and never
+    waits for lore. Addresses which are not known yet, were not searched
+    deep enough or whose entries expired (after ttl seconds) are queued,
+    and a background thread refreshes the queue in batches, with one lei
+    query per batch. Until an address is known it's not considered stale,
+    expired entries are used until they are refreshed.
+    """
+    def __init__(self, path, ttl=14 * 24 * 60 * 60, batch=8, claim_timeout=10 * 60):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.batch = batch
+        self.claim_timeout = claim_timeout
+
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        with db:
+            db.execute('''CREATE TABLE IF NOT EXISTS staleness (
+                            email TEXT PRIMARY KEY, load_time REAL, depth INTEGER,
+                            month_age REAL, newest_mid TEXT)''')
+            db.execute('''CREATE TABLE IF NOT EXISTS refresh (
+                            email TEXT PRIMARY KEY, depth INTEGER, requested REAL,
+                            claimed REAL DEFAULT 0, claim TEXT)''')
+
+    def _db(self):
+        # sqlite connections can't be shared between threads
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            self._local.db = db
+        return db
+
+    def _request(self, e, since_months):
+        with self._db() as db:
+            db.execute('''INSERT INTO refresh (email, depth, requested) VALUES (?, ?, ?)
+                          ON CONFLICT(email) DO UPDATE SET depth = max(depth, excluded.depth)''',
+                       (e, since_months, time.time()))
+
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refresh_run, daemon=True,
+                                                name="staleness-refresh")
+                self._thread.start()
+        self._wakeup.set()
 
-    def reload(self, since_months):
-        res = subprocess.run(['lei', 'q', f"f:{self.email} AND d:{since_months}.months.ago..",
-                              '--no-save', '-q', '-O', 'https://lore.kernel.org/netdev'],
-                             stdout=subprocess.PIPE)
-        output = res.stdout.decode('utf-8', 'replace')
+    def is_stale(self, e, since_months, dbg=None):
+        row = self._db().execute('''SELECT load_time, depth, month_age, newest_mid
+                                    FROM staleness WHERE email = ?''', (e,)).fetchone()
+        if row is None:
+            self._request(e, since_months)
+            if dbg is not None:
+                dbg.append(f"Staleness({e}) not known yet, refresh queued")
+            return False
 
-        self._query_output = json.loads(output)
-        self._query_depth = since_months
-        self._load_time = datetime.datetime.now(datetime.UTC)
+        load_time, depth, month_age, newest_mid = row
+        if dbg is not None:
+            dbg.append(f'Staleness({e}, age:{month_age} search depth:{depth}, mid:{newest_mid})')
 
-        newest = None
-        for e in self._query_output:
-            # Lei adds a null at the end of the list
-            if not e:
-                continue
-            dt = datetime.datetime.fromisoformat(e["rt"])
-            if not newest or dt > newest:
-                newest = dt
-                self._newest_mid = e["m"]
-
-        if not newest:
-            self._month_age = 999
-        else:
-            self._month_age = (self._load_time - newest).seconds / 60 / 60 / 24 / 30
-
-    def is_stale(self, since_months, dbg=None):
-        if datetime.datetime.now(datetime.UTC) - self._load_time > datetime.timedelta(weeks=2):
+        if time.time() - load_time > self.ttl:
             if dbg is not None:
-                dbg.append("Cache expired for " + self.email)
-            self.reload(since_months)
+                dbg.append("Cache expired for " + e)
+            self._request(e, max(depth, since_months))
 
         # We know it's not stale, doesn't matter how deep the entry is
-        if self._month_age <= since_months:
+        if month_age <= since_months:
             return False
         # The query may have not been deep enough, refresh..
-        if self._query_depth < since_months:
-            self.reload(since_months)
-        return self._month_age > since_months
-
-
-class StalenessDB:
-    def __init__(self):
-        self._db = {}
-
-    def is_stale(self, e, since_months, dbg=None):
-        if e not in self._db:
-            self._db[e] = StalenessEntry(e, since_months)
-
-        ret = self._db[e].is_stale(since_months, dbg)
-
-        if dbg is not None:
-            dbg.append(repr(self._db[e]))
-        return ret
-
-
-stale_db = StalenessDB()
-
-
-def get_stale(sender_from, missing, out):
+        if depth < since_months:
+            self._request(e, since_months)
+            return False
+        return True
+
+    def _claim(self):
+        claim = uuid.uuid4().hex
+        now = time.time()
+        with self._db() as db:
+            db.execute('''UPDATE refresh SET claimed = ?, claim = ? WHERE email IN
+                            (SELECT email FROM refresh WHERE claimed < ?
+                             ORDER BY requested LIMIT ?)''',
+                       (now, claim, now - self.claim_timeout, self.batch))
+        rows = self._db().execute('SELECT email, depth FROM refresh WHERE claim = ?',
+                                  (claim,)).fetchall()
+        return claim, rows
+
+    @staticmethod
+    def _lei_query(emails, since_months):
+        query = '(' + ' OR '.join(f"f:{e}" for e in emails) + f') AND d:{since_months}.months.ago..'
+        res = subprocess.run(['lei', 'q', query, '--no-save', '-q', '-O', 'https://lore.kernel.org/netdev'],
+                             stdout=subprocess.PIPE, check=True)
+        return json.loads(res.stdout.decode('utf-8', 'replace'))
+
+    @staticmethod
+    def _sender_addrs(f):
+        """Addresses in the From of a lei result, "f" is a list of [name, address]"""
+        if isinstance(f, str):
+            f = [f]
+        addrs = set()
+        for sender in f or []:
+            if isinstance(sender, list):
+                addrs.add(sender[-1].lower())
+            else:
+                addrs.update(addr.lower() for _, addr in email.utils.getaddresses([sender]))
+        return addrs
+
+    def _refresh(self, claim, rows):
+        emails = [row[0] for row in rows]
+        depth = max(row[1] for row in rows)
+        output = self._lei_query(emails, depth)
+        load_time = datetime.datetime.now(datetime.UTC)
+
+        newest = {}
+        for msg in output:
+            # Lei adds a null at the end of the list
+            if not msg:
+                continue
+            senders = self._sender_addrs(msg.get("f"))
+            dt = datetime.datetime.fromisoformat(msg["rt"])
+            for e in emails:
+                if e.lower() in senders and (e not in newest or dt > newest[e][0]):
+                    newest[e] = (dt, msg["m"])
+
+        with self._db() as db:
+            for e in emails:
+                if e in newest:
+                    month_age = (load_time - newest[e][0]).total_seconds() / 60 / 60 / 24 / 30
+                    mid = newest[e][1]
+                else:
+                    month_age = 999
+                    mid = None
+                db.execute('''INSERT OR REPLACE INTO staleness
+                              (email, load_time, depth, month_age, newest_mid)
+                              VALUES (?, ?, ?, ?, ?)''',
+                           (e, load_time.timestamp(), depth, month_age, mid))
+            db.execute('DELETE FROM refresh WHERE claim = ?', (claim,))
+
+    def _refresh_run(self):
+        while True:
+            try:
+                claim, rows = self._claim()
+                if rows:
+                    self._refresh(claim, rows)
+                    continue
+            except (sqlite3.Error, subprocess.CalledProcessError, OSError, ValueError, KeyError):
+                # Claimed entries will be retried once the claim times out
+                pass
+            # Also pick up requests queued by other processes
+            self._wakeup.wait(60)
+            self._wakeup.clear()
+
+
+_stale_dbs = {}
+_stale_dbs_lock = threading.Lock()
+
+
+def stale_db_get(tree):
+    """Get the staleness DB, kept in the state dir of the tree's repo"""
+    path = os.path.join(tree.state_dir(), 'staleness.db')
+    with _stale_dbs_lock:
+        if path not in _stale_dbs:
+            _stale_dbs[path] = StalenessDB(path)
+        return _stale_dbs[path]
+
+
+def get_stale(stale_db, sender_from, missing, out):
     sender_corp = None
     for corp in corp_suffix:
         if sender_from.endswith(corp):
@@ -159,6 +262,34 @@ def get_stale(sender_from, missing, out):
 # Main
 #
 
+_config = None
+
+
+def _test_config():
+    """Config of the tester running us, read on first use"""
+    global _config
+
+    if _config is None:
+        config = configparser.ConfigParser()
+        config.read(['nipa.config', 'pw.config', 'tester.config'])
+        _config = config
+    return _config
+
+
+def run_get_maintainer(tree, patch, out):
+    config = _test_config()
+    engine = config.get('cc_maintainers', 'engine', fallback='script')
+    min_percent = config.getint('cc_maintainers', 'git_min_percent', fallback=35)
+
+    try:
+        return get_maintainer(tree, patch, engine, min_percent)
+    except Exception as e:
+        if engine == 'script':
+            raise
+        out += [f"get_maintainer engine {engine} failed: {e}, using the script", ""]
+        return get_maintainer(tree, patch, 'script', min_percent)
+
+
 def cc_maintainers(tree, thing, result_dir) -> Tuple[int, str, str]:
     """ Main test entry point """
     out = []
@@ -168,7 +299,7 @@ def cc_maintainers(tree, thing, result_dir) -> Tuple[int, str, str]:
     if patch.series and patch.series.cover_pull:
         return 0, "Pull request co-post, skipping", ""
 
-    msg = email.message_from_string(patch.raw_patch)
+    msg = patch.parsed.headers
     addrs = msg.get_all('to', [])
     addrs += msg.get_all('cc', [])
     addrs += msg.get_all('from', [])
@@ -190,26 +321,19 @@ def cc_maintainers(tree, thing, result_dir) -> Tuple[int, str, str]:
     blamed = set()
     pure_blamed = set()
     ignored = set()
-    with tempfile.NamedTemporaryFile() as fp:
-        patch.write_out(fp)
-        command = ['./scripts/get_maintainer.pl', '--git-min-percent', '35', '--', fp.name]
-        with subprocess.Popen(command, cwd=tree.path, stdout=subprocess.PIPE) as p:
-            line = p.stdout.readline().decode('utf8', 'replace')
-            while line:
-                raw_gm.append(line.strip())
-                match = emailpat.search(line)
-                if match:
-                    addr = match.group(1).lower()
-                    expected.add(addr)
-                    if 'blamed_fixes' in line:
-                        blamed.add(addr)
-                        if 'maintainer' not in line:
-                            pure_blamed.add(addr)
-                for domain in ignore_domains:
-                    if domain in addr:
-                        ignored.add(addr)
-                line = p.stdout.readline().decode('utf8', 'replace')
-            p.wait()
+    for line in run_get_maintainer(tree, patch, out):
+        raw_gm.append(line)
+        match = emailpat.search(line)
+        if match:
+            addr = match.group(1).lower()
+            expected.add(addr)
+            if 'blamed_fixes' in line:
+                blamed.add(addr)
+                if 'maintainer' not in line:
+                    pure_blamed.add(addr)
+        for domain in ignore_domains:
+            if domain in addr:
+                ignored.add(addr)
 
     expected.difference_update(ignore_emails)
     blamed.difference_update(ignore_emails)
@@ -228,7 +352,7 @@ def cc_maintainers(tree, thing, result_dir) -> Tuple[int, str, str]:
     missing_blamed = blamed.difference(included)
 
     stale_log = []
-    stale = get_stale(sender_from, missing_blamed, stale_log)
+    stale = get_stale(stale_db_get(tree), sender_from, missing_blamed, stale_log)
     out.append(f"Stale: {stale}")
 
     # Ditch all stale from blames, and from missing only those stales who aren't maintainers.
@@ -133,25 +133,16 @@ def extract_files(patch):
 
     new_files = set()
     mod_files = set()
-    lines = patch.raw_patch.split("\n")
-
-    # Walk lines, skip last since it doesn't have next
-    for i, line in enumerate(lines[:-1]):
-        next_line = lines[i + 1]
-
-        if not next_line.startswith("+++ b/"):
-            continue
-        if 'tools/testing/selftests/' not in next_line:
+    for f in patch.parsed.files:
+        if 'tools/testing/selftests/' not in f.path:
             continue
-        if '/net/' not in next_line:
+        if '/net/' not in f.path:
             continue
 
-        file_path = next_line[6:]
-
-        if line == "--- /dev/null":
-            new_files.add(file_path)
-        else:
-            mod_files.add(file_path)
+        if f.status == 'A':
+            new_files.add(f.path)
+        elif f.status != 'D':
+            mod_files.add(f.path)
 
     # We're testing a series, same file may appear multiple times
     mod_files -= new_files
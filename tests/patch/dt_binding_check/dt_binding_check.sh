@@ -4,6 +4,9 @@
 
 HEAD=$(git rev-parse HEAD)
 ncpu=$(grep -c processor /proc/cpuinfo)
+jobs="-j $ncpu"
+# Let a jobserver shared by the tester limit the parallelism
+[[ "$MAKEFLAGS" == *jobserver-auth* ]] && jobs=""
 rc=0
 
 pr() {
@@ -11,7 +14,7 @@ pr() {
 }
 
 build() {
-    make -s -j $ncpu DT_CHECKER_FLAGS=-m dt_binding_check 2>&1
+    make -s $jobs DT_CHECKER_FLAGS=-m dt_binding_check 2>&1
 }
 
 # Only run this check if the patch touches DT binding files.
@@ -4,7 +4,10 @@
 
 HEAD=$(git rev-parse HEAD)
 nproc=$(grep -c processor /proc/cpuinfo)
-build_flags="-j $nproc"
+jobs="-j $nproc"
+# Let a jobserver shared by the tester limit the parallelism
+[[ "$MAKEFLAGS" == *jobserver-auth* ]] && jobs=""
+build_flags="$jobs"
 rc=0
 
 architectures=(
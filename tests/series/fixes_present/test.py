@@ -2,8 +2,6 @@
 #
 # Copyright (C) 2019 Netronome Systems, Inc.
 
-import re
-
 from typing import Tuple
 """ Test presence of the Fixes tag in non *-next patches """
 
@@ -12,21 +10,14 @@ def fixes_present(tree, thing, result_dir) -> Tuple[int, str]:
     if tree.pfx.count("next"):
         return 0, "Fixes tag not required for -next series"
     for patch in thing.patches:
-        if patch.raw_patch.count('\nFixes: '):
+        if patch.parsed.fixes:
             return 0, "Fixes tag present in non-next series"
 
-    r_header = re.compile(r'\+\+\+ b/([-\w/._]+)$')
     all_safe = None
     for p in thing.patches:
-        lines = p.raw_patch.split('\n')
         safe = None
 
-        for line in lines:
-            match = r_header.match(line)
-            if not match:
-                continue
-
-            file_name = match.group(1)
+        for file_name in p.parsed.file_names(status='AMR'):
             if file_name.startswith("Documentation/") or \
                 file_name.startswith("MAINTAINERS"):
                 safe = True
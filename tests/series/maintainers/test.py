@@ -17,26 +17,16 @@ def extract_files(series):
 
     new_files = set()
     mod_files = set()
-    lines = []
     for patch in series.patches:
-        lines += patch.raw_patch.split("\n")
-
-    # Walk lines, skip last since it doesn't have next
-    for i, line in enumerate(lines[:-1]):
-        next_line = lines[i + 1]
-
-        if not next_line.startswith("+++ b/"):
-            continue
-        file_path = next_line[6:]
-
-        # .startswith() can take a while array of alternatives
-        if file_path.startswith(tuple(new_file_ignore_pfx)):
-            continue
-
-        if line == "--- /dev/null":
-            new_files.add(file_path)
-        else:
-            mod_files.add(file_path)
+        for f in patch.parsed.files:
+            # .startswith() can take a while array of alternatives
+            if f.path.startswith(tuple(new_file_ignore_pfx)):
+                continue
+
+            if f.status == 'A':
+                new_files.add(f.path)
+            elif f.status != 'D':
+                mod_files.add(f.path)
 
     # We're testing a series, same file may appear multiple times
     mod_files -= new_files
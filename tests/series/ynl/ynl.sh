@@ -5,6 +5,9 @@
 
 HEAD=$(git rev-parse HEAD)
 ncpu=$(grep -c processor /proc/cpuinfo)
+jobs="-j $ncpu"
+# Let a jobserver shared by the tester limit the parallelism
+[[ "$MAKEFLAGS" == *jobserver-auth* ]] && jobs=""
 tmpfile=$(mktemp)
 rc=0
 
@@ -23,7 +26,7 @@ fi
 ##################################################################
 echo " ====== 2/ Test build ======"
 make -C tools/net/ynl/ distclean
-if ! make -C tools/net/ynl/ -j $ncpu 2> >(tee $tmpfile >&2); then
+if ! make -C tools/net/ynl/ $jobs 2> >(tee $tmpfile >&2); then
   echo "build failed;" >&$DESC_FD
   rc=1
 fi
@@ -45,13 +48,13 @@ TEMP_DIR=$(mktemp -d /tmp/ynl_build-tmp.XXXXXX)
 mkdir $TEMP_DIR/old-code
 git checkout -q $BRANCH_BASE
 make -C tools/net/ynl/generated/ distclean
-make -C tools/net/ynl/generated/ -j $ncpu
+make -C tools/net/ynl/generated/ $jobs
 cp tools/net/ynl/generated/*.[ch] $TEMP_DIR/old-code/
 
 mkdir $TEMP_DIR/new-code
 git checkout -q $HEAD
 make -C tools/net/ynl/generated/ distclean
-make -C tools/net/ynl/generated/ -j $ncpu
+make -C tools/net/ynl/generated/ $jobs
 cp tools/net/ynl/generated/*.[ch] $TEMP_DIR/new-code/
 
 git diff --no-index --stat \